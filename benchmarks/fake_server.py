@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for WhatsApp chat endpoint. Speaks enough of the protocol for a yowsup stack without E2E
+encryption: stream start, challenge authentication with the account password, encrypted stanzas, acks
+for messages and results for pings.
+"""
+import os
+import time
+import base64
+import socket
+import logging
+import threading
+from yowsup.structs import ProtocolTreeNode
+from yowsup.layers.auth.keystream import KeyStream
+from yowsup.layers.coder.encoder import WriteEncoder
+from yowsup.layers.coder.decoder import ReadDecoder
+from yowsup.layers.coder.tokendictionary import TokenDictionary
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+logger = logging.getLogger(__name__)
+
+ENCRYPTED = 8
+
+
+class FakeSession(socketserver.BaseRequestHandler):
+    """
+    One client connection. Stanzas are frames of 3 bytes header, flags and size, and a payload
+    encrypted once authenticated
+    """
+
+    def setup(self):
+        dictionary = TokenDictionary()
+        self.reader = ReadDecoder(dictionary)
+        self.writer = WriteEncoder(dictionary)
+        self.input_key = None
+        self.output_key = None
+        self.nonce = None
+        self.phone = None
+        self.write_lock = threading.Lock()
+
+    def recv_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data.extend(chunk)
+        return data
+
+    def read_node(self):
+        header = self.recv_exactly(3)
+        size = ((header[1] << 8) + header[2]) | ((header[0] & 0x0F) << 16)
+        payload = self.recv_exactly(size)
+        if header[0] >> 4 & ENCRYPTED:
+            payload = self.input_key.decodeMessage(payload, 0, 4, len(payload) - 4)
+        return self.reader.getProtocolTreeNode(payload)
+
+    def write_frame(self, data):
+        data = bytearray(data)
+        flags = 0
+        if self.output_key:
+            data = bytearray(self.output_key.encodeMessage(data, len(data), 0, len(data)))
+            flags = ENCRYPTED
+        size = len(data)
+        header = bytearray([(flags << 4) | (size >> 16), (size >> 8) & 0xFF, size & 0xFF])
+        with self.write_lock:
+            self.request.sendall(bytes(header + data))
+
+    def write_node(self, node):
+        self.write_frame(self.writer.protocolTreeNodeToBytes(node))
+
+    def handle(self):
+        try:
+            # WA prologue, version and stream start
+            self.recv_exactly(4)
+            self.read_node()
+            self.write_frame(self.writer.getStreamStartBytes(self.server.domain, "server")[4:])
+            while True:
+                node = self.read_node()
+                if node is not None:
+                    self.dispatch(node)
+        except (EOFError, socket.error):
+            pass
+        except Exception:
+            logger.exception("Fake server session error")
+
+    def dispatch(self, node):
+        handler = getattr(self, "on_%s" % node.tag, None)
+        if handler:
+            handler(node)
+
+    def on_auth(self, node):
+        self.phone = node.getAttributeValue("user")
+        self.nonce = bytearray(os.urandom(20))
+        self.write_node(ProtocolTreeNode("challenge", {}, None, self.nonce.decode("latin-1")))
+
+    def on_response(self, node):
+        password = self.server.accounts.get(self.phone)
+        blob = node.getData()
+        blob = bytearray(blob.encode("latin-1") if not isinstance(blob, (bytes, bytearray)) else blob)
+        if password is None:
+            self.fail()
+            return
+        keys = KeyStream.generateKeys(bytearray(base64.b64decode(password)), self.nonce)
+        input_key = KeyStream(keys[0], keys[1])
+        # auth blob has its mac at the start
+        if input_key.computeMac(blob[4:], 0, len(blob) - 4)[:4] != blob[:4]:
+            self.fail()
+            return
+        input_key.rc4.cipher(blob, 4, len(blob) - 4)
+        self.input_key = input_key
+        self.output_key = KeyStream(keys[2], keys[3])
+        now = str(int(time.time()))
+        self.write_node(ProtocolTreeNode("success", {"status": "active", "kind": "free", "creation": now,
+                                                     "expiration": str(int(time.time()) + 365 * 24 * 3600),
+                                                     "props": "1", "t": now}))
+
+    def fail(self):
+        self.write_node(ProtocolTreeNode("failure", {}, [ProtocolTreeNode("not-authorized")]))
+        self.request.close()
+        raise EOFError()
+
+    def on_message(self, node):
+        self.server.messages += 1
+        delay = self.server.ack_delay
+        ack = ProtocolTreeNode("ack", {"class": "message", "id": node.getAttributeValue("id"),
+                                       "from": node.getAttributeValue("to"), "t": str(int(time.time()))})
+        if delay:
+            timer = threading.Timer(delay, self.write_node, (ack,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.write_node(ack)
+
+    def on_iq(self, node):
+        if node.getAttributeValue("type") in ("get", "set"):
+            self.write_node(ProtocolTreeNode("iq", {"type": "result", "id": node.getAttributeValue("id"),
+                                                    "from": self.server.domain}))
+
+
+class FakeServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    Threaded fake WhatsApp server listening on localhost
+
+    :ivar dict accounts: base64 password by phone number allowed to log in
+    :ivar float ack_delay: secs to wait before acking each message
+    :ivar int messages: messages received
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    domain = "s.whatsapp.net"
+
+    def __init__(self, accounts, address=("127.0.0.1", 0), ack_delay=0):
+        socketserver.TCPServer.__init__(self, address, FakeSession)
+        self.accounts = dict(accounts)
+        self.ack_delay = ack_delay
+        self.messages = 0
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        return self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="fake-whatsapp")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
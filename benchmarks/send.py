@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of send_message task through YowsupStack loop against the local fake WhatsApp server.
+
+    $ python -m benchmarks.send --messages 2000 --concurrency 8
+    $ python -m benchmarks.send --pool gevent --detached-delay 0.05 --poll
+    $ python -m benchmarks.send --matrix --pools threads,gevent --detached-delays 0.01,0.2,1
+
+Each run reports messages/sec, p50/p99 latency from task start to ack and peak memory. Matrix runs every
+combination in its own process, gevent needs monkey patching before anything else is imported.
+"""
+from __future__ import print_function
+import sys
+import argparse
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="send_message benchmark against a fake WhatsApp server")
+    parser.add_argument("--messages", type=int, default=1000, help="messages to send")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent producers, as worker concurrency")
+    parser.add_argument("--pool", choices=["threads", "gevent"], default="threads", help="worker pool emulated")
+    parser.add_argument("--loop", default=None, help="loop backend, asyncore by default")
+    parser.add_argument("--detached-delay", type=float, default=0.2,
+                        help="secs waiting detached callbacks, used with --poll")
+    parser.add_argument("--poll", action="store_true",
+                        help="poll detached queue instead of waking the loop with a socket pair")
+    parser.add_argument("--batch-size", type=int, default=None, help="max detached callbacks per iteration")
+    parser.add_argument("--ack-delay", type=float, default=0, help="secs the server waits before each ack")
+    parser.add_argument("--matrix", action="store_true", help="run every pool and detached delay combination")
+    parser.add_argument("--pools", default="threads,gevent", help="pools of matrix")
+    parser.add_argument("--detached-delays", default="0.01,0.2,1", help="detached delays of matrix")
+    parser.add_argument("--json", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def peak_memory_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+
+def run(args):
+    """
+    Send args.messages with send_message task waiting for their acks
+    :returns: dict of results
+    """
+    import time
+    import base64
+    import threading
+    from celery import Celery
+    from yowsup.layers.network import YowNetworkLayer
+    from yowsup_celery import tasks
+    from yowsup_celery.stack import YowsupStack
+    from yowsup_celery.registry import StackRegistry
+    from yowsup_celery.routing import AccountRouter
+    from benchmarks.fake_server import FakeServer
+
+    phone = "341111111"
+    password = base64.b64encode(b"benchmark-password").decode()
+    server = FakeServer({phone: password}, ack_delay=args.ack_delay).start()
+    app = Celery("benchmark")
+    # producer threads resolve shared tasks with the default app
+    app.set_default()
+    stack = YowsupStack((phone, password), False, loop_backend=args.loop)
+    stack.setProp(YowNetworkLayer.PROP_ENDPOINT, server.endpoint)
+    if args.poll:
+        stack._open_wakeup = lambda: None
+    app.stack = stack
+    app.stacks = StackRegistry([stack])
+    app.router = AccountRouter(app.stacks)
+
+    loop = threading.Thread(target=stack.asynloop, kwargs=dict(timeout=1, detached_delay=args.detached_delay,
+                                                               batch_size=args.batch_size, persistent=True))
+    loop.daemon = True
+    loop.start()
+    deadline = time.time() + 10
+    while not stack.facade.connected():
+        if time.time() > deadline:
+            raise RuntimeError("Not connected to fake server")
+        time.sleep(0.01)
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def produce(count):
+        for i in range(count):
+            start = time.time()
+            try:
+                tasks.send_message.apply(args=("342222222", "benchmark %d" % i), kwargs={"result": "ack"}).get()
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                continue
+            with lock:
+                latencies.append(time.time() - start)
+
+    counts = [args.messages // args.concurrency] * args.concurrency
+    counts[0] += args.messages - sum(counts)
+    producers = [threading.Thread(target=produce, args=(count,)) for count in counts]
+    start = time.time()
+    for producer in producers:
+        producer.start()
+    for producer in producers:
+        producer.join()
+    elapsed = time.time() - start
+
+    stack.stop()
+    loop.join(10)
+    server.stop()
+    return {
+        "pool": args.pool,
+        "loop": args.loop or "asyncore",
+        "wakeup": "poll" if args.poll else "socketpair",
+        "detached_delay": args.detached_delay,
+        "messages": len(latencies),
+        "errors": len(errors),
+        "msg_per_sec": len(latencies) / elapsed if elapsed else 0,
+        "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+        "peak_mb": peak_memory_mb(),
+    }
+
+
+COLUMNS = ("pool", "loop", "wakeup", "detached_delay", "messages", "errors", "msg_per_sec", "p50_ms", "p99_ms",
+           "peak_mb")
+
+
+def format_row(result):
+    cells = []
+    for column in COLUMNS:
+        value = result.get(column)
+        cells.append("%.2f" % value if isinstance(value, float) else str(value))
+    return "\t".join(cells)
+
+
+def run_matrix(args):
+    import json
+    import subprocess
+    print("\t".join(COLUMNS))
+    for pool in args.pools.split(","):
+        for delay in args.detached_delays.split(","):
+            command = [sys.executable, "-m", "benchmarks.send", "--json", "--pool", pool, "--detached-delay", delay,
+                       "--messages", str(args.messages), "--concurrency", str(args.concurrency),
+                       "--ack-delay", str(args.ack_delay)]
+            if args.loop:
+                command += ["--loop", args.loop]
+            if args.poll:
+                command.append("--poll")
+            if args.batch_size:
+                command += ["--batch-size", str(args.batch_size)]
+            output = subprocess.check_output(command).decode()
+            print(format_row(json.loads(output.strip().splitlines()[-1])))
+            sys.stdout.flush()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.matrix:
+        return run_matrix(args)
+    if args.pool == "gevent":
+        from gevent import monkey
+        monkey.patch_all()
+    result = run(args)
+    if args.json:
+        import json
+        print(json.dumps(result))
+    else:
+        print("\t".join(COLUMNS))
+        print(format_row(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,9 @@ from yowsup_celery.celery import YowCelery
                         phonenumber:password,                      where
                         password is base64 encoded.
   --yowunmoxie          Disable E2E Encryption
+  --yowpersistent       Keep WhatsApp connection alive until worker stops
+  --yowloop=LOOP        Event loop polling WhatsApp connection: asyncore
+                        (default), asyncio or gevent
 
 """
 
@@ -19,7 +19,9 @@ requirements = [
                 'celery>=3.1.19',
                 'gevent>=1.0.2',
                 #install fork git+https://github.com/jlmadurga/yowsup.git@issue_1181#egg=yowsup 
-                'yowsup2'
+                'yowsup2',
+                # asyncore was removed from the standard library in Python 3.12
+                'pyasyncore; python_version >= "3.12"'
                 ]
 test_requirements = requirements + [
                      'mock>=1.3.0'
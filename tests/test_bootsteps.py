@@ -6,6 +6,7 @@ from yowsup_celery.steps import YowsupStep
 from yowsup_celery.stack import YowsupStack
 from yowsup_celery.layer_interface import CeleryLayerInterface
 from yowsup_celery.exceptions import ConfigurationError
+from yowsup.layers.protocol_iq import YowIqProtocolLayer
 try:
     from unittest import mock
 except ImportError:
@@ -85,6 +86,72 @@ class TestYowsupStep(unittest.TestCase):
         step.stop(self.worker)
         self.assertEqual(0, self.worker.app.stack.facade.disconnect.call_count)
 
+    def test_init_persistent(self):
+        self.worker.app.conf.table = mock.MagicMock(return_value={'YOWSUP_PING_INTERVAL': 20,
+                                                                  'YOWSUP_PONG_TIMEOUT': 5})
+        YowsupStep(self.worker, "341234567:password", None, True, persistent=True)
+        self.assertTrue(self.worker.app.stack.persistent)
+        self.assertEqual(20, self.worker.app.stack.facade._layer.ping_interval)
+        self.assertEqual(5, self.worker.app.stack.facade._layer.pong_timeout)
+        # yowsup ping thread disabled, pings are sent by the loop
+        self.assertEqual(0, self.worker.app.stack.getProp(YowIqProtocolLayer.PROP_PING_INTERVAL))
+
+    def test_stop_requests_loop_stop(self):
+        step = self._correct_login_step()
+        self.worker.app.stack.facade.connected = mock.MagicMock(return_value=False)
+        step.stop(self.worker)
+        self.assertTrue(self.worker.app.stack.stopping)
+
+    def test_start_persistent_loop(self):
+        step = YowsupStep(self.worker, "341234567:password", None, True, persistent=True)
+        self.worker.app.stack.asynloop = mock.MagicMock()
+        step.start(self.worker)
+        step.listener.join(1)
+        self.worker.app.stack.asynloop.assert_called_once_with(persistent=True)
+        step.stop(self.worker)
+        self.assertIsNone(step.listener)
+
+    def test_start_not_persistent(self):
+        step = self._correct_login_step()
+        self.worker.app.stack.asynloop = mock.MagicMock()
+        step.start(self.worker)
+        self.assertIsNone(step.listener)
+        self.assertEqual(0, self.worker.app.stack.asynloop.call_count)
+
+    def test_metrics_exporter(self):
+        self.worker.app.conf.table = mock.MagicMock(return_value={'YOWSUP_METRICS_PORT': 0})
+        step = self._correct_login_step()
+        self.assertIs(self.worker.app.metrics, self.worker.app.stack.metrics)
+        step.start(self.worker)
+        self.assertIsNotNone(step.exporter)
+        self.worker.app.stack.facade.connected = mock.MagicMock(return_value=False)
+        step.stop(self.worker)
+        self.assertIsNone(step.exporter)
+
+    def test_metrics_disabled(self):
+        self._correct_login_step()
+        self.assertIsNone(self.worker.app.metrics)
+
+    def test_init_inbound_task(self):
+        self.worker.app.conf.table = mock.MagicMock(return_value={'YOWSUP_INBOUND_TASK': 'proj.tasks.inbound',
+                                                                  'YOWSUP_INBOUND_BATCH_SIZE': 50})
+        self._correct_login_step()
+        inbound = self.worker.app.stack.facade._layer.inbound
+        self.assertEqual('proj.tasks.inbound', inbound.sink.task_name)
+        self.assertEqual(50, inbound.batch_size)
+
+    def test_init_accounts(self):
+        self.worker.app.conf.table = mock.MagicMock(return_value={'YOWSUP_ACCOUNTS': ['342222222:password']})
+        step = self._correct_login_step()
+        self.assertEqual(['341234567', '342222222'], self.worker.app.stacks.accounts())
+        self.assertEqual(self.worker.app.stack, self.worker.app.stacks.get())
+        stack = self.worker.app.stacks.get('342222222')
+        self.assertStackIntiliazed(stack)
+        stack.facade.connected = mock.MagicMock(return_value=True)
+        stack.facade.disconnect = mock.MagicMock()
+        step.stop(self.worker)
+        stack.facade.disconnect.assert_called_once_with()
+
 if __name__ == '__main__':
     import sys
     sys.exit(unittest.main())
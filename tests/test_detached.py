@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import threading
+import time
+from yowsup_celery.detached import DetachedQueue, LoopCall
+from yowsup_celery.exceptions import QueueFullError, LoopTimeoutError, ConfigurationError
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+
+class TestDetachedQueue(unittest.TestCase):
+
+    def test_lanes_priority(self):
+        queue = DetachedQueue()
+        queue.put("bulk", "bulk")
+        queue.put("transactional", "transactional")
+        queue.put("control")
+        self.assertEqual(3, queue.qsize())
+        self.assertEqual(1, queue.depth("bulk"))
+        self.assertEqual(["control", "transactional", "bulk"], [queue.get(False) for _ in range(3)])
+        self.assertRaises(Queue.Empty, queue.get, False)
+        self.assertRaises(Queue.Empty, queue.get, True, 0.01)
+
+    def test_reject(self):
+        queue = DetachedQueue(2, "reject")
+        queue.put(1, "bulk")
+        queue.put(2, "bulk")
+        self.assertRaises(QueueFullError, queue.put, 3, "bulk")
+        queue.put(4, "transactional")
+        # control lane is not bounded
+        for i in range(5):
+            queue.put(i)
+        self.assertEqual(2, queue.depth("bulk"))
+
+    def test_shed_oldest(self):
+        queue = DetachedQueue(2, "shed_oldest")
+        calls = [LoopCall(lambda i=i: i) for i in range(3)]
+        for call in calls:
+            queue.put(call, "bulk")
+        self.assertEqual(calls[1:], [queue.get(False), queue.get(False)])
+        self.assertEqual(1, queue.dropped["bulk"])
+        self.assertRaises(QueueFullError, calls[0].wait, 0)
+
+    def test_block(self):
+        queue = DetachedQueue(1, "block", timeout=0.05)
+        queue.put(1, "bulk")
+        start = time.time()
+        self.assertRaises(QueueFullError, queue.put, 2, "bulk")
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        timer = threading.Timer(0.05, queue.get)
+        timer.start()
+        queue.timeout = 5
+        queue.put(2, "bulk")
+        self.assertEqual(2, queue.get(False))
+        timer.join()
+
+    def test_unknown_policy(self):
+        self.assertRaises(ConfigurationError, DetachedQueue, 1, "drop")
+
+    def test_cancel_calls(self):
+        queue = DetachedQueue()
+        calls = [LoopCall(lambda: None) for _ in range(3)]
+        queue.put(calls[0], "control")
+        queue.put(calls[1], "transactional")
+        queue.put(lambda: None, "bulk")
+        queue.put(calls[2], "bulk")
+        self.assertEqual(2, queue.cancel_calls(LoopTimeoutError()))
+        self.assertEqual(1, queue.depth("control"))
+        self.assertEqual(1, queue.depth("bulk"))
+        self.assertFalse(hasattr(queue.get(lane="bulk", block=False), "cancel"))
+        for call in calls[1:]:
+            self.assertRaises(LoopTimeoutError, call.wait, 0)
+
+
+class TestLoopCall(unittest.TestCase):
+
+    def test_result(self):
+        call = LoopCall(lambda: "result")
+        threading.Timer(0.01, call).start()
+        self.assertEqual("result", call.wait(1))
+
+    def test_error(self):
+        call = LoopCall(lambda: 1 / 0)
+        call()
+        self.assertRaises(ZeroDivisionError, call.wait, 1)
+
+    def test_timeout_cancels(self):
+        executed = []
+        call = LoopCall(lambda: executed.append(True))
+        self.assertRaises(LoopTimeoutError, call.wait, 0.01)
+        call()
+        self.assertEqual([], executed)
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unittest.main())
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import base64
+import threading
+import time
+from yowsup.layers.network import YowNetworkLayer
+from yowsup_celery.stack import YowsupStack
+from yowsup_celery.registry import StackRegistry
+from yowsup_celery.exceptions import AuthenticationError
+from benchmarks.fake_server import FakeServer
+
+
+class TestFakeServer(unittest.TestCase):
+
+    def setUp(self):
+        self.password = base64.b64encode(b"password").decode()
+        self.server = FakeServer({"341111111": self.password}).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _stack(self, number, password):
+        stack = YowsupStack((number, password))
+        stack.setProp(YowNetworkLayer.PROP_ENDPOINT, self.server.endpoint)
+        return stack
+
+    def _loop(self, password, accounts=()):
+        stack = self._stack("341111111", password)
+        registry = StackRegistry([stack] + list(accounts))
+        errors = []
+
+        def loop():
+            try:
+                registry.asynloop(timeout=0.5, persistent=True)
+            except Exception as e:
+                errors.append(e)
+        thread = threading.Thread(target=loop)
+        thread.daemon = True
+        thread.start()
+        deadline = time.time() + 5
+        while not stack.facade.connected() and thread.is_alive() and time.time() < deadline:
+            time.sleep(0.01)
+        return stack, thread, errors
+
+    def test_login_and_ack(self):
+        stack, thread, errors = self._loop(self.password)
+        self.assertTrue(stack.facade.connected())
+        message = stack.facade.send_message("342222222", "message test")
+        delivery = stack.facade.wait_delivery(message.getId(), "ack", 5)
+        self.assertIsNotNone(delivery)
+        self.assertEqual(1, self.server.messages)
+        stack.stop()
+        thread.join(5)
+        self.assertEqual([], errors)
+
+    def test_login_wrong_password(self):
+        stack, thread, errors = self._loop(base64.b64encode(b"wrong").decode())
+        thread.join(5)
+        self.assertFalse(stack.facade.connected())
+        self.assertEqual(1, len(errors))
+        self.assertIsInstance(errors[0], AuthenticationError)
+
+    def test_login_wrong_password_other_account_keeps_looping(self):
+        failing = self._stack("342222222", base64.b64encode(b"wrong").decode())
+        stack, thread, errors = self._loop(self.password, [failing])
+        deadline = time.time() + 5
+        while failing.auth_error is None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIsNotNone(failing.auth_error)
+        self.assertFalse(failing.listening)
+        self.assertTrue(thread.is_alive())
+        self.assertTrue(stack.facade.connected())
+        message = stack.facade.send_message("342222222", "message test")
+        self.assertIsNotNone(stack.facade.wait_delivery(message.getId(), "ack", 5))
+        stack.registry.stop()
+        thread.join(5)
+        self.assertEqual([], errors)
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unittest.main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from yowsup_celery.inbound import InboundDispatcher, TaskSink, message_event, receipt_event
+from yowsup_celery.exceptions import QueueFullError
+from yowsup_celery.utils import WorkerPool
+from yowsup.layers.protocol_messages.protocolentities import TextMessageProtocolEntity
+from yowsup.layers.protocol_receipts.protocolentities import IncomingReceiptProtocolEntity
+try:
+    from unittest import mock
+except ImportError:
+    import mock  # noqa
+
+
+class TestEvents(unittest.TestCase):
+
+    def test_message_event(self):
+        entity = TextMessageProtocolEntity("hello", _from="341234567@s.whatsapp.net", timestamp=1450000000)
+        event = message_event(entity)
+        self.assertEqual("message", event["event"])
+        self.assertEqual(entity.getId(), event["id"])
+        self.assertEqual("341234567@s.whatsapp.net", event["from"])
+        self.assertEqual("hello", event["body"])
+        self.assertEqual(1450000000, event["timestamp"])
+
+    def test_receipt_event(self):
+        entity = IncomingReceiptProtocolEntity("123", "341234567@s.whatsapp.net", 1450000000, items=["124"])
+        event = receipt_event(entity)
+        self.assertEqual(("receipt", "123", ["124"]), (event["event"], event["id"], event["items"]))
+
+
+class TestInboundDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = mock.Mock()
+        self.scheduler = mock.Mock()
+        self.dispatcher = InboundDispatcher(self.sink, self.scheduler, batch_size=3, window=0.5)
+
+    def tearDown(self):
+        if isinstance(self.dispatcher.pool, WorkerPool):
+            self.dispatcher.pool.stop(1)
+
+    def test_batch_by_count(self):
+        for i in range(7):
+            self.dispatcher.add(i)
+        self.dispatcher.pool.join()
+        self.assertEqual([mock.call([0, 1, 2]), mock.call([3, 4, 5])], self.sink.call_args_list)
+        self.assertEqual([6], self.dispatcher.batch)
+
+    def test_batch_by_window(self):
+        self.dispatcher.add(0)
+        self.dispatcher.add(1)
+        self.scheduler.assert_called_once_with(0.5, self.dispatcher.flush)
+        self.assertEqual(0, self.sink.call_count)
+        self.dispatcher.flush()
+        self.dispatcher.pool.join()
+        self.sink.assert_called_once_with([0, 1])
+        self.dispatcher.add(2)
+        self.assertEqual(2, self.scheduler.call_count)
+
+    def test_delivery_behind_buffered(self):
+        pool = self.dispatcher.pool
+        self.dispatcher.pool = mock.Mock()
+        self.dispatcher.pool.submit.side_effect = QueueFullError
+        for i in range(6):
+            self.dispatcher.add(i)
+        self.assertEqual(0, self.sink.call_count)
+        self.assertEqual([[0, 1, 2], [3, 4, 5]], [events for events, _ in self.dispatcher.buffer])
+        self.scheduler.assert_called_with(0.5, self.dispatcher._scheduled_drain)
+        self.dispatcher.pool = pool
+        self.dispatcher._scheduled_drain()
+        self.dispatcher.pool.join()
+        self.assertEqual([mock.call([0, 1, 2]), mock.call([3, 4, 5])], self.sink.call_args_list)
+        self.assertEqual(0, len(self.dispatcher.buffer))
+
+    def test_acked_once_delivered(self):
+        acks = [mock.Mock() for _ in range(3)]
+        for i, ack in enumerate(acks):
+            self.dispatcher.add(i, ack)
+        self.dispatcher.pool.join()
+        self.sink.assert_called_once_with([0, 1, 2])
+        delay, ack_delivered = self.scheduler.call_args[0]
+        self.assertEqual(0, delay)
+        self.assertEqual(0, acks[0].call_count)
+        ack_delivered()
+        for ack in acks:
+            ack.assert_called_once_with()
+
+    def test_not_acked_when_sink_fails(self):
+        self.sink.side_effect = Exception("broker down")
+        for i in range(3):
+            self.dispatcher.add(i, mock.Mock())
+        self.dispatcher.pool.join()
+        self.assertEqual(1, self.scheduler.call_count)
+
+    def test_task_sink(self):
+        app = mock.Mock()
+        TaskSink(app, "proj.tasks.inbound", "inbound")([1, 2])
+        app.send_task.assert_called_once_with("proj.tasks.inbound", args=([1, 2],), queue="inbound")
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unittest.main())
@@ -6,14 +6,19 @@ from yowsup_celery.layer import CeleryLayer
 from yowsup.layers.protocol_messages.protocolentities import TextMessageProtocolEntity
 from yowsup.layers.protocol_receipts.protocolentities import IncomingReceiptProtocolEntity
 import time
-from yowsup_celery.exceptions import ConnectionError
-from tests.utils import success_protocol_entity, failure_protocol_entity, \
+import tempfile
+from yowsup_celery.exceptions import ConnectionError, QueueFullError, LoopTimeoutError
+from yowsup_celery.ratelimit import RateLimiter
+from yowsup_celery.metrics import MetricsRegistry
+from yowsup_celery.tracing import Tracer
+from tests.utils import success_protocol_entity, failure_protocol_entity, ack_incoming_protocol_entity, \
     image_downloadable_media_message_protocol_entity, audio_downloadable_media_message_protocol_entity
 from yowsup.layers import YowLayerEvent
 from yowsup.layers.network import YowNetworkLayer
 import unittest
 from yowsup.layers.protocol_media.protocolentities.message_media_downloadable import \
     DownloadableMediaMessageProtocolEntity
+from yowsup.layers.protocol_media.protocolentities import RequestUploadIqProtocolEntity
 try:
     from unittest import mock
 except ImportError:
@@ -51,6 +56,20 @@ class CeleryLayerTest(YowProtocolLayerTest, CeleryLayer):
         self.receive(receipt)
         return receipt    
     
+    def test_inbound_dispatch(self):
+        self.inbound = mock.Mock()
+        msg = self.receive_message()
+        receipt = self.receive_receipt()
+        events = [c[0][0] for c in self.inbound.add.call_args_list]
+        self.assertEqual([("message", msg.getId()), ("receipt", receipt.getId())],
+                         [(e["event"], e["id"]) for e in events])
+        self.assertEqual("Received message", events[0]["body"])
+        # acked once inbound sink accepted them
+        self.assertEqual([], self.lowerSink)
+        for call in self.inbound.add.call_args_list:
+            call[0][1]()
+        self.assertEqual(2, len(self.lowerSink))
+
     def test_already_connected(self):
         self.connected = True
         self.assertFalse(self.connect())
@@ -70,6 +89,48 @@ class CeleryLayerTest(YowProtocolLayerTest, CeleryLayer):
         ack = self.lowerSink.pop()
         self.assertEqual(ack.getId(), msg.getId())
         
+    def test_ack_tracked(self):
+        msg = self.send_message(self.number, self.content)
+        self.assertEqual(1, self.ack_tracker.in_flight())
+        self.receive(ack_incoming_protocol_entity(msg))
+        delivery = self.ack_tracker.get(msg.getId())
+        self.assertIsNotNone(delivery["ack_latency"])
+        self.assertEqual(0, self.ack_tracker.in_flight())
+
+    def test_metrics_sent_and_acked(self):
+        self.metrics = MetricsRegistry()
+        self.metric_labels = {"account": "341111111"}
+        msg = self.send_message(self.number, self.content)
+        self.receive(ack_incoming_protocol_entity(msg))
+        self.assertEqual(1, self.metrics.counter("messages_sent_total").get(account="341111111", type="text"))
+        self.assertEqual(1, self.metrics.counter("messages_acked_total").get(account="341111111", type="text"))
+
+    def test_metrics_failed(self):
+        self.metrics = MetricsRegistry()
+        self.metric_labels = {"account": "341111111"}
+        failed = self.metrics.counter("messages_failed_total")
+        self.loop_runner = mock.Mock(side_effect=LoopTimeoutError)
+        self.assertRaises(LoopTimeoutError, self.send_message, self.number, self.content)
+        self.assertRaises(LoopTimeoutError, self.send_messages, [(self.number, "a"), (self.number, "b")])
+        self.assertEqual(3, failed.get(account="341111111", type="text"))
+        self.loop_runner = None
+        self.connected = False
+        self.assertRaises(ConnectionError, self.send_location, self.number, "name", "url", "1", "2")
+        self.assertRaises(ConnectionError, self.send_image, self.number, "path/image.jpg")
+        self.assertEqual(1, failed.get(account="341111111", type="location"))
+        self.assertEqual(1, failed.get(account="341111111", type="media"))
+
+    def test_callback_traced(self):
+        self.tracer = Tracer(MetricsRegistry())
+        msg = self.send_message(self.number, self.content)
+        self.receive(ack_incoming_protocol_entity(msg))
+        self.assertEqual(1, self.tracer.metrics.histogram("stage_seconds").get(stage="callback", name="ack")[0])
+
+    def test_receipt_tracked(self):
+        msg = self.send_message(self.number, self.content)
+        self.receive(IncomingReceiptProtocolEntity(msg.getId(), msg.getTo(), int(time.time())))
+        self.assertIsNotNone(self.ack_tracker.get(msg.getId())["receipt_latency"])
+
     def test_ack_for_received_receipt(self):
         receipt = self.receive_receipt()
         ack = self.lowerSink.pop()
@@ -86,6 +147,68 @@ class CeleryLayerTest(YowProtocolLayerTest, CeleryLayer):
         self.assertEqual(self.number + '@s.whatsapp.net', out_msg.getTo())
         self.assertEqual(self.content, out_msg.getBody().decode('utf-8'))
         
+    def test_send_messages(self):
+        messages = [(self.number, "content 1"), ("341234568", "content 2")]
+        results = self.send_messages(messages)
+        self.assertEqual(2, len(self.lowerSink))
+        for result, (number, content), out_msg in zip(results, messages, self.lowerSink):
+            self.assertEqual("sent", result["status"])
+            self.assertEqual(number, result["number"])
+            self.assertEqual(out_msg.getId(), result["id"])
+            self.assertEqual(content, out_msg.getBody().decode('utf-8'))
+
+    def test_send_messages_buffered(self):
+        self.connected = False
+        self.reconnecting = True
+        results = self.send_messages([(self.number, self.content)])
+        self.assertEqual([{"number": self.number, "id": None, "status": "buffered"}], results)
+
+    def test_send_messages_connection_required(self):
+        self.connected = False
+        self.assertRaises(ConnectionError, self.send_messages, [(self.number, self.content)])
+
+    def test_send_message_rate_limited(self):
+        self.rate_limiter = RateLimiter(rate=1)
+        self.getStack = mock.MagicMock()
+        first = self.send_message(self.number, "content 1")
+        second = self.send_message(self.number, "content 2")
+        self.assertEqual([first], self.lowerSink)
+        self.assertEqual([second], list(self.throttled))
+        delay, callback = self.getStack.return_value.call_later.call_args[0]
+        self.assertGreater(delay, 0)
+        self.assertEqual(self.flush_throttled, callback)
+        self.rate_limiter.bucket.tokens = 1
+        self.flush_throttled()
+        self.assertEqual([first, second], self.lowerSink)
+        self.assertEqual(0, len(self.throttled))
+
+    def test_flush_throttled_keeps_recipient_order(self):
+        self.rate_limiter = RateLimiter(recipient_rate=1)
+        self.getStack = mock.MagicMock()
+        first = self.send_message(self.number, "content 1")
+        second = self.send_message(self.number, "content 2")
+        third = self.send_message("341234568", "content 3")
+        fourth = self.send_message(self.number, "content 4")
+        self.assertEqual([first], self.lowerSink)
+        self.flush_throttled()
+        self.assertEqual([first, third], self.lowerSink)
+        self.assertEqual([second, fourth], list(self.throttled))
+        self.assertEqual(2, self.getStack.return_value.call_later.call_count)
+
+    def test_throttled_held_while_disconnected(self):
+        self.rate_limiter = RateLimiter(rate=1)
+        self.getStack = mock.MagicMock()
+        first = self.send_message(self.number, "content 1")
+        second = self.send_message(self.number, "content 2")
+        self.onEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_DISCONNECTED))
+        self.assertEqual(0, len(self.throttled))
+        self.rate_limiter.bucket.tokens = 1
+        self.flush_throttled()
+        self.assertEqual([first], self.lowerSink)
+        self.on_success(success_protocol_entity())
+        self.assertEqual([first, second], self.lowerSink)
+        self.assertEqual(0, len(self.outgoing_buffer))
+
     def test_disconnect(self):
         self.connected = True
         self.disconnect()
@@ -104,6 +227,52 @@ class CeleryLayerTest(YowProtocolLayerTest, CeleryLayer):
         self.onEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_DISCONNECTED))
         self.assertFalse(self.connected)
 
+    def test_on_disconnected_schedules_reconnect(self):
+        self.connected = True
+        self.reconnect = True
+        self.getStack = mock.MagicMock()
+        self.onEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_DISCONNECTED))
+        self.assertFalse(self.connected)
+        self.assertTrue(self.reconnecting)
+        delay, callback = self.getStack.return_value.call_later.call_args[0]
+        self.assertLessEqual(delay, self.backoff.base)
+        self.assertEqual(self.do_reconnect, callback)
+
+    def test_on_disconnected_requested_no_reconnect(self):
+        self.connected = True
+        self.reconnect = True
+        self.getStack = mock.MagicMock()
+        self.disconnect()
+        self.onEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_DISCONNECTED))
+        self.assertFalse(self.reconnecting)
+        self.assertEqual(0, self.getStack.return_value.call_later.call_count)
+
+    def test_do_reconnect(self):
+        self.connected = False
+        self.reconnecting = True
+        self.getLayerInterface = mock.MagicMock()
+        self.do_reconnect()
+        self.getLayerInterface.return_value.connect.assert_called_once_with()
+        self.assertEqual(1, self.reconnect_count)
+
+    def test_send_buffered_while_reconnecting(self):
+        self.connected = False
+        self.reconnecting = True
+        self.assertIsNone(self.send_message(self.number, self.content))
+        self.assertEqual([], self.lowerSink)
+        self.on_success(success_protocol_entity())
+        self.assertFalse(self.reconnecting)
+        out_msg = self.lowerSink.pop()
+        self.assertEqual(self.content, out_msg.getBody().decode('utf-8'))
+        self.assertEqual(0, len(self.outgoing_buffer))
+
+    def test_send_buffer_full(self):
+        self.connected = False
+        self.reconnecting = True
+        self.outgoing_buffer_size = 1
+        self.send_message(self.number, self.content)
+        self.assertRaises(ConnectionError, self.send_message, self.number, self.content)
+
     def _test_send_media_to_upload(self, fn, *args, **kwargs):
         with mock.patch('yowsup.layers.protocol_media.protocolentities.iq_requestupload.RequestUploadIqProtocolEntity.__init__',  # noqa
                         init_request_upload):  
@@ -119,6 +288,108 @@ class CeleryLayerTest(YowProtocolLayerTest, CeleryLayer):
     def test_send_audio_to_upload(self):
         self._test_send_media_to_upload(self.send_audio, "341234567", "path/audio.mp3")
 
+    def test_send_media_upload_pool_full(self):
+        self.upload_pool.slots.maxsize = 1
+        self.upload_slot_timeout = 0.01
+        self._test_send_media_to_upload(self.send_image, "341234567", "path/image.jpg")
+        self.assertEqual(1, self.upload_pool.pending())
+        with mock.patch('yowsup.layers.protocol_media.protocolentities.iq_requestupload.RequestUploadIqProtocolEntity.__init__',  # noqa
+                        init_request_upload):
+            self.assertRaises(QueueFullError, self.send_image, "341234567", "path/image.jpg")
+
+    def test_send_media_upload_pool_full_in_loop(self):
+        self.upload_pool.slots.maxsize = 1
+        self.loop_checker = lambda: True
+        self._test_send_media_to_upload(self.send_image, "341234567", "path/image.jpg")
+        start = time.time()
+        with mock.patch('yowsup.layers.protocol_media.protocolentities.iq_requestupload.RequestUploadIqProtocolEntity.__init__',  # noqa
+                        init_request_upload):
+            self.assertRaises(QueueFullError, self.send_image, "341234567", "path/image.jpg")
+        self.assertLess(time.time() - start, 1)
+
+    def test_request_upload_error_releases_slot(self):
+        self._test_send_media_to_upload(self.send_image, "341234567", "path/image.jpg")
+        self.on_request_upload_error("341234567@s.whatsapp.net", "path/image.jpg", None, None)
+        self.assertEqual(0, self.upload_pool.pending())
+
+    def test_disconnected_releases_upload_requests(self):
+        self._test_send_media_to_upload(self.send_image, "341234567", "path/image.jpg")
+        self.assertEqual(1, self.upload_pool.pending())
+        self.onEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_DISCONNECTED))
+        self.assertEqual(0, self.upload_pool.pending())
+        self.assertEqual({}, self.iqRegistry)
+        self.assertEqual(set(), self.upload_requests)
+
+    def test_upload_in_pool(self):
+        result = mock.Mock(isDuplicate=mock.Mock(return_value=False), getUrl=mock.Mock(return_value="url"),
+                           getResumeOffset=mock.Mock(return_value=0), getIp=mock.Mock(return_value="ip"))
+        request = mock.Mock(mediaType=RequestUploadIqProtocolEntity.MEDIA_TYPE_IMAGE, b64Hash="hash")
+        self.upload_pool.acquire()
+        with mock.patch.object(self.uploads, 'upload') as mock_upload, \
+                mock.patch.object(self, 'do_send_image') as mock_do_send, \
+                mock.patch.object(self, 'getOwnJid', return_value="own@s.whatsapp.net"):
+            mock_upload.side_effect = lambda jid, own, source, url, offset, success_fn, error_fn, progress_fn, \
+                resume_offset_fn, content_hash: success_fn(source, jid, url)
+            self.on_request_upload_result("jid", "path", result, request)
+            self.upload_pool.join()
+        self.assertEqual("path", mock_upload.call_args[0][2].path)
+        self.assertEqual(0, mock_upload.call_args[0][4])
+        self.assertEqual("hash", mock_upload.call_args[0][9])
+        mock_do_send.assert_called_once_with("path", "url", "jid", "ip", None)
+        self.assertEqual(0, self.upload_pool.pending())
+
+    def test_request_resume_offset(self):
+        request = mock.Mock(mediaType=RequestUploadIqProtocolEntity.MEDIA_TYPE_IMAGE, b64Hash="hash", size=1234)
+        result = mock.Mock(isDuplicate=mock.Mock(return_value=False), getResumeOffset=mock.Mock(return_value="512"))
+        with mock.patch.object(self, '_sendIq') as mock_send_iq:
+            mock_send_iq.side_effect = lambda entity, success_fn, error_fn: success_fn(result, entity)
+            self.assertEqual(512, self.request_resume_offset(request))
+            mock_send_iq.side_effect = lambda entity, success_fn, error_fn: error_fn(None, entity)
+            self.assertIsNone(self.request_resume_offset(request))
+            mock_send_iq.side_effect = None
+            self.assertIsNone(self.request_resume_offset(request, timeout=0.01))
+
+    def test_uploaded_media_cached(self):
+        result = mock.Mock(isDuplicate=mock.Mock(return_value=True), getUrl=mock.Mock(return_value="url"),
+                           getIp=mock.Mock(return_value="ip"))
+        request = mock.Mock(mediaType=RequestUploadIqProtocolEntity.MEDIA_TYPE_IMAGE, b64Hash="hash", size=1234)
+        self.upload_pool.acquire()
+        with mock.patch.object(self, 'do_send_image') as mock_do_send:
+            self.on_request_upload_result("jid", "path/image.jpg", result, request)
+        mock_do_send.assert_called_once_with("path/image.jpg", "url", "jid", "ip", None)
+        with mock.patch('yowsup.layers.protocol_media.protocolentities.iq_requestupload.RequestUploadIqProtocolEntity.__init__',  # noqa
+                        init_request_upload), mock.patch.object(self, 'do_send_image') as mock_do_send:
+            self.send_image("341234567", "other/image.jpg", "caption")
+        mock_do_send.assert_called_once_with("other/image.jpg", "url", "341234567@s.whatsapp.net", "ip", "caption")
+        self.assertEqual([], self.lowerSink)
+        self.assertEqual(0, self.upload_pool.pending())
+
+    def test_media_cache_disabled(self):
+        self.media_cache = None
+        self._test_send_media_to_upload(self.send_image, "341234567", "path/image.jpg")
+
+    def test_send_image_data(self):
+        self.send_image_data("341234567", b"image", "image.jpg", "caption")
+        entity_iq = self.lowerSink.pop()
+        self.assertEqual(RequestUploadIqProtocolEntity.MEDIA_TYPE_IMAGE, entity_iq.mediaType)
+        self.assertEqual(5, entity_iq.size)
+        result = mock.Mock(isDuplicate=mock.Mock(return_value=False), getUrl=mock.Mock(return_value="url"),
+                           getIp=mock.Mock(return_value="ip"))
+        _, iq_on_success, _ = self.iqRegistry[entity_iq.getId()]
+        with mock.patch.object(self.uploads, 'upload') as mock_upload, \
+                mock.patch('yowsup_celery.layer.media_message_from_source') as mock_message, \
+                mock.patch.object(self, 'getOwnJid', return_value="own@s.whatsapp.net"), \
+                mock.patch.object(self, 'paced_to_lower') as mock_paced:
+            mock_upload.side_effect = lambda jid, own, source, url, offset, success_fn, error_fn, progress_fn, \
+                resume_offset_fn, content_hash: success_fn(source, jid, "media_url")
+            iq_on_success(result, entity_iq)
+            self.upload_pool.join()
+        source = mock_upload.call_args[0][2]
+        self.assertEqual(b"image", source.data)
+        mock_message.assert_called_once_with(RequestUploadIqProtocolEntity.MEDIA_TYPE_IMAGE, source, "media_url",
+                                             "ip", "341234567@s.whatsapp.net", "caption")
+        mock_paced.assert_called_once_with(mock_message.return_value)
+
     def test_send_image_to_do(self):
         path = "file_path/image.jpg"
         url = "image_url"
@@ -147,6 +418,25 @@ class CeleryLayerTest(YowProtocolLayerTest, CeleryLayer):
             self.assertEqual(entity.url, url)
             self.assertEqual(entity.getMediaType(), DownloadableMediaMessageProtocolEntity.MEDIA_TYPE_AUDIO)
             
+    def test_send_image_metadata_cached(self):
+        with tempfile.NamedTemporaryFile(suffix=".jpg") as f:
+            f.write(b"image")
+            f.flush()
+            with mock.patch('yowsup.layers.protocol_media.protocolentities.message_media_downloadable_image.ImageDownloadableMediaMessageProtocolEntity.fromFilePath') as mock_image:  # noqa
+                mock_image.return_value = image_downloadable_media_message_protocol_entity("url", "to1", "ip", "c1")
+                self.do_send_image(f.name, "url", "to1", "ip", "c1")
+                self.do_send_image(f.name, "url2", "to2", "ip2", "c2")
+                self.assertEqual(1, mock_image.call_count)
+                second = self.lowerSink.pop()
+                first = self.lowerSink.pop()
+                self.assertNotEqual(first.getId(), second.getId())
+                self.assertEqual(("to1", "c1", "url"), (first.to, first.caption, first.url))
+                self.assertEqual(("to2", "c2", "url2", "ip2"), (second.to, second.caption, second.url, second.ip))
+                f.write(b"modified")
+                f.flush()
+                self.do_send_image(f.name, "url", "to1", "ip", "c1")
+                self.assertEqual(2, mock_image.call_count)
+
     def test_send_location(self):
         params = {
             "number": "341234567",
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import socket
+import asyncore
+from yowsup_celery.loops import get_backend, AsyncioBackend, AsyncoreBackend, GeventBackend
+from yowsup_celery.exceptions import ConfigurationError
+
+
+class Reader(asyncore.dispatcher):
+
+    def __init__(self, sock, socket_map, error=None):
+        asyncore.dispatcher.__init__(self, sock, map=socket_map)
+        self.received = []
+        self.error = error
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.received.append(self.recv(1024))
+        if self.error:
+            raise self.error
+
+    def handle_error(self):
+        raise
+
+
+class TestLoops(unittest.TestCase):
+
+    def setUp(self):
+        self.socket_map = {}
+        self.reader_sock, self.writer = socket.socketpair()
+        self.backend = AsyncioBackend(self.socket_map)
+
+    def tearDown(self):
+        self.backend.close()
+        for obj in list(self.socket_map.values()):
+            obj.close()
+        self.writer.close()
+
+    def test_get_backend(self):
+        self.assertIsInstance(get_backend(), AsyncoreBackend)
+        self.assertIsInstance(get_backend("asyncio"), AsyncioBackend)
+        self.assertIsInstance(get_backend("gevent"), GeventBackend)
+        self.assertRaises(ConfigurationError, get_backend, "unknown")
+
+    def test_poll_read(self):
+        reader = Reader(self.reader_sock, self.socket_map)
+        self.backend.poll(0.01)
+        self.assertEqual([], reader.received)
+        self.writer.send(b"data")
+        self.backend.poll(1)
+        self.assertEqual([b"data"], reader.received)
+        self.assertIn(self.reader_sock.fileno(), self.backend.readers)
+
+    def test_closed_dispatcher_unregistered(self):
+        reader = Reader(self.reader_sock, self.socket_map)
+        self.backend.poll(0.01)
+        fd = self.reader_sock.fileno()
+        reader.close()
+        self.backend.poll(0.01)
+        self.assertNotIn(fd, self.backend.readers)
+
+    def test_poll_raises_handler_error(self):
+        Reader(self.reader_sock, self.socket_map, error=ValueError("error"))
+        self.writer.send(b"data")
+        self.assertRaises(ValueError, self.backend.poll, 1)
+
+
+class TestGeventLoop(TestLoops):
+
+    def setUp(self):
+        self.socket_map = {}
+        self.reader_sock, self.writer = socket.socketpair()
+        self.backend = GeventBackend(self.socket_map)
+
+    def test_poll_read(self):
+        reader = Reader(self.reader_sock, self.socket_map)
+        self.backend.poll(0.01)
+        self.assertEqual([], reader.received)
+        self.writer.send(b"data")
+        self.backend.poll(1)
+        self.assertEqual([b"data"], reader.received)
+
+    def test_closed_dispatcher_unregistered(self):
+        reader = Reader(self.reader_sock, self.socket_map)
+        reader.close()
+        self.backend.poll(0.01)
+        self.assertEqual({}, self.socket_map)
+
+    def test_spawn(self):
+        greenlet = GeventBackend.spawn(lambda x: x * 2, 2)
+        self.assertEqual(4, greenlet.get(timeout=1))
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unittest.main())
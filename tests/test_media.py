@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import base64
+import hashlib
+import tempfile
+from yowsup_celery.media import BytesSource, FileSource, StreamUploader, ResumableUploads
+try:
+    from unittest import mock
+except ImportError:
+    import mock  # noqa
+
+
+class TestMediaSource(unittest.TestCase):
+
+    def test_bytes_chunks(self):
+        source = BytesSource(b"0123456789", "audio.mp3")
+        self.assertEqual([b"0123", b"4567", b"89"], list(source.chunks(chunk_size=4)))
+        self.assertEqual([b"6789"], list(source.chunks(6, 4)))
+        self.assertEqual(10, source.size)
+        self.assertEqual("audio/mpeg", source.mimetype)
+
+    def test_hash(self):
+        source = BytesSource(b"0123456789", "audio.mp3")
+        source.chunk_size = 3
+        self.assertEqual(base64.b64encode(hashlib.sha256(b"0123456789").digest()).decode(), source.hash())
+
+    def test_file_same_as_bytes(self):
+        with tempfile.NamedTemporaryFile(suffix=".jpg") as f:
+            f.write(b"image content")
+            f.flush()
+            source = FileSource(f.name)
+            self.assertEqual(BytesSource(b"image content", "image.jpg").hash(), source.hash())
+            self.assertEqual(13, source.size)
+
+
+class TestStreamUploader(unittest.TestCase):
+
+    def setUp(self):
+        self.source = BytesSource(b"0123456789", "audio.mp3")
+        self.uploader = StreamUploader("jid@s.whatsapp.net", "own@whatsapp.net", self.source,
+                                       "https://mms.whatsapp.net/u/path", chunk_size=4)
+        patcher = mock.patch.object(self.uploader, 'connect')
+        self.mock_connect = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sock = self.mock_connect.return_value
+
+    def test_upload_in_chunks(self):
+        self.sock.recv.side_effect = [b'HTTP/1.1 200 OK\r\n\r\n{"url": "https://mms/media.mp3"}', b""]
+        self.assertEqual("https://mms/media.mp3", self.uploader.upload())
+        self.mock_connect.assert_called_once_with("mms.whatsapp.net")
+        writes = [c[0][0] for c in self.sock.sendall.call_args_list]
+        self.assertEqual([b"0123", b"4567", b"89"], writes[2:5])
+        self.assertIn(("Content-Length: %d" % (len(writes[1]) + len(writes[5]) + 10)).encode(), writes[0])
+        self.sock.close.assert_called_once_with()
+
+    def test_upload_error(self):
+        self.sock.recv.return_value = b""
+        self.assertRaises(Exception, self.uploader.upload)
+        self.sock.close.assert_called_once_with()
+
+    def test_resume_offset(self):
+        self.uploader.resume_offset = self.uploader.sent = 6
+        self.sock.recv.side_effect = [b'HTTP/1.1 200 OK\r\n\r\n{"url": "https://mms/media.mp3"}', b""]
+        self.assertEqual("https://mms/media.mp3", self.uploader.upload())
+        writes = [c[0][0] for c in self.sock.sendall.call_args_list]
+        self.assertIn(b"Content-Range: bytes 6-9/10", writes[0])
+        self.assertEqual([b"6789"], writes[2:3])
+        self.assertEqual(10, self.uploader.sent)
+
+    @mock.patch('yowsup_celery.media.ssl.create_default_context')
+    @mock.patch('yowsup_celery.media.socket.create_connection')
+    def test_connect_verifies_host(self, mock_create_connection, mock_context):
+        uploader = StreamUploader("jid@s.whatsapp.net", "own@whatsapp.net", self.source,
+                                  "https://mms.whatsapp.net/u/path")
+        sock = uploader.connect("mms.whatsapp.net")
+        mock_context.return_value.wrap_socket.assert_called_once_with(mock_create_connection.return_value,
+                                                                      server_hostname="mms.whatsapp.net")
+        self.assertIs(mock_context.return_value.wrap_socket.return_value, sock)
+
+
+class TestResumableUploads(unittest.TestCase):
+
+    def setUp(self):
+        self.source = BytesSource(b"0123456789", "audio.mp3")
+        self.uploads = ResumableUploads(attempts=3, chunk_size=4, retry_delay=0)
+        self.success_fn = mock.Mock()
+        self.error_fn = mock.Mock()
+        self.offsets = []
+        patcher = mock.patch('yowsup_celery.media.StreamUploader.upload', autospec=True)
+        self.mock_upload = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fail_at(self, sent):
+        def upload(uploader):
+            self.offsets.append(uploader.resume_offset)
+            uploader.sent = sent
+            raise IOError("connection reset")
+        return upload
+
+    def _upload(self, resume_offset=0, resume_offset_fn=None):
+        return self.uploads.upload("jid", "own", self.source, "https://mms/u", resume_offset, self.success_fn,
+                                   self.error_fn, resume_offset_fn=resume_offset_fn)
+
+    def test_retry_from_server_offset(self):
+        def succeed(uploader):
+            self.offsets.append(uploader.resume_offset)
+            return "https://mms/media.mp3"
+        steps = [self.fail_at(4), self.fail_at(8), succeed]
+        self.mock_upload.side_effect = lambda uploader: steps.pop(0)(uploader)
+        server_offsets = [4, 6]
+        self.assertEqual("https://mms/media.mp3", self._upload(resume_offset_fn=lambda: server_offsets.pop(0)))
+        self.assertEqual([0, 4, 6], self.offsets)
+        self.success_fn.assert_called_once_with(self.source, "jid", "https://mms/media.mp3")
+        self.assertEqual(0, len(self.uploads.progress))
+
+    def test_retry_without_server_offset_from_first_byte(self):
+        self.mock_upload.side_effect = self.fail_at(8)
+        self.assertIsNone(self._upload())
+        self.assertEqual([0, 0, 0], self.offsets)
+        self.mock_upload.side_effect = self.fail_at(8)
+        self.offsets = []
+        self.assertIsNone(self._upload(resume_offset_fn=lambda: None))
+        self.assertEqual([0, 0, 0], self.offsets)
+
+    def test_server_offset_bounded_by_sent(self):
+        self.mock_upload.side_effect = self.fail_at(4)
+        self.assertIsNone(self._upload(resume_offset_fn=lambda: 8))
+        self.assertEqual([0, 0, 0], self.offsets)
+
+    def test_attempts_exhausted_keeps_progress(self):
+        self.mock_upload.side_effect = self.fail_at(4)
+        self.assertIsNone(self._upload(resume_offset_fn=lambda: 4))
+        self.assertEqual(3, len(self.offsets))
+        self.error_fn.assert_called_once_with(self.source, "jid", "https://mms/u")
+        self.assertEqual(4, self.uploads.offset(self.source, "https://mms/u"))
+        self.assertEqual(6, self.uploads.offset(self.source, "https://mms/u", 6))
+
+    def test_content_hash_not_computed_again(self):
+        self.mock_upload.side_effect = self.fail_at(4)
+        with mock.patch.object(self.source, 'hash') as mock_hash:
+            self.assertIsNone(self.uploads.upload("jid", "own", self.source, "https://mms/u",
+                                                  resume_offset_fn=lambda: 4, content_hash="hash"))
+            self.assertEqual(0, mock_hash.call_count)
+        self.assertEqual(4, self.uploads.offset(self.source, "https://mms/u", content_hash="hash"))
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unittest.main())
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from yowsup_celery.metrics import MetricsRegistry, MetricsExporter
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        counter = self.registry.counter("messages_sent_total")
+        counter.inc(account="341111111", type="text")
+        counter.inc(2, account="341111111", type="text")
+        self.assertIs(counter, self.registry.counter("messages_sent_total"))
+        self.assertEqual(3, counter.get(account="341111111", type="text"))
+        self.assertEqual(0, counter.get(account="341111111", type="media"))
+        self.assertIn('yowsup_messages_sent_total{account="341111111",type="text"} 3.0', self.registry.render())
+        self.assertIn("# TYPE yowsup_messages_sent_total counter", self.registry.render())
+
+    def test_gauge_function(self):
+        depth = [5]
+        self.registry.gauge("detached_queue_depth").set_function(lambda: depth[0], account="341111111")
+        self.assertIn('yowsup_detached_queue_depth{account="341111111"} 5.0', self.registry.render())
+        depth[0] = 0
+        self.assertEqual(0, self.registry.gauge("detached_queue_depth").get(account="341111111"))
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("upload_seconds", buckets=(1, 5))
+        histogram.observe(0.5)
+        histogram.observe(3)
+        histogram.observe(10)
+        self.assertEqual((3, 13.5), histogram.get())
+        rendered = self.registry.render()
+        self.assertIn('yowsup_upload_seconds_bucket{le="1.0"} 1.0', rendered)
+        self.assertIn('yowsup_upload_seconds_bucket{le="5.0"} 2.0', rendered)
+        self.assertIn('yowsup_upload_seconds_bucket{le="+Inf"} 3.0', rendered)
+        self.assertIn('yowsup_upload_seconds_count 3.0', rendered)
+
+    def test_label_escaped(self):
+        self.registry.counter("messages_failed_total").inc(type='a"b')
+        self.assertIn('type="a\\"b"', self.registry.render())
+
+    def test_exporter(self):
+        self.registry.counter("reconnects_total").inc(account="341111111")
+        exporter = MetricsExporter(self.registry, 0).start()
+        try:
+            response = urlopen("http://127.0.0.1:%d/metrics" % exporter.server_address[1], timeout=5)
+            body = response.read().decode("utf-8")
+        finally:
+            exporter.stop()
+        self.assertIn('yowsup_reconnects_total{account="341111111"} 1.0', body)
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unittest.main())
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from yowsup_celery.ratelimit import TokenBucket, RateLimiter
+try:
+    from unittest import mock
+except ImportError:
+    import mock  # noqa
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('yowsup_celery.ratelimit.time')
+        self.mock_time = patcher.start()
+        self.mock_time.time.return_value = 1000.0
+        self.addCleanup(patcher.stop)
+
+    def test_bucket_burst(self):
+        bucket = TokenBucket(2, 3)
+        for _ in range(3):
+            self.assertEqual(0, bucket.delay())
+            bucket.consume()
+        self.assertAlmostEqual(0.5, bucket.delay())
+
+    def test_bucket_refill(self):
+        bucket = TokenBucket(2, 1)
+        bucket.consume()
+        self.mock_time.time.return_value = 1000.25
+        self.assertAlmostEqual(0.25, bucket.delay())
+        self.mock_time.time.return_value = 1010.0
+        self.assertEqual(0, bucket.delay())
+        self.assertEqual(1, bucket.tokens)
+
+    def test_limiter_global(self):
+        limiter = RateLimiter(rate=1)
+        self.assertEqual(0, limiter.acquire("a"))
+        self.assertAlmostEqual(1, limiter.acquire("b"))
+
+    def test_limiter_recipient(self):
+        limiter = RateLimiter(rate=10, recipient_rate=1)
+        self.assertEqual(0, limiter.acquire("a"))
+        self.assertAlmostEqual(1, limiter.acquire("a"))
+        self.assertEqual(0, limiter.acquire("b"))
+        # rejected acquire does not consume global tokens
+        self.assertAlmostEqual(8, limiter.bucket.tokens)
+
+    def test_limiter_max_recipients(self):
+        limiter = RateLimiter(recipient_rate=1, max_recipients=2)
+        for recipient in ("a", "b", "c"):
+            limiter.acquire(recipient)
+        self.assertEqual(["b", "c"], list(limiter.recipient_buckets.keys()))
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unittest.main())
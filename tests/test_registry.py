@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import socket
+import threading
+from yowsup.layers import YowLayerEvent
+from yowsup.layers.network import YowNetworkLayer
+from yowsup_celery.stack import YowsupStack, _poll
+from yowsup_celery.layer import CeleryLayer
+from yowsup_celery.registry import StackRegistry
+from yowsup_celery.exceptions import ConfigurationError
+from tests.test_stack import CoreLayerMock
+try:
+    from unittest import mock
+except ImportError:
+    import mock  # noqa
+
+
+class FailingLayerMock(CoreLayerMock):
+
+    def handle_read(self):
+        raise socket.error("Connection reset by peer")
+
+
+def mock_stack(number, core_layer=CoreLayerMock):
+    stack = YowsupStack((number, "password"))
+    stack._YowStack__stack = (core_layer, CeleryLayer)
+    stack._YowStack__stackInstances = []
+    stack._YowStack__props = {}
+    stack._construct()
+    stack.facade = stack.getLayerInterface(CeleryLayer)
+    return stack
+
+
+class TestStackRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.stack1 = mock_stack("341111111")
+        self.stack2 = mock_stack("342222222")
+        self.registry = StackRegistry([self.stack1, self.stack2])
+
+    def test_get(self):
+        self.assertEqual(self.stack1, self.registry.get())
+        self.assertEqual(self.stack2, self.registry.get("342222222"))
+        self.assertEqual(["341111111", "342222222"], self.registry.accounts())
+        self.assertRaises(ConfigurationError, self.registry.get, "343333333")
+        self.assertRaises(ConfigurationError, self.registry.add, mock_stack("341111111"))
+
+    def test_request_listen_single_flight_across_accounts(self):
+        self.assertTrue(self.stack2.request_listen())
+        self.assertFalse(self.stack1.request_listen())
+        self.stack1.cancel_listen_request()
+        self.assertTrue(self.stack1.request_listen())
+
+    def test_wait_listening_default_failed(self):
+        self.assertFalse(self.registry.wait_listening(0.01))
+        self.stack2.listening = True
+        self.assertTrue(self.registry.listening)
+        self.assertTrue(self.registry.wait_listening(0.01))
+
+    def test_shared_loop(self):
+        executed = []
+        listening = []
+
+        def queue_detached():
+            while not self.stack1.listening:
+                pass
+            listening.append((self.stack1.listening, self.stack2.listening))
+            self.stack1.execDetached(lambda: executed.append(1))
+            self.stack2.execDetached(lambda: executed.append(2))
+        thread = threading.Thread(target=queue_detached)
+        thread.daemon = True
+        thread.start()
+        # looping one account loops all of them
+        self.stack2.asynloop(timeout=0.2)
+        thread.join()
+        self.assertEqual([(True, True)], listening)
+        self.assertEqual([1, 2], sorted(executed))
+        self.assertFalse(self.stack1.listening or self.stack2.listening)
+
+    def test_stop(self):
+        def stop():
+            while not self.stack1.listening:
+                pass
+            self.registry.stop()
+        thread = threading.Thread(target=stop)
+        thread.daemon = True
+        thread.start()
+        self.registry.asynloop(timeout=0.1, persistent=True)
+        thread.join()
+        self.assertFalse(self.stack1.listening or self.stack2.listening)
+
+    def test_network_error_disconnects_owner(self):
+        stack3 = mock_stack("343333333", FailingLayerMock)
+        stacks = [self.stack1, stack3]
+        for stack in stacks:
+            stack.broadcastEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_CONNECT))
+        backend = mock.Mock()
+        backend.poll.side_effect = lambda timeout, count=None: stack3.getLayer(0).handle_read()
+        _poll(stacks, backend, 0)
+        for stack in stacks:
+            stack.exec_detached_queue()
+        self.assertFalse(stack3.facade.connected())
+        self.assertTrue(self.stack1.facade.connected())
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unittest.main())
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from yowsup_celery.routing import AccountRouter
+from yowsup_celery.registry import StackRegistry
+try:
+    from unittest import mock
+except ImportError:
+    import mock  # noqa
+
+
+def mock_stack(account, connected=True, in_flight=0, throttled=0, rate_limit_delay=0, reconnecting=False):
+    stack = mock.Mock(account=account)
+    stack.facade.connected.return_value = connected
+    stack.facade.reconnecting.return_value = reconnecting
+    stack.facade.in_flight.return_value = in_flight
+    stack.facade.throttled.return_value = throttled
+    stack.facade.rate_limit_delay.return_value = rate_limit_delay
+    return stack
+
+
+class TestAccountRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.stack1 = mock_stack("341111111", in_flight=5)
+        self.stack2 = mock_stack("342222222", in_flight=2, throttled=1)
+        self.stack3 = mock_stack("343333333", connected=False)
+        self.router = AccountRouter(StackRegistry([self.stack1, self.stack2, self.stack3]))
+
+    def test_least_loaded_healthy(self):
+        self.assertEqual(self.stack2, self.router.route("34600000001"))
+
+    def test_rate_limited_last(self):
+        self.stack2.facade.rate_limit_delay.return_value = 0.5
+        self.assertEqual(self.stack1, self.router.route("34600000001"))
+
+    def test_sticky_while_healthy(self):
+        self.assertEqual(self.stack2, self.router.route("34600000001"))
+        self.stack2.facade.in_flight.return_value = 10
+        self.assertEqual(self.stack2, self.router.route("34600000001"))
+        self.assertEqual(self.stack1, self.router.route("34600000002"))
+        self.stack2.facade.connected.return_value = False
+        self.assertEqual(self.stack1, self.router.route("34600000001"))
+
+    def test_no_healthy_account(self):
+        for stack in (self.stack1, self.stack2):
+            stack.facade.connected.return_value = False
+        self.assertEqual(self.stack1, self.router.route("34600000001"))
+        self.stack3.facade.reconnecting.return_value = True
+        self.assertEqual(self.stack3, self.router.route("34600000001"))
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unittest.main())
@@ -4,6 +4,7 @@
 import unittest
 import inspect
 import threading
+import time
 from yowsup.layers.interface import YowInterfaceLayer
 from yowsup.layers.network import YowNetworkLayer
 from yowsup.layers import YowLayerEvent, EventCallback
@@ -12,6 +13,8 @@ from tests.utils import success_protocol_entity, failure_protocol_entity, ack_in
 from yowsup.layers.auth.autherror import AuthError
 from yowsup_celery.stack import YowsupStack
 from yowsup_celery.layer import CeleryLayer
+from yowsup_celery.detached import DetachedQueue, LoopCall
+from yowsup_celery.exceptions import QueueFullError, LoopTimeoutError
 
 
 try:
@@ -133,6 +136,7 @@ class StackTest(unittest.TestCase):
         self.stack._YowStack__props = {}
         self.stack._construct()
         self.stack.facade = self.stack.getLayerInterface(CeleryLayer)
+        self.stack.facade.set_loop_runner(self.stack.run_in_loop, self.stack.in_loop_thread)
         self.mock_layer = self.stack._YowStack__stackInstances[0]
         self.celery_layer = self.stack._YowStack__stackInstances[1]
         self.number = "341234567"
@@ -205,3 +209,216 @@ class StackTest(unittest.TestCase):
             self.assertEqual(msg_to_send.getId(), msg_sent.getId())
             self.assertEqual(msg_to_send.getBody(), msg_sent.getBody())
         self._test_asynloop(send_message)
+
+    def test_exec_detached_queue_drains_all(self):
+        executed = []
+        for i in range(5):
+            self.stack.execDetached(lambda i=i: executed.append(i))
+        self.assertEqual(5, self.stack.exec_detached_queue())
+        self.assertEqual([0, 1, 2, 3, 4], executed)
+        self.assertTrue(self.stack.detached_queue.empty())
+
+    def test_exec_detached_queue_batch_size(self):
+        executed = []
+        for i in range(5):
+            self.stack.execDetached(lambda i=i: executed.append(i))
+        self.assertEqual(2, self.stack.exec_detached_queue(batch_size=2))
+        self.assertEqual([0, 1], executed)
+        self.assertEqual(3, self.stack.detached_queue.qsize())
+
+    def test_exec_detached_queue_wakes_on_callback(self):
+        executed = []
+        timer = threading.Timer(0.05, self.stack.execDetached, args=(lambda: executed.append(True),))
+        timer.start()
+        start = time.time()
+        self.assertEqual(1, self.stack.exec_detached_queue(delay=5))
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual([True], executed)
+        timer.join()
+
+    def test_asynloop_drains_detached_queue(self):
+        executed = []
+        for i in range(100):
+            self.stack.execDetached(lambda i=i: executed.append(i))
+        self.stack.asynloop(timeout=0.1, detached_delay=0.2)
+        self.assertEqual(list(range(100)), executed)
+
+    def test_asynloop_wakeup_on_detached(self):
+        latency = []
+
+        def queue_detached():
+            start = time.time()
+            self.stack.execDetached(lambda: latency.append(time.time() - start))
+        self._asynloop(queue_detached, timeout=0.5)
+        self.assertEqual(1, len(latency))
+        self.assertLess(latency[0], 0.2)
+        self.assertIsNone(self.stack.wakeup)
+
+    def test_asynloop_persistent(self):
+        def stop():
+            time.sleep(0.3)
+            self.stack.stop()
+        start = time.time()
+        self.stack.persistent = True
+        self._asynloop(stop, timeout=0.1)
+        self.assertGreater(time.time() - start, 0.3)
+        self.assertFalse(self.mock_layer.connected)
+        self.assertFalse(self.stack.stopping)
+
+    def test_call_later(self):
+        executed = []
+        self.stack.call_later(0.1, lambda: executed.append(time.time()))
+        self.assertIsNotNone(self.stack.exec_timers())
+        self.assertEqual([], executed)
+        start = time.time()
+        self.stack.asynloop(timeout=0.3)
+        self.assertEqual(1, len(executed))
+        self.assertLess(executed[0] - start, 0.2)
+        self.assertEqual([], self.stack.timers)
+
+    def test_asynloop_reconnect(self):
+        self.celery_layer.reconnect = True
+        self.celery_layer.backoff.base = 0.01
+
+        def reconnect():
+            self.stack.facade.connect()
+            # connection lost
+            self.mock_layer.connected = False
+            self.mock_layer.emitEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_DISCONNECTED, detached=True))
+            while not self.celery_layer.reconnecting:
+                time.sleep(0.01)
+            self.stack.facade.send_message(self.number, self.content)
+
+        with mock.patch.object(YowsupStack, 'getLayerInterface', return_value=self.mock_layer):
+            self._asynloop(reconnect, timeout=0.5)
+        self.assertEqual(1, self.celery_layer.reconnect_count)
+        self.assertEqual(self.content, self.mock_layer.lowerSink.pop().getBody().decode('utf-8'))
+
+    def test_run_in_loop(self):
+        threads = []
+
+        def record_thread():
+            threads.append(threading.current_thread())
+            return "result"
+
+        def run_in_loop():
+            self.assertEqual("result", self.stack.run_in_loop(record_thread, "bulk"))
+        self._asynloop(run_in_loop, timeout=0.5)
+        self.assertEqual([threading.current_thread()], threads)
+        self.assertEqual("result", self.stack.run_in_loop(lambda: "result"))
+
+    def test_asynloop_exit_cancels_calls(self):
+        call = LoopCall(lambda: None)
+        executed = []
+
+        def stop():
+            self.stack.execDetached(call, "bulk")
+            self.stack.execDetached(lambda: executed.append(True), "bulk")
+            self.stack.stop()
+        self.stack.execDetached(stop)
+        with mock.patch('yowsup_celery.stack._drain'):
+            self.stack.asynloop(timeout=1, batch_size=1)
+        self.assertRaises(LoopTimeoutError, call.wait, 0)
+        self.assertEqual(1, self.stack.detached_queue.depth("bulk"))
+        self.stack.exec_detached_queue()
+        self.assertEqual([True], executed)
+
+    def test_cleanup_keeps_detached_queue(self):
+        executed = []
+        self.stack.execDetached(lambda: executed.append(True))
+        self.stack.cleanup()
+        self.assertEqual(1, self.stack.detached_queue.qsize())
+        self.stack.asynloop(timeout=0.1)
+        self.assertEqual([True], executed)
+
+    def test_asynloop_drains_before_disconnect(self):
+        connected = []
+
+        def stop():
+            # left in queue by batch size when stop is requested
+            self.stack.stop()
+            self.stack.execDetached(lambda: connected.append(self.mock_layer.connected), "bulk")
+        with mock.patch.object(YowsupStack, 'getLayerInterface', return_value=self.mock_layer):
+            self.stack.execDetached(stop)
+            self.stack.asynloop(auto_connect=True, timeout=0.1, batch_size=1, persistent=True)
+        self.assertEqual([True], connected)
+        self.assertFalse(self.mock_layer.connected)
+        self.assertTrue(self.stack.detached_queue.empty())
+
+    def test_detached_queue_full(self):
+        self.stack.detached_queue = DetachedQueue(1, "reject")
+        self.stack.execDetached(lambda: None, "bulk")
+        self.assertRaises(QueueFullError, self.stack.execDetached, lambda: None, "bulk")
+        self.stack.execDetached(lambda: None, "transactional")
+        self.assertEqual(1, self.stack.detached_queue.depth("bulk"))
+        self.assertEqual(2, self.stack.detached_queue.qsize())
+
+    def test_asynloop_ping_from_loop(self):
+        pings = []
+
+        def to_lower(entity):
+            if entity.getTag() == "iq":
+                pings.append(threading.current_thread())
+        self.mock_layer.toLower = to_lower
+        self.stack.facade.set_ping(0.05)
+
+        def wait_pings():
+            self.stack.facade.connect()
+            time.sleep(0.3)
+            self.stack.stop()
+        self.stack.persistent = True
+        with mock.patch.object(YowsupStack, 'getLayerInterface', return_value=self.mock_layer):
+            self._asynloop(wait_pings, timeout=0.1)
+        self.assertTrue(pings)
+        self.assertEqual(set([threading.current_thread()]), set(pings))
+        # pings are not answered by mock layer
+        self.assertFalse(self.celery_layer.connected)
+
+    def test_request_listen_single_flight(self):
+        self.assertTrue(self.stack.request_listen())
+        self.assertFalse(self.stack.request_listen())
+        self.stack.cancel_listen_request()
+        self.assertTrue(self.stack.request_listen())
+
+    def test_wait_listening(self):
+        self.assertFalse(self.stack.wait_listening(0.01))
+        waited = []
+
+        def wait():
+            waited.append(self.stack.wait_listening(1))
+        self._asynloop(wait)
+        self.assertEqual([True], waited)
+        self.assertFalse(self.stack.listen_requested)
+        self.assertFalse(self.stack.listening_event.is_set())
+
+
+class AsyncioStackTest(StackTest):
+    """
+    Same loop behaviour polling with asyncio backend
+    """
+
+    def setUp(self):
+        super(AsyncioStackTest, self).setUp()
+        self.stack.loop_backend = "asyncio"
+
+    def test_spawn_loop_not_supported(self):
+        self.assertIsNone(self.stack.spawn_loop())
+
+
+class GeventStackTest(StackTest):
+    """
+    Same loop behaviour polling with gevent backend
+    """
+
+    def setUp(self):
+        super(GeventStackTest, self).setUp()
+        self.stack.loop_backend = "gevent"
+
+    def test_spawn_loop(self):
+        start = time.time()
+        greenlet = self.stack.spawn_loop(timeout=0.1)
+        self.assertFalse(self.stack.listening)
+        greenlet.join(1)
+        self.assertTrue(greenlet.successful())
+        self.assertGreater(time.time() - start, 0.1)
+        self.assertFalse(self.stack.listening)
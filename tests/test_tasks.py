@@ -4,6 +4,8 @@
 import unittest
 from yowsup_celery import tasks
 from celery import current_app
+from yowsup_celery.registry import StackRegistry
+from yowsup_celery.exceptions import DeliveryTimeoutError, LoopTimeoutError
 try:
     from unittest import mock
 except ImportError:
@@ -30,19 +32,34 @@ class TestTasks(unittest.TestCase):
             mock_stack.return_value.stack = mock.MagicMock()
             tasks.listen()
             mock_stack.return_value.asynloop.assert_called_once_with()
+            mock_stack.return_value.cancel_listen_request.assert_called_once_with()
                         
     def test_listen_required(self):
         with mock.patch('yowsup_celery.tasks.YowsupTask.stack', new_callable=mock.PropertyMock) as mock_stack, \
                 mock.patch('yowsup_celery.tasks.YowsupTask.facade', new_callable=mock.PropertyMock) as mock_facade, \
                 mock.patch('celery.app.task.Context', new_callable=mock.MagicMock) as mock_request, \
-                mock.patch('yowsup_celery.tasks.connect.apply_async', new_callable=tasks.listen), \
-                mock.patch('yowsup_celery.tasks.connect.retry', new_callable=tasks.connect):
+                mock.patch('yowsup_celery.tasks.connect.retry') as mock_retry:
             mock_request.return_value = mock.MagicMock(delivery_info={'routing_key': 'any_queue'})
             mock_stack.return_value = mock.MagicMock(listening=False)
-            mock_stack.return_value.stack = mock.MagicMock()
+            mock_stack.return_value.request_listen.return_value = True
+            mock_stack.return_value.wait_listening.return_value = True
+            mock_stack.return_value.spawn_loop.return_value = None
             tasks.connect()
             mock_stack.return_value.asynloop.assert_called_once_with()
             mock_facade.return_value.connect.assert_called_once_with()
+            self.assertEqual(0, mock_retry.call_count)
+
+    def test_listen_required_spawned_loop(self):
+        with mock.patch('yowsup_celery.tasks.YowsupTask.stack', new_callable=mock.PropertyMock) as mock_stack, \
+                mock.patch('yowsup_celery.tasks.YowsupTask.facade', new_callable=mock.PropertyMock) as mock_facade, \
+                mock.patch('yowsup_celery.tasks.listen.apply_async') as mock_listen:
+            mock_stack.return_value = mock.MagicMock(listening=False)
+            mock_stack.return_value.request_listen.return_value = True
+            mock_stack.return_value.wait_listening.return_value = True
+            tasks.connect()
+            mock_stack.return_value.spawn_loop.assert_called_once_with()
+            self.assertEqual(0, mock_listen.call_count)
+            mock_facade.return_value.connect.assert_called_once_with()
             
     def test_listen_required_not_needed(self):
         with mock.patch('yowsup_celery.tasks.YowsupTask.stack', new_callable=mock.PropertyMock) as mock_stack, \
@@ -53,6 +70,152 @@ class TestTasks(unittest.TestCase):
             self.assertEqual(0, mock_stack.asynloop.call_count)
             mock_facade.return_value.connect.assert_called_once_with()
             
+    def test_listen_required_wait_listening(self):
+        with mock.patch('yowsup_celery.tasks.YowsupTask.stack', new_callable=mock.PropertyMock) as mock_stack, \
+                mock.patch('yowsup_celery.tasks.YowsupTask.facade', new_callable=mock.PropertyMock) as mock_facade, \
+                mock.patch('yowsup_celery.tasks.listen.apply_async') as mock_listen:
+            mock_stack.return_value = mock.MagicMock(listening=False)
+            mock_stack.return_value.request_listen.return_value = False
+            mock_stack.return_value.wait_listening.return_value = True
+            tasks.connect()
+            self.assertEqual(0, mock_listen.call_count)
+            mock_stack.return_value.wait_listening.assert_called_once_with(tasks.connect.listening_timeout)
+            mock_facade.return_value.connect.assert_called_once_with()
+
+    def test_listen_required_wait_timeout(self):
+        with mock.patch('yowsup_celery.tasks.YowsupTask.stack', new_callable=mock.PropertyMock) as mock_stack, \
+                mock.patch('yowsup_celery.tasks.YowsupTask.facade', new_callable=mock.PropertyMock) as mock_facade, \
+                mock.patch('yowsup_celery.tasks.listen.apply_async'), \
+                mock.patch('yowsup_celery.tasks.connect.retry') as mock_retry:
+            mock_stack.return_value = mock.MagicMock(listening=False)
+            mock_stack.return_value.request_listen.return_value = False
+            mock_stack.return_value.wait_listening.return_value = False
+            tasks.connect()
+            mock_retry.assert_called_once_with()
+            # listen task requested is still queued
+            self.assertEqual(0, mock_stack.return_value.cancel_listen_request.call_count)
+            self.assertEqual(0, mock_facade.return_value.connect.call_count)
+
+    def _send_message(self, result, delivery=None):
+        with mock.patch('yowsup_celery.tasks.YowsupTask.stack', new_callable=mock.PropertyMock) as mock_stack, \
+                mock.patch('yowsup_celery.tasks.YowsupTask.facade', new_callable=mock.PropertyMock) as mock_facade:
+            mock_stack.return_value = mock.MagicMock(listening=True)
+            mock_facade.return_value.send_message.return_value.getId.return_value = "message_id"
+            mock_facade.return_value.wait_delivery.return_value = delivery
+            return tasks.send_message.apply(args=("341234567", "content"), kwargs={"result": result}), mock_facade
+
+    def test_send_message_result_default(self):
+        self.assertTrue(self._send_message(None)[0].get())
+
+    def test_send_message_result_id(self):
+        self.assertEqual("message_id", self._send_message("id")[0].get())
+
+    def test_send_message_result_ack(self):
+        delivery = {"id": "message_id", "ack_latency": 0.1}
+        result, mock_facade = self._send_message("ack", delivery)
+        self.assertEqual(delivery, result.get())
+        mock_facade.return_value.wait_delivery.assert_called_once_with(
+            "message_id", "ack", tasks.send_message.delivery_timeout)
+
+    def test_send_message_result_ack_timeout(self):
+        result, _ = self._send_message("ack")
+        self.assertRaises(DeliveryTimeoutError, result.get)
+
+    def test_send_image_data_base64(self):
+        with mock.patch('yowsup_celery.tasks.YowsupTask.stack', new_callable=mock.PropertyMock) as mock_stack, \
+                mock.patch('yowsup_celery.tasks.YowsupTask.facade', new_callable=mock.PropertyMock) as mock_facade:
+            mock_stack.return_value = mock.MagicMock(listening=True)
+            self.assertTrue(tasks.send_image_data.apply(args=("341234567", u"aW1hZ2U=", "image.jpg")).get())
+            mock_facade.return_value.send_image_data.assert_called_once_with("341234567", b"image", "image.jpg",
+                                                                             None, lane="transactional")
+
+    def test_account_routing(self):
+        stack = mock.MagicMock(listening=True)
+        with mock.patch.object(current_app, 'stacks', create=True) as mock_stacks:
+            mock_stacks.get.return_value = stack
+            tasks.send_message.apply(args=("341234567", "content"), kwargs={"account": "342222222"}).get()
+            mock_stacks.get.assert_called_with("342222222")
+            stack.facade.send_message.assert_called_once_with("341234567", "content", lane="transactional")
+
+    def test_send_messages_bulk_auto_account(self):
+        facades = {"1": mock.MagicMock(), "2": mock.MagicMock()}
+
+        def send_messages(messages, lane):
+            return [{"number": n, "id": c, "status": "sent"} for n, c in messages]
+        for facade in facades.values():
+            facade.send_messages.side_effect = send_messages
+        messages = [("3461", "a"), ("3462", "b"), ("3463", "c")]
+        with mock.patch.object(current_app, 'router', create=True) as mock_router, \
+                mock.patch('yowsup_celery.tasks.YowsupTask.loop', new_callable=mock.PropertyMock) as mock_stack:
+            mock_stack.return_value = mock.MagicMock(listening=True)
+            mock_router.route.side_effect = lambda number: mock.Mock(facade=facades["1" if number != "3462" else "2"])
+            results = tasks.send_messages_bulk.apply(args=(messages,), kwargs={"account": "auto"}).get()
+        self.assertEqual(["a", "b", "c"], [r["id"] for r in results])
+        facades["1"].send_messages.assert_called_once_with([("3461", "a"), ("3463", "c")], lane="bulk")
+        facades["2"].send_messages.assert_called_once_with([("3462", "b")], lane="bulk")
+
+    def test_auto_account_default_failed(self):
+        default = mock.MagicMock(listening=False, account="341111111")
+        other = mock.MagicMock(listening=True, account="342222222")
+        registry = StackRegistry([default, other])
+        with mock.patch.object(current_app, 'stack', default, create=True), \
+                mock.patch.object(current_app, 'stacks', registry, create=True), \
+                mock.patch.object(current_app, 'router', create=True) as mock_router, \
+                mock.patch('yowsup_celery.tasks.send_message.retry') as mock_retry:
+            mock_router.route.return_value = other
+            tasks.send_message.apply(args=("341234567", "content"), kwargs={"account": "auto"}).get()
+        self.assertEqual(0, mock_retry.call_count)
+        self.assertEqual(0, default.request_listen.call_count)
+        other.facade.send_message.assert_called_once_with("341234567", "content", lane="transactional")
+
+    def test_send_messages_bulk_auto_account_error(self):
+        facades = {"1": mock.MagicMock(), "2": mock.MagicMock()}
+        facades["1"].send_messages.side_effect = lambda messages, lane: [{"number": n, "id": c, "status": "sent"}
+                                                                         for n, c in messages]
+        facades["2"].send_messages.side_effect = LoopTimeoutError("not executed")
+        messages = [("3461", "a"), ("3462", "b"), ("3463", "c")]
+        with mock.patch.object(current_app, 'router', create=True) as mock_router, \
+                mock.patch('yowsup_celery.tasks.YowsupTask.loop', new_callable=mock.PropertyMock) as mock_stack, \
+                mock.patch('yowsup_celery.tasks.send_messages_bulk.retry') as mock_retry:
+            mock_stack.return_value = mock.MagicMock(listening=True)
+            mock_router.route.side_effect = lambda number: mock.Mock(facade=facades["1" if number != "3462" else "2"])
+            results = tasks.send_messages_bulk.apply(args=(messages,), kwargs={"account": "auto"}).get()
+        self.assertEqual(0, mock_retry.call_count)
+        self.assertEqual(["sent", "error", "sent"], [r["status"] for r in results])
+        self.assertEqual({"number": "3462", "id": None, "status": "error", "error": "not executed"}, results[1])
+
+    def test_send_messages_bulk_delivery_timeout(self):
+        delivery = {"id": "1", "ack_latency": 0.1}
+        with mock.patch('yowsup_celery.tasks.YowsupTask.stack', new_callable=mock.PropertyMock) as mock_stack, \
+                mock.patch('yowsup_celery.tasks.YowsupTask.facade', new_callable=mock.PropertyMock) as mock_facade:
+            mock_stack.return_value = mock.MagicMock(listening=True)
+            mock_facade.return_value.send_messages.return_value = [{"number": "3461", "id": "1", "status": "sent"},
+                                                                   {"number": "3462", "id": "2", "status": "sent"}]
+            mock_facade.return_value.wait_delivery.side_effect = lambda message_id, event, timeout: \
+                delivery if message_id == "1" else None
+            results = tasks.send_messages_bulk.apply(args=([("3461", "a"), ("3462", "b")],),
+                                                     kwargs={"result": "ack"}).get()
+        self.assertEqual([delivery, None], [r["delivery"] for r in results])
+        self.assertEqual(["1", "2"], [r["id"] for r in results])
+
+    def test_send_message_not_executed_by_loop_retried(self):
+        with mock.patch('yowsup_celery.tasks.YowsupTask.stack', new_callable=mock.PropertyMock) as mock_stack, \
+                mock.patch('yowsup_celery.tasks.YowsupTask.facade', new_callable=mock.PropertyMock) as mock_facade, \
+                mock.patch('yowsup_celery.tasks.send_message.retry') as mock_retry:
+            mock_stack.return_value = mock.MagicMock(listening=True)
+            error = LoopTimeoutError()
+            mock_facade.return_value.send_message.side_effect = error
+            tasks.send_message("341234567", "content")
+            mock_retry.assert_called_once_with(exc=error)
+
+    def test_send_message_lane(self):
+        stack = mock.MagicMock(listening=True)
+        with mock.patch.object(current_app, 'stacks', create=True) as mock_stacks:
+            mock_stacks.get.return_value = stack
+            tasks.send_message.apply(args=("341234567", "content"), kwargs={"account": "342222222",
+                                                                            "lane": "bulk"}).get()
+            stack.facade.send_message.assert_called_once_with("341234567", "content", lane="bulk")
+
 if __name__ == '__main__':
     import sys
     sys.exit(unittest.main())
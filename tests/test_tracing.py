@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+from yowsup_celery.tracing import Tracer, TracingLayer
+from yowsup_celery.metrics import MetricsRegistry
+try:
+    from unittest import mock
+except ImportError:
+    import mock  # noqa
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_record(self):
+        metrics = MetricsRegistry()
+        span_fn = mock.MagicMock()
+        tracer = Tracer(metrics, span_fn)
+        tracer.record("lower", "message", 10, 10.5)
+        self.assertEqual((1, 0.5), metrics.histogram("stage_seconds").get(stage="lower", name="message"))
+        span_fn.assert_called_once_with("lower", "message", 10, 0.5)
+
+    def test_slow_logged(self):
+        tracer = Tracer(slow=0.1)
+        with mock.patch('yowsup_celery.tracing.logger') as mock_logger:
+            tracer.record("callback", "ack", 10, 10.05)
+            self.assertEqual(0, mock_logger.warning.call_count)
+            tracer.record("callback", "ack", 10, 11)
+            self.assertEqual(1, mock_logger.warning.call_count)
+
+
+class TestTracingLayer(unittest.TestCase):
+
+    def setUp(self):
+        self.layer = TracingLayer()
+        self.upper = mock.MagicMock()
+        self.lower = mock.MagicMock()
+        self.layer.setLayers(self.upper, self.lower)
+        self.stack = mock.MagicMock(tracer=mock.MagicMock())
+        self.layer.setStack(self.stack)
+        self.entity = mock.MagicMock()
+        self.entity.getTag.return_value = "message"
+
+    def test_send_traced(self):
+        self.layer.send(self.entity)
+        self.lower.send.assert_called_once_with(self.entity)
+        self.assertEqual(("lower", "message"), self.stack.tracer.record.call_args[0][:2])
+
+    def test_receive_traced(self):
+        self.layer.receive(self.entity)
+        self.upper.receive.assert_called_once_with(self.entity)
+        self.assertEqual(("upper", "message"), self.stack.tracer.record.call_args[0][:2])
+
+    def test_not_traced(self):
+        self.stack.tracer = None
+        self.layer.send(self.entity)
+        self.layer.receive(self.entity)
+        self.lower.send.assert_called_once_with(self.entity)
+        self.upper.receive.assert_called_once_with(self.entity)
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unittest.main())
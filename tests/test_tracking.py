@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import threading
+from yowsup_celery.tracking import AckTracker
+try:
+    from unittest import mock
+except ImportError:
+    import mock  # noqa
+
+
+class TestAckTracker(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('yowsup_celery.tracking.time')
+        self.mock_time = patcher.start()
+        self.mock_time.time.return_value = 1000.0
+        self.addCleanup(patcher.stop)
+        self.tracker = AckTracker(max_size=3, ttl=60)
+
+    def test_delivery_latencies(self):
+        self.tracker.sent("1", "341234567@s.whatsapp.net", "text")
+        self.mock_time.time.return_value = 1000.5
+        self.tracker.acked("1")
+        self.mock_time.time.return_value = 1002.0
+        self.tracker.received("1")
+        delivery = self.tracker.get("1")
+        self.assertEqual("341234567@s.whatsapp.net", delivery["to"])
+        self.assertEqual(0.5, delivery["ack_latency"])
+        self.assertEqual(2.0, delivery["receipt_latency"])
+        self.assertEqual([0.5], self.tracker.ack_latencies())
+
+    def test_not_tracked(self):
+        self.assertIsNone(self.tracker.acked("unknown"))
+        self.assertIsNone(self.tracker.get("unknown"))
+
+    def test_in_flight(self):
+        self.tracker.sent("1", "a")
+        self.tracker.sent("2", "b")
+        self.tracker.acked("1")
+        self.assertEqual(1, self.tracker.in_flight())
+
+    def test_max_size(self):
+        for message_id in ("1", "2", "3", "4"):
+            self.tracker.sent(message_id, "a")
+        self.assertEqual(["2", "3", "4"], list(self.tracker.deliveries.keys()))
+
+    def test_ttl(self):
+        self.tracker.sent("1", "a")
+        self.mock_time.time.return_value = 1030.0
+        self.tracker.sent("2", "a")
+        self.mock_time.time.return_value = 1070.0
+        self.assertEqual(1, self.tracker.in_flight())
+        self.assertIsNone(self.tracker.get("1"))
+
+    def test_callback(self):
+        deliveries = []
+        self.tracker.add_callback("1", deliveries.append)
+        self.tracker.sent("1", "a")
+        self.assertEqual([], deliveries)
+        self.mock_time.time.return_value = 1001.0
+        self.tracker.acked("1")
+        self.assertEqual(1.0, deliveries[0]["ack_latency"])
+        self.assertEqual({}, self.tracker.callbacks)
+
+    def test_callback_already_received(self):
+        deliveries = []
+        self.tracker.sent("1", "a")
+        self.tracker.received("1")
+        self.tracker.add_callback("1", deliveries.append, "receipt")
+        self.assertEqual("1", deliveries[0]["id"])
+
+    def test_wait(self):
+        self.tracker.sent("1", "a")
+        timer = threading.Timer(0.05, self.tracker.acked, args=("1",))
+        timer.start()
+        self.assertEqual("1", self.tracker.wait("1", timeout=5)["id"])
+        timer.join()
+
+    def test_wait_timeout(self):
+        self.tracker.sent("1", "a")
+        self.assertIsNone(self.tracker.wait("1", "receipt", timeout=0.01))
+        self.assertEqual({}, self.tracker.callbacks)
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unittest.main())
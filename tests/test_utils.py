@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import threading
+from yowsup_celery.utils import ExponentialBackoff, WorkerPool, TTLCache
+from yowsup_celery.exceptions import QueueFullError
+try:
+    from unittest import mock
+except ImportError:
+    import mock  # noqa
+
+
+class TestExponentialBackoff(unittest.TestCase):
+
+    def test_delays_grow_until_maximum(self):
+        backoff = ExponentialBackoff(base=1, maximum=10, factor=2, jitter=0)
+        self.assertEqual([1, 2, 4, 8, 10, 10], [backoff.next() for _ in range(6)])
+
+    def test_jitter(self):
+        backoff = ExponentialBackoff(base=4, maximum=10, factor=2, jitter=0.5)
+        for _ in range(20):
+            backoff.reset()
+            delay = backoff.next()
+            self.assertGreaterEqual(delay, 2)
+            self.assertLessEqual(delay, 4)
+
+    def test_reset(self):
+        backoff = ExponentialBackoff(base=1, jitter=0)
+        backoff.next()
+        backoff.next()
+        backoff.reset()
+        self.assertEqual(1, backoff.next())
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('yowsup_celery.utils.time')
+        self.mock_time = patcher.start()
+        self.mock_time.time.return_value = 1000.0
+        self.addCleanup(patcher.stop)
+        self.cache = TTLCache(max_size=2, ttl=60)
+
+    def test_lru_eviction(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.assertEqual(1, self.cache.get("a"))
+        self.cache.set("c", 3)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(1, self.cache.get("a"))
+        self.assertEqual(3, self.cache.get("c"))
+
+    def test_ttl(self):
+        self.cache.set("a", 1)
+        self.mock_time.time.return_value = 1061.0
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(0, len(self.cache))
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool(size=2, max_pending=2, name="test")
+
+    def tearDown(self):
+        self.pool.stop(1)
+
+    def test_submit(self):
+        results = []
+        for i in range(2):
+            self.pool.submit(results.append, (i,))
+        self.pool.join()
+        self.assertEqual([0, 1], sorted(results))
+        self.assertEqual(0, self.pool.pending())
+        self.assertEqual(2, len(self.pool.threads))
+
+    def test_full(self):
+        event = threading.Event()
+        self.pool.submit(event.wait)
+        self.pool.submit(event.wait)
+        self.assertRaises(QueueFullError, self.pool.submit, event.wait, timeout=0.01)
+        event.set()
+        self.pool.join()
+        self.assertEqual(0, self.pool.pending())
+
+    def test_job_error_releases_slot(self):
+        self.pool.submit(lambda: 1 / 0)
+        self.pool.join()
+        self.assertEqual(0, self.pool.pending())
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unittest.main())
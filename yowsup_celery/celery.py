@@ -16,4 +16,8 @@ class YowCelery(Celery):
              Option('--yowconfig', dest='config', default=None, 
                     help='Path to config file containing authentication info.'),
              Option('--yowunmoxie', dest='unmoxie', action="store_true", default=False, 
-                    help="Disable E2E Encryption")])
+                    help="Disable E2E Encryption"),
+             Option('--yowpersistent', dest='persistent', action="store_true", default=False,
+                    help="Keep WhatsApp connection alive until worker stops"),
+             Option('--yowloop', dest='loop', default=None, choices=['asyncore', 'asyncio', 'gevent'],
+                    help="Event loop polling WhatsApp connection: asyncore (default), asyncio or gevent")])
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+import logging
+import threading
+from collections import deque
+import six
+from yowsup_celery.exceptions import ConfigurationError, QueueFullError, LoopTimeoutError
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+logger = logging.getLogger(__name__)
+
+CONTROL_LANE = "control"
+TRANSACTIONAL_LANE = "transactional"
+BULK_LANE = "bulk"
+LANES = (CONTROL_LANE, TRANSACTIONAL_LANE, BULK_LANE)
+
+BLOCK = "block"
+REJECT = "reject"
+SHED_OLDEST = "shed_oldest"
+FULL_POLICIES = (BLOCK, REJECT, SHED_OLDEST)
+
+
+class DetachedQueue(object):
+    """
+    Callbacks to be executed by the loop in priority lanes. Callbacks are taken from the first lane
+    with callbacks, so bulk sends never delay transactional ones. Control lane has stack internal
+    callbacks and is unbounded, the other lanes hold at most maxsize callbacks each.
+
+    When a lane is full, according to full policy, put blocks until there is room (raising
+    QueueFullError after timeout), raises QueueFullError at once, or drops the oldest callback of the
+    lane. Dropped callbacks with a cancel method are cancelled with QueueFullError.
+
+    Get, qsize and empty behave as Queue.Queue ones.
+
+    :ivar dict lanes: deque of callbacks by lane
+    :ivar dict dropped: callbacks dropped by lane
+    """
+
+    def __init__(self, maxsize=10000, full_policy=BLOCK, timeout=30, lanes=LANES):
+        """
+        :param int maxsize: max callbacks of each lane except control, 0 for unbounded
+        :param str full_policy: block, reject or shed_oldest
+        :param float timeout: max secs put blocks with block policy, None to wait forever
+        :param tuple lanes: lane names by priority, first one is control lane
+        """
+        if full_policy not in FULL_POLICIES:
+            raise ConfigurationError("Unknown full policy %s, options are %s" %
+                                     (full_policy, ", ".join(FULL_POLICIES)))
+        self.maxsize = maxsize
+        self.full_policy = full_policy
+        self.timeout = timeout
+        self.priorities = tuple(lanes)
+        self.lanes = dict((lane, deque()) for lane in lanes)
+        self.dropped = dict((lane, 0) for lane in lanes)
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+
+    def _full(self, lane):
+        return self.maxsize > 0 and lane != self.priorities[0] and len(self.lanes[lane]) >= self.maxsize
+
+    def put(self, item, lane=None):
+        """
+        :param item: callback
+        :param str lane: control lane if None
+        :raises: QueueFullError when lane is full and policy rejects it or block timed out
+        """
+        lane = lane or self.priorities[0]
+        if lane not in self.lanes:
+            raise ValueError("Unknown lane %s, options are %s" % (lane, ", ".join(self.priorities)))
+        dropped = None
+        with self._not_full:
+            if self._full(lane):
+                if self.full_policy == REJECT:
+                    raise QueueFullError("Detached queue lane %s has %d callbacks" % (lane, self.maxsize))
+                elif self.full_policy == SHED_OLDEST:
+                    dropped = self.lanes[lane].popleft()
+                    self.dropped[lane] += 1
+                else:
+                    deadline = time.time() + self.timeout if self.timeout is not None else None
+                    while self._full(lane):
+                        remaining = deadline - time.time() if deadline is not None else None
+                        if remaining is not None and remaining <= 0:
+                            raise QueueFullError("Detached queue lane %s full for %s secs" % (lane, self.timeout))
+                        self._not_full.wait(remaining)
+            self.lanes[lane].append(item)
+            self._not_empty.notify()
+        if dropped is not None:
+            logger.warning("Detached queue lane %s full, oldest callback dropped" % lane)
+            if hasattr(dropped, "cancel"):
+                dropped.cancel(QueueFullError("Dropped from full detached queue lane %s" % lane))
+
+    def _pop(self, lanes):
+        for lane in lanes:
+            if self.lanes[lane]:
+                item = self.lanes[lane].popleft()
+                self._not_full.notify()
+                return item
+        raise Queue.Empty
+
+    def get(self, block=True, timeout=None, lane=None):
+        """
+        Remove and return the first callback of the highest priority lane with callbacks
+        :param str lane: only take callbacks of this lane, None for any lane
+        :raises: Queue.Empty when there are no callbacks in time
+        """
+        lanes = (lane,) if lane else self.priorities
+        with self._not_empty:
+            if block:
+                deadline = time.time() + timeout if timeout is not None else None
+                while not any(self.lanes[name] for name in lanes):
+                    remaining = deadline - time.time() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._not_empty.wait(remaining)
+            return self._pop(lanes)
+
+    def _qsize(self):
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def qsize(self):
+        with self._mutex:
+            return self._qsize()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def depth(self, lane=None):
+        """
+        :param str lane: None for all lanes
+        :returns: callbacks waiting in lane
+        """
+        if lane is None:
+            return self.qsize()
+        with self._mutex:
+            return len(self.lanes[lane])
+
+    def cancel_calls(self, error, lanes=None):
+        """
+        Remove callbacks that can be cancelled, calls waited by other threads, and cancel them with error.
+        Other callbacks are kept
+        :param list lanes: None for all lanes except control
+        :returns: number of callbacks cancelled
+        """
+        lanes = lanes or self.priorities[1:]
+        with self._mutex:
+            items = []
+            for lane in lanes:
+                kept = deque()
+                for item in self.lanes[lane]:
+                    (items if hasattr(item, "cancel") else kept).append(item)
+                self.lanes[lane] = kept
+            self._not_full.notify_all()
+        for item in items:
+            item.cancel(error)
+        return len(items)
+
+
+class LoopCall(object):
+    """
+    Call handed over to the loop thread by another thread waiting for its result
+
+    :ivar Event done: set when call is executed or cancelled
+    :ivar bool started: loop started executing it, it can not be cancelled anymore
+    :ivar bool cancelled: cancelled before being executed, loop skips it
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.started = False
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.started = True
+        try:
+            self.result = self.fn()
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            self.done.set()
+
+    def cancel(self, error):
+        """
+        Cancel call not started yet, caller gets error
+        :returns: True if cancelled
+        """
+        with self._lock:
+            if self.started:
+                return False
+            self.cancelled = True
+        try:
+            raise error
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Block until call is executed by the loop
+        :param float timeout: max secs to wait, call is cancelled when it expires before it starts
+        :returns: call result
+        :raises: call exception, LoopTimeoutError when loop did not execute it in time
+        """
+        if not self.done.wait(timeout):
+            if self.cancel(LoopTimeoutError("Loop did not execute call in %s secs" % timeout)):
+                six.reraise(*self.exc_info)
+            # started just in time
+            self.done.wait()
+        if self.exc_info:
+            six.reraise(*self.exc_info)
+        return self.result
@@ -29,3 +29,24 @@ class AuthenticationError(YowsupCeleryError):
     password for number is incorrect. Check if registration was correct
     """
     pass
+
+
+class DeliveryTimeoutError(YowsupCeleryError):
+    """
+    Raised when a sent message ack or receipt is not received in time
+    """
+    pass
+
+
+class QueueFullError(YowsupCeleryError):
+    """
+    Raised when a bounded queue has no room for more work in time
+    """
+    pass
+
+
+class LoopTimeoutError(YowsupCeleryError):
+    """
+    Raised when a call handed over to the loop is not executed in time
+    """
+    pass
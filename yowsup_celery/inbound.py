@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from collections import deque
+from yowsup_celery.exceptions import QueueFullError
+from yowsup_celery.utils import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+
+def _text(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def message_event(message_protocol_entity):
+    """
+    Serializable dict for an incoming message entity
+    """
+    event = {
+        "event": "message",
+        "id": message_protocol_entity.getId(),
+        "from": message_protocol_entity.getFrom(),
+        "participant": message_protocol_entity.getParticipant(),
+        "notify": message_protocol_entity.getNotify(),
+        "timestamp": message_protocol_entity.getTimestamp(),
+        "type": message_protocol_entity.getType(),
+    }
+    if hasattr(message_protocol_entity, "getBody"):
+        event["body"] = _text(message_protocol_entity.getBody())
+    if hasattr(message_protocol_entity, "getMediaType"):
+        event["media_type"] = message_protocol_entity.getMediaType()
+    if hasattr(message_protocol_entity, "getMediaUrl"):
+        event["url"] = message_protocol_entity.getMediaUrl()
+        event["mimetype"] = message_protocol_entity.getMimeType()
+        event["size"] = message_protocol_entity.getMediaSize()
+    if getattr(message_protocol_entity, "caption", None):
+        event["caption"] = _text(message_protocol_entity.caption)
+    return event
+
+
+def receipt_event(receipt_protocol_entity):
+    """
+    Serializable dict for an incoming receipt entity
+    """
+    return {
+        "event": "receipt",
+        "id": receipt_protocol_entity.getId(),
+        "from": receipt_protocol_entity.getFrom(),
+        "participant": receipt_protocol_entity.getParticipant(),
+        "timestamp": getattr(receipt_protocol_entity, "timestamp", None),
+        "type": receipt_protocol_entity.getType(),
+        "items": getattr(receipt_protocol_entity, "items", None) or [],
+    }
+
+
+class TaskSink(object):
+    """
+    Sink publishing each batch of inbound events as a celery task with the batch as only argument
+    """
+
+    def __init__(self, app, task_name, queue=None):
+        """
+        :param app: celery app
+        :param str task_name: name of the task receiving batches
+        :param str queue: queue to publish to, None for task default
+        """
+        self.app = app
+        self.task_name = task_name
+        self.queue = queue
+
+    def __call__(self, events):
+        options = {"queue": self.queue} if self.queue else {}
+        self.app.send_task(self.task_name, args=(events,), **options)
+
+
+class InboundDispatcher(object):
+    """
+    Batch inbound events and deliver them to a sink out of the loop thread. A batch is delivered
+    when it reaches batch size or when window secs passed since its first event.
+
+    Events are acknowledged to the server only once the sink accepted their batch, acks are scheduled
+    in the loop. When delivery threads are behind, batches wait in a buffer and are handed over to the
+    pool when it has room, so the loop never delivers them itself. Events waiting are not acked, so the
+    server keeps them and sends them again if they are lost.
+
+    :ivar list batch: events waiting to be delivered
+    :ivar deque buffer: (events, acks) batches waiting for room in pool
+    :ivar WorkerPool pool: threads delivering batches to sink
+    """
+
+    def __init__(self, sink, scheduler, batch_size=100, window=1.0, workers=1, max_pending=10):
+        """
+        :param sink: callable receiving a list of events
+        :param scheduler: callable(delay, fn) executing fn in the loop after delay secs
+        :param int batch_size: max events per batch
+        :param float window: max secs an event waits for its batch to be delivered
+        :param int workers: threads delivering batches
+        :param int max_pending: max batches waiting in pool for delivery
+        """
+        self.sink = sink
+        self.scheduler = scheduler
+        self.batch_size = batch_size
+        self.window = window
+        self.pool = WorkerPool(workers, max_pending, name="inbound")
+        self.batch = []
+        self.buffer = deque()
+        self._acks = []
+        self._lock = threading.Lock()
+        self._flush_scheduled = False
+        self._drain_scheduled = False
+
+    def add(self, event, ack=None):
+        """
+        :param dict event: inbound event
+        :param ack: executed in the loop once the sink accepted the event, None if it is not acked
+        """
+        with self._lock:
+            self.batch.append(event)
+            if ack is not None:
+                self._acks.append(ack)
+            if len(self.batch) < self.batch_size:
+                if not self._flush_scheduled:
+                    self._flush_scheduled = True
+                    self.scheduler(self.window, self.flush)
+                return
+            events, acks = self._take()
+        self.dispatch(events, acks)
+
+    def _take(self):
+        events, acks = self.batch, self._acks
+        self.batch, self._acks = [], []
+        return events, acks
+
+    def flush(self):
+        """
+        Deliver events waiting in current batch
+        """
+        with self._lock:
+            self._flush_scheduled = False
+            events, acks = self._take()
+        if events:
+            self.dispatch(events, acks)
+
+    def dispatch(self, events, acks=()):
+        with self._lock:
+            self.buffer.append((events, list(acks)))
+            if len(self.buffer) > 1:
+                logger.warning("Inbound delivery is behind, %d batches waiting" % len(self.buffer))
+        self.drain()
+
+    def drain(self):
+        """
+        Hand over buffered batches to pool while it has room, retrying after window secs when it is full
+        """
+        with self._lock:
+            while self.buffer:
+                try:
+                    self.pool.submit(self.deliver, self.buffer[0], timeout=0)
+                except QueueFullError:
+                    break
+                self.buffer.popleft()
+            retry = bool(self.buffer) and not self._drain_scheduled
+            if retry:
+                self._drain_scheduled = True
+                self.scheduler(self.window, self._scheduled_drain)
+
+    def _scheduled_drain(self):
+        with self._lock:
+            self._drain_scheduled = False
+        self.drain()
+
+    def deliver(self, events, acks=()):
+        try:
+            self.sink(events)
+        except Exception:
+            logger.exception("Error delivering %d inbound events, they are not acked" % len(events))
+            return
+        if acks:
+            self.scheduler(0, lambda: self.ack(acks))
+
+    def ack(self, acks):
+        for ack in acks:
+            try:
+                ack()
+            except Exception:
+                logger.exception("Error acking inbound event")
@@ -4,6 +4,7 @@ from yowsup.layers import EventCallback
 from yowsup.layers.protocol_messages.protocolentities import \
     TextMessageProtocolEntity
 from yowsup.layers.protocol_media.protocolentities import RequestUploadIqProtocolEntity
+from yowsup.layers.protocol_iq.protocolentities import PingIqProtocolEntity
 from yowsup.layers.protocol_media.protocolentities.message_media_downloadable_image import \
     ImageDownloadableMediaMessageProtocolEntity
 from yowsup.layers.protocol_media.protocolentities.message_media_downloadable_audio import \
@@ -14,11 +15,24 @@ import logging
 from yowsup.layers.network import YowNetworkLayer
 from yowsup.layers import YowLayerEvent
 from functools import wraps
+from collections import deque
+import socket
 import sys
 import os
+import copy
+import time
+import threading
 from yowsup_celery.layer_interface import CeleryLayerInterface
 from yowsup_celery.exceptions import ConnectionError
-from yowsup.layers.protocol_media.mediauploader import MediaUploader
+from yowsup_celery.utils import ExponentialBackoff, WorkerPool, TTLCache
+from yowsup_celery.tracking import AckTracker
+from yowsup_celery.inbound import message_event, receipt_event
+from yowsup_celery.media import MediaSource, FileSource, BytesSource, ResumableUploads, media_message_from_source
+from yowsup_celery.detached import CONTROL_LANE
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 
 logger = logging.getLogger(__name__)
 
@@ -30,17 +44,130 @@ def connection_required(f):
         return f(self, *args, **kwargs)
     return decorated_function
 
+def buffered_while_reconnecting(f):
+    """
+    Keep the call in outgoing buffer while reconnecting instead of failing. Buffered calls
+    are executed once connection is restored
+    """
+    @wraps(f)
+    def decorated_function(self, *args, **kwargs):
+        if not self.connected and self.reconnecting:
+            if len(self.outgoing_buffer) >= self.outgoing_buffer_size:
+                raise ConnectionError("%s needs to be connected, outgoing buffer is full" % f.__name__)
+            self.outgoing_buffer.append((f, args, kwargs))
+            return None
+        return f(self, *args, **kwargs)
+    return decorated_function
+
+def failures_counted(message_type, batch=None):
+    """
+    Count messages_failed_total of calls raising, as sends not executed by the loop in time or rejected by
+    a full queue. Failures detected later, as upload errors, are counted where they happen
+    :param str message_type: type label of the counter
+    :param str batch: first argument name when it is a list of messages, each one is counted
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(self, *args, **kwargs):
+            try:
+                return f(self, *args, **kwargs)
+            except Exception:
+                failed = len(kwargs[batch] if batch in kwargs else args[0]) if batch else 1
+                self.count("messages_failed_total", failed, type=message_type)
+                raise
+        return decorated_function
+    return decorator
+
+def in_loop(f):
+    """
+    Execute the call in the loop, see :meth:`CeleryLayer.run_in_loop`. Optional lane keyword selects
+    the detached queue lane, it is not passed to the call
+    """
+    @wraps(f)
+    def decorated_function(self, *args, **kwargs):
+        lane = kwargs.pop("lane", None)
+        return self.run_in_loop(lambda: f(self, *args, **kwargs), lane)
+    return decorated_function
+
 class CeleryLayer(YowInterfaceLayer):    
     """
     Layer to be on the top of the Yowsup Stack. 
     :ivar bool connected: connected or not connected to whatsapp
     :ivar YowLayerInterface interface: layer interface
+    :ivar bool reconnect: reconnect automatically when connection is lost
+    :ivar bool reconnecting: connection lost and reconnection in progress
+    :ivar ExponentialBackoff backoff: delays between reconnection attempts
+    :ivar deque outgoing_buffer: sends waiting for reconnection
+    :ivar int reconnect_count: reconnection attempts
+    :ivar RateLimiter rate_limiter: pacing for outgoing messages, None to send without limits
+    :ivar deque throttled: outgoing entities waiting for rate limiter
+    :ivar AckTracker ack_tracker: sent messages pending of ack and receipt
+    :ivar WorkerPool upload_pool: threads uploading media, bounding media sends in progress
+    :ivar float upload_slot_timeout: max secs a media send waits for room in upload pool
+    :ivar set upload_requests: ids of upload requests waiting for server answer, each one holding an upload
+        pool slot
+    :ivar TTLCache media_cache: (url, ip) of uploaded media by (media type, content hash, size),
+        None to request upload for each media send
+    :ivar ResumableUploads uploads: uploads media retrying failed uploads from last offset
+    :ivar InboundDispatcher inbound: delivers received messages and receipts in batches, None to
+        only ack them
+    :ivar TTLCache media_metadata: media message entities, with file hash, size and preview computed,
+        by (path, mtime, size, media type). None to read media files for each send
+    :ivar MetricsRegistry metrics: registry of counters and histograms, None to not record metrics
+    :ivar dict metric_labels: labels added to every metric recorded, account by default
+    :ivar Tracer tracer: records duration of protocol entity callbacks, None to not trace them
+    :ivar loop_runner: callable(fn, lane) executing fn in the stack loop, None to execute sends in the caller
+        thread
+    :ivar loop_checker: callable returning True when called from the loop thread, None if there is no loop
+    :ivar float ping_interval: secs between keep alive pings sent by loop timers, None to not send them
+    :ivar float pong_timeout: secs to wait for a ping answer before disconnecting, ping_interval if None
+    :ivar str pending_ping: id of the last ping sent not answered yet
+    :ivar int ping_generation: connection the scheduled ping timers belong to, timers of previous
+        connections are ignored
     """
 
     def __init__(self):
         super(CeleryLayer, self).__init__()
         self.connected = False
         self.interface = CeleryLayerInterface(self)
+        self.reconnect = False
+        self.reconnecting = False
+        self.disconnect_requested = False
+        self.backoff = ExponentialBackoff()
+        self.outgoing_buffer = deque()
+        self.outgoing_buffer_size = 1000
+        self.reconnect_count = 0
+        self.rate_limiter = None
+        self.throttled = deque()
+        self._throttled_lock = threading.Lock()
+        self._throttled_flush_scheduled = False
+        self.ack_tracker = AckTracker()
+        self.upload_pool = WorkerPool(4, 100, name="upload")
+        self.upload_slot_timeout = 30
+        self.upload_requests = set()
+        self.media_cache = TTLCache(1000, 24 * 3600)
+        self.media_metadata = TTLCache(100)
+        self.uploads = ResumableUploads()
+        self.inbound = None
+        self.metrics = None
+        self.metric_labels = {}
+        self.tracer = None
+        self.loop_runner = None
+        self.loop_checker = None
+        self.ping_interval = None
+        self.pong_timeout = None
+        self.pending_ping = None
+        self.ping_generation = 0
+
+    def receive(self, entity):
+        tracer = self.tracer
+        if tracer is None:
+            return super(CeleryLayer, self).receive(entity)
+        start = time.time()
+        try:
+            return super(CeleryLayer, self).receive(entity)
+        finally:
+            tracer.record("callback", entity.getTag(), start)
 
     def normalize_jid(self, number):
         if '@' in number:
@@ -50,13 +177,168 @@ class CeleryLayer(YowInterfaceLayer):
 
         return "%s@s.whatsapp.net" % number
     
-    def do_send_image(self, file_path, url, to, ip=None, caption=None):
-        entity = ImageDownloadableMediaMessageProtocolEntity.fromFilePath(file_path, url, ip, to, caption=caption)
+    def paced_to_lower(self, entity):
+        """
+        Send message entity to lower layer at the pace allowed by rate limiter. Entities over the
+        limits wait in throttled queue, in order, until the loop flushes them
+        """
+        if self.rate_limiter is None:
+            self.tracked_to_lower(entity)
+            return
+        with self._throttled_lock:
+            if not self.throttled and self.rate_limiter.acquire(entity.getTo()) == 0:
+                self.tracked_to_lower(entity)
+                return
+            self.throttled.append(entity)
+            self._schedule_throttled_flush(self.rate_limiter.global_delay())
+
+    def tracked_to_lower(self, entity):
+        """
+        Send message entity to lower layer tracking it until ack is received
+        """
+        self.ack_tracker.sent(entity.getId(), entity.getTo(), entity.getType())
         self.toLower(entity)
+        self.count("messages_sent_total", type=entity.getType())
+
+    def call_later(self, delay, fn):
+        self.getStack().call_later(delay, fn)
+
+    def run_in_loop(self, fn, lane=None):
+        """
+        Execute fn with loop runner, so entities are only written to the connection by the loop thread
+        while it is listening
+        :param str lane: detached queue lane, transactional if None
+        """
+        if self.loop_runner is None:
+            return fn()
+        return self.loop_runner(fn, lane)
+
+    def in_loop_thread(self):
+        return self.loop_checker is not None and self.loop_checker()
+
+    def count(self, name, value=1, **labels):
+        """
+        Increase counter when metrics are enabled
+        """
+        if self.metrics is not None:
+            labels.update(self.metric_labels)
+            self.metrics.counter(name).inc(value, **labels)
+
+    def observe(self, name, value, **labels):
+        """
+        Record histogram observation when metrics are enabled
+        """
+        if self.metrics is not None:
+            labels.update(self.metric_labels)
+            self.metrics.histogram(name).observe(value, **labels)
+
+    def _schedule_throttled_flush(self, delay):
+        if not self._throttled_flush_scheduled:
+            self._throttled_flush_scheduled = True
+            self.getStack().call_later(delay, self.flush_throttled)
+
+    def flush_throttled(self):
+        """
+        Send throttled entities allowed by rate limiter keeping order for each recipient
+        """
+        with self._throttled_lock:
+            self._throttled_flush_scheduled = False
+            if not self.connected:
+                # held in outgoing buffer on disconnection, a closed connection would drop them
+                return
+            pending = deque()
+            blocked = set()
+            wait = None
+            while self.throttled:
+                global_delay = self.rate_limiter.global_delay()
+                if global_delay:
+                    wait = global_delay
+                    break
+                entity = self.throttled.popleft()
+                to = entity.getTo()
+                delay = None if to in blocked else self.rate_limiter.acquire(to)
+                if delay == 0:
+                    self.tracked_to_lower(entity)
+                else:
+                    blocked.add(to)
+                    pending.append(entity)
+                    if delay and (wait is None or delay < wait):
+                        wait = delay
+            pending.extend(self.throttled)
+            self.throttled = pending
+            if self.throttled:
+                self._schedule_throttled_flush(wait or 0)
+
+    def hold_throttled(self):
+        """
+        Move throttled entities to the front of outgoing buffer when connection is lost, so they are
+        sent once connection is restored
+        """
+        with self._throttled_lock:
+            entities, self.throttled = self.throttled, deque()
+        if entities:
+            logger.info("Holding %d throttled entities until connected" % len(entities))
+            self.outgoing_buffer.extendleft((CeleryLayer.paced_to_lower, (entity,), {})
+                                            for entity in reversed(entities))
+
+    def media_file_key(self, path, media_type):
+        """
+        Key identifying file content for media metadata, None if file can not be accessed or media
+        is not a file
+        """
+        if isinstance(path, MediaSource):
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (os.path.abspath(path), stat.st_mtime, stat.st_size, media_type)
+
+    def media_template(self, path, media_type):
+        """
+        Cached media message entity for file, None if it was not computed yet or file was modified
+        """
+        if self.media_metadata is None:
+            return None
+        key = self.media_file_key(path, media_type)
+        return self.media_metadata.get(key) if key else None
+
+    def media_entity(self, media_type, file_path, url, to, ip=None, caption=None):
+        """
+        Media message entity for file. File is read, hashed and thumbnailed once, next sends of the
+        same unmodified file clone the computed entity
+        :param file_path: file path or :class:`yowsup_celery.media.MediaSource`
+        """
+        if isinstance(file_path, MediaSource):
+            return media_message_from_source(media_type, file_path, url, ip, to, caption)
+        template = self.media_template(file_path, media_type)
+        if template is None:
+            if media_type == RequestUploadIqProtocolEntity.MEDIA_TYPE_AUDIO:
+                entity = AudioDownloadableMediaMessageProtocolEntity.fromFilePath(file_path, url, ip, to)
+            else:
+                entity = ImageDownloadableMediaMessageProtocolEntity.fromFilePath(file_path, url, ip, to,
+                                                                                  caption=caption)
+            key = self.media_file_key(file_path, media_type) if self.media_metadata is not None else None
+            if key:
+                self.media_metadata.set(key, copy.copy(entity))
+            return entity
+        entity = copy.copy(template)
+        entity._id = entity._generateId()
+        entity.timestamp = entity._getCurrentTimestamp()
+        entity.url = url
+        entity.ip = ip
+        entity.to = to
+        if media_type == RequestUploadIqProtocolEntity.MEDIA_TYPE_IMAGE:
+            entity.caption = caption
+        return entity
+
+    def do_send_image(self, file_path, url, to, ip=None, caption=None):
+        entity = self.media_entity(RequestUploadIqProtocolEntity.MEDIA_TYPE_IMAGE, file_path, url, to, ip, caption)
+        self.paced_to_lower(entity)
 
     def do_send_audio(self, file_path, url, to, ip=None, caption=None):
-        entity = AudioDownloadableMediaMessageProtocolEntity.fromFilePath(file_path, url, ip, to)
-        self.toLower(entity)
+        entity = self.media_entity(RequestUploadIqProtocolEntity.MEDIA_TYPE_AUDIO, file_path, url, to, ip)
+        self.paced_to_lower(entity)
         
     @ProtocolEntityCallback("success")
     def on_success(self, success_protocol_entity):
@@ -65,6 +347,11 @@ class CeleryLayer(YowInterfaceLayer):
         """
         logger.info("Logged in")
         self.connected = True
+        if self.reconnecting:
+            self.reconnecting = False
+            self.backoff.reset()
+        self.start_ping()
+        self.flush_outgoing_buffer()
             
     @ProtocolEntityCallback("failure")
     def on_failure(self, entity):
@@ -74,6 +361,7 @@ class CeleryLayer(YowInterfaceLayer):
         """
         logger.error("Login failed, reason: %s" % entity.getReason())
         self.connected = False
+        self.stop_reconnect()
         
     @ProtocolEntityCallback("ack")
     @connection_required
@@ -83,6 +371,9 @@ class CeleryLayer(YowInterfaceLayer):
         whatsapp
         """
         logger.info("Ack id %s received" % entity.getId())
+        delivery = self.ack_tracker.acked(entity.getId())
+        if delivery is not None:
+            self.count("messages_acked_total", type=delivery["type"])
    
     @ProtocolEntityCallback("message")
     @connection_required
@@ -91,8 +382,12 @@ class CeleryLayer(YowInterfaceLayer):
         Callback function when receiving message from whatsapp server
         """
         logger.info("Message id %s received" % message_protocol_entity.getId())
-        # answer with receipt
-        self.toLower(message_protocol_entity.ack())
+        # answer with receipt, once inbound sink accepted the message
+        ack = lambda: self.toLower(message_protocol_entity.ack())
+        if self.inbound:
+            self.inbound.add(message_event(message_protocol_entity), ack)
+        else:
+            ack()
             
     @ProtocolEntityCallback("receipt")
     @connection_required
@@ -100,16 +395,111 @@ class CeleryLayer(YowInterfaceLayer):
         """
         Callback function when receiving receipt message from whatsapp
         """
-        self.toLower(receipt_protocol_entity.ack())
+        items = getattr(receipt_protocol_entity, "items", None) or []
+        for message_id in [receipt_protocol_entity.getId()] + items:
+            self.ack_tracker.received(message_id)
+        ack = lambda: self.toLower(receipt_protocol_entity.ack())
+        if self.inbound:
+            self.inbound.add(receipt_event(receipt_protocol_entity), ack)
+        else:
+            ack()
         
     @EventCallback(YowNetworkLayer.EVENT_STATE_DISCONNECTED)
-    @connection_required
     def on_disconnected(self, yowLayerEvent):
         """
         Callback function when receiving a disconnection event
         """
         logger.info("On disconnected")
         self.connected = False
+        self.stop_ping()
+        self.hold_throttled()
+        self.release_upload_requests()
+        if self.inbound:
+            self.inbound.flush()
+        if self.reconnect and not self.disconnect_requested:
+            self.schedule_reconnect()
+
+    def start_ping(self):
+        """
+        Keep connection alive with pings scheduled in the loop, so they are written by the loop thread
+        as any other entity
+        """
+        self.ping_generation += 1
+        self.pending_ping = None
+        if self.ping_interval:
+            generation = self.ping_generation
+            self.call_later(self.ping_interval, lambda: self.ping(generation))
+
+    def stop_ping(self):
+        self.ping_generation += 1
+        self.pending_ping = None
+
+    def ping(self, generation):
+        """
+        Send a keep alive ping and schedule its pong check and the next ping. Executed by loop timers
+        """
+        if generation != self.ping_generation or not self.connected:
+            return
+        entity = PingIqProtocolEntity()
+        ping_id = self.pending_ping = entity.getId()
+        self._sendIq(entity, self.on_pong, self.on_pong)
+        self.call_later(self.pong_timeout or self.ping_interval, lambda: self.check_pong(generation, ping_id))
+        self.call_later(self.ping_interval, lambda: self.ping(generation))
+
+    def on_pong(self, result_entity, original_entity):
+        if self.pending_ping == original_entity.getId():
+            self.pending_ping = None
+
+    def check_pong(self, generation, ping_id):
+        """
+        Disconnect when ping was not answered in time, reconnecting if enabled
+        """
+        if generation != self.ping_generation or self.pending_ping != ping_id:
+            return
+        logger.warning("Ping %s not answered in time, disconnecting" % ping_id)
+        self.stop_ping()
+        self.broadcastEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_DISCONNECT, reason="Ping Timeout"))
+
+    def schedule_reconnect(self):
+        """
+        Schedule next reconnection attempt after backoff delay
+        """
+        self.reconnecting = True
+        delay = self.backoff.next()
+        logger.info("Reconnecting in %.2f secs" % delay)
+        self.getStack().call_later(delay, self.do_reconnect)
+
+    def do_reconnect(self):
+        if self.connected or not self.reconnecting:
+            return
+        self.reconnect_count += 1
+        self.count("reconnects_total")
+        try:
+            self.getLayerInterface(YowNetworkLayer).connect()
+        except socket.error as e:
+            logger.warning("Reconnection attempt failed: %s" % e)
+            self.schedule_reconnect()
+
+    def stop_reconnect(self):
+        """
+        Stop reconnection in progress discarding buffered sends
+        """
+        if self.outgoing_buffer:
+            logger.warning("Discarding %d buffered sends" % len(self.outgoing_buffer))
+            self.outgoing_buffer.clear()
+        self.reconnecting = False
+        self.backoff.reset()
+
+    def flush_outgoing_buffer(self):
+        """
+        Execute sends buffered while reconnecting
+        """
+        while self.outgoing_buffer and self.connected:
+            f, args, kwargs = self.outgoing_buffer.popleft()
+            try:
+                f(self, *args, **kwargs)
+            except Exception:
+                logger.exception("Error sending buffered %s" % f.__name__)
         
     def on_request_upload_result(self, jid, path, result_request_upload_iq_protocol_entity, 
                                  request_upload_iq_protocol_entity, caption=None):
@@ -119,25 +509,93 @@ class CeleryLayer(YowInterfaceLayer):
         else:
             do_send_fn = self.do_send_image
 
+        ip = result_request_upload_iq_protocol_entity.getIp()
         if result_request_upload_iq_protocol_entity.isDuplicate():
-            do_send_fn(path, result_request_upload_iq_protocol_entity.getUrl(), jid,
-                       result_request_upload_iq_protocol_entity.getIp(), caption)
+            self.upload_pool.release()
+            url = result_request_upload_iq_protocol_entity.getUrl()
+            self.cache_media(request_upload_iq_protocol_entity, url, ip)
+            do_send_fn(path, url, jid, ip, caption)
         else:
-            success_fn = lambda filePath, jid, url: do_send_fn(filePath, url, jid, 
-                                                               result_request_upload_iq_protocol_entity.getIp(), 
-                                                               caption)
-            mediaUploader = MediaUploader(jid, self.getOwnJid(), path,
-                                          result_request_upload_iq_protocol_entity.getUrl(),
-                                          result_request_upload_iq_protocol_entity.getResumeOffset(),
-                                          success_fn, self.on_upload_error, self.on_upload_progress, async=True)
-            mediaUploader.start()
+            def success_fn(file_path, jid, url):
+                # called by upload thread
+                self.cache_media(request_upload_iq_protocol_entity, url, ip)
+                self.run_in_loop(lambda: do_send_fn(file_path, url, jid, ip, caption), CONTROL_LANE)
+            resume_offset_fn = lambda: self.request_resume_offset(request_upload_iq_protocol_entity)
+            self.upload_pool.submit(self.do_upload, (jid, path, result_request_upload_iq_protocol_entity.getUrl(),
+                                                     result_request_upload_iq_protocol_entity.getResumeOffset(),
+                                                     success_fn, resume_offset_fn,
+                                                     request_upload_iq_protocol_entity.b64Hash), reserved=True)
+
+    def media_key(self, request_upload_iq_protocol_entity):
+        return (request_upload_iq_protocol_entity.mediaType, request_upload_iq_protocol_entity.b64Hash,
+                request_upload_iq_protocol_entity.size)
+
+    def cache_media(self, request_upload_iq_protocol_entity, url, ip):
+        """
+        Keep url and ip of uploaded media to send same content again without uploading it
+        """
+        if self.media_cache is not None:
+            self.media_cache.set(self.media_key(request_upload_iq_protocol_entity), (url, ip))
+
+    def request_resume_offset(self, request_upload_iq_protocol_entity, timeout=30):
+        """
+        Request upload again so the server reports bytes received of a failed upload. Executed by upload
+        pool threads
+        :param float timeout: max secs to wait for server answer
+        :returns: resume offset, None when server did not answer
+        """
+        entity = RequestUploadIqProtocolEntity(request_upload_iq_protocol_entity.mediaType,
+                                               b64Hash=request_upload_iq_protocol_entity.b64Hash,
+                                               size=request_upload_iq_protocol_entity.size)
+        results = Queue.Queue()
+        self.run_in_loop(lambda: self._sendIq(entity, lambda result, original: results.put(result),
+                                              lambda error, original: results.put(None)), CONTROL_LANE)
+        try:
+            result = results.get(timeout=timeout)
+        except Queue.Empty:
+            logger.warning("Request upload for resume offset not answered in %s secs" % timeout)
+            return None
+        if result is None or result.isDuplicate():
+            return None
+        return int(result.getResumeOffset() or 0)
+
+    def do_upload(self, jid, path, url, resume_offset, success_fn, resume_offset_fn=None, content_hash=None):
+        """
+        Upload media file, blocking until it is finished. Executed by upload pool threads
+        :param resume_offset_fn: returns bytes received by the server after a failed attempt
+        :param str content_hash: base64 sha256 sent in request upload, file is hashed again if None
+        """
+        if isinstance(path, MediaSource):
+            source = path
+        else:
+            # callbacks get the path back so file metadata cache is used
+            source = FileSource(path)
+            upload_success_fn = success_fn
+            success_fn = lambda source, jid, url: upload_success_fn(path, jid, url)
+        start = time.time()
+        uploaded = self.uploads.upload(jid, self.getOwnJid(), source, url, resume_offset, success_fn,
+                                       self.on_upload_error, self.on_upload_progress, resume_offset_fn,
+                                       content_hash)
+        self.observe("upload_seconds", time.time() - start)
+        if uploaded:
+            self.count("upload_bytes_total", source.size - (resume_offset or 0))
+
+    def on_request_upload_error(self, jid, path, error_request_upload_iq_protocol_entity,
+                                request_upload_iq_protocol_entity):
+        self.upload_pool.release()
+        logger.error("Request upload for file %s for %s failed!" % (path, jid))
+        self.count("messages_failed_total", type="media")
             
     def on_upload_error(self, file_path, jid, url):
         logger.error("Upload file %s to %s for %s failed!" % (file_path, url, jid))
+        self.count("messages_failed_total", type="media")
 
     def on_upload_progress(self, file_path, jid, url, progress):
-        logger.info("%s => %s, %d%% \r" % (os.path.basename(file_path), jid, progress))
+        logger.info("%s => %s, %d%% \r" % (os.path.basename(str(file_path)), jid, progress))
     
+    @failures_counted("text")
+    @in_loop
+    @buffered_while_reconnecting
     @connection_required
     def send_message(self, number, content):
         """
@@ -147,48 +605,150 @@ class CeleryLayer(YowInterfaceLayer):
         """
         outgoing_message = TextMessageProtocolEntity(content.encode("utf-8") if sys.version_info >= (3, 0)
                                                      else content, to=self.normalize_jid(number))
-        self.toLower(outgoing_message)
+        self.paced_to_lower(outgoing_message)
         return outgoing_message
         
+    @failures_counted("text", batch="messages")
+    @in_loop
+    def send_messages(self, messages):
+        """
+        Send a batch of messages
+        :param list messages: (number, content) pairs
+        :returns: list of dicts with number, id and status (sent, buffered or error) of each message
+        """
+        if not self.connected and not self.reconnecting:
+            raise ConnectionError("send_messages needs to be connected")
+        results = []
+        for number, content in messages:
+            try:
+                outgoing_message = self.send_message(number, content)
+            except Exception as e:
+                # counted by send_message
+                logger.exception("Error sending message to %s" % number)
+                results.append({"number": number, "id": None, "status": "error", "error": str(e)})
+            else:
+                results.append({"number": number,
+                                "id": outgoing_message.getId() if outgoing_message else None,
+                                "status": "sent" if outgoing_message else "buffered"})
+        return results
+        
     def connect(self):
         if self.connected:
             logger.warning("Already connected, disconnect first")
             return False
+        self.disconnect_requested = False
         self.getLayerInterface(YowNetworkLayer).connect()
         return True
 
     @connection_required
     def disconnect(self):
+        self.disconnect_requested = True
         self.broadcastEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_DISCONNECT))
         return True
     
-    def _send_media_path(self, number, path, type, caption=None):
+    def _send_media_path(self, number, path, type, caption=None, lane=None):
+        """
+        Files are hashed in the caller thread, only the upload request, or the media message when it was
+        already uploaded, is handed over to the loop
+        """
         jid = self.normalize_jid(number)
-        entity = RequestUploadIqProtocolEntity(type, filePath=path)
-        success_fn = lambda success_entity, original_entity: self.on_request_upload_result(jid, path, success_entity, 
-                                                                                           original_entity, caption)
-        error_fn = lambda error_entity, original_entity: self.on_request_upload_error(jid, path, error_entity, 
-                                                                                      original_entity)
-        self._sendIq(entity, success_fn, error_fn)
+        template = self.media_template(path, type)
+        if isinstance(path, MediaSource):
+            entity = RequestUploadIqProtocolEntity(type, b64Hash=path.hash(), size=path.size)
+        elif template is None:
+            entity = RequestUploadIqProtocolEntity(type, filePath=path)
+        else:
+            entity = RequestUploadIqProtocolEntity(type, b64Hash=template.fileHash, size=template.size)
+        uploaded = self.media_cache.get(self.media_key(entity)) if self.media_cache is not None else None
+        if uploaded:
+            url, ip = uploaded
+            do_send_fn = self.do_send_audio if type == RequestUploadIqProtocolEntity.MEDIA_TYPE_AUDIO \
+                else self.do_send_image
+            return self.run_in_loop(lambda: do_send_fn(path, url, jid, ip, caption), lane)
+        # buffered sends flushed on reconnection must not block the loop waiting for a slot
+        self.upload_pool.acquire(0 if self.in_loop_thread() else self.upload_slot_timeout)
+
+        def success_fn(success_entity, original_entity):
+            self.upload_requests.discard(original_entity.getId())
+            self.on_request_upload_result(jid, path, success_entity, original_entity, caption)
+
+        def error_fn(error_entity, original_entity):
+            self.upload_requests.discard(original_entity.getId())
+            self.on_request_upload_error(jid, path, error_entity, original_entity)
+
+        def request_upload():
+            self.upload_requests.add(entity.getId())
+            self._sendIq(entity, success_fn, error_fn)
+        try:
+            self.run_in_loop(request_upload, lane)
+        except Exception:
+            self.upload_requests.discard(entity.getId())
+            self.upload_pool.release()
+            raise
 
+    def release_upload_requests(self):
+        """
+        Release upload slots of requests not answered when connection is lost. Yowsup keeps them in iq
+        registry, but their answer will never arrive
+        """
+        for request_id in list(self.upload_requests):
+            self.upload_requests.discard(request_id)
+            self.iqRegistry.pop(request_id, None)
+            self.upload_pool.release()
+            logger.warning("Upload request %s discarded, connection lost" % request_id)
+            self.count("messages_failed_total", type="media")
+
+    @failures_counted("media")
+    @buffered_while_reconnecting
     @connection_required
-    def send_image(self, number, path, caption=None):
+    def send_image(self, number, path, caption=None, lane=None):
         """
         Send image message
         :param str number: phone number with cc (country code)
         :param str path: image file path
         """
-        return self._send_media_path(number, path, RequestUploadIqProtocolEntity.MEDIA_TYPE_IMAGE, caption)
+        return self._send_media_path(number, path, RequestUploadIqProtocolEntity.MEDIA_TYPE_IMAGE, caption, lane)
         
+    @failures_counted("media")
+    @buffered_while_reconnecting
     @connection_required
-    def send_audio(self, number, path):
+    def send_audio(self, number, path, lane=None):
         """
         Send audio message
         :param str number: phone number with cc (country code)
         :param str path: audio file path
         """
-        return self._send_media_path(number, path, RequestUploadIqProtocolEntity.MEDIA_TYPE_AUDIO)
+        return self._send_media_path(number, path, RequestUploadIqProtocolEntity.MEDIA_TYPE_AUDIO, lane=lane)
     
+    @failures_counted("media")
+    @buffered_while_reconnecting
+    @connection_required
+    def send_image_data(self, number, data, name, caption=None, lane=None):
+        """
+        Send image message from content in memory, uploaded in chunks without temporary files
+        :param str number: phone number with cc (country code)
+        :param bytes data: image content
+        :param str name: image file name, used to guess mimetype
+        """
+        return self._send_media_path(number, BytesSource(data, name), RequestUploadIqProtocolEntity.MEDIA_TYPE_IMAGE,
+                                     caption, lane)
+
+    @failures_counted("media")
+    @buffered_while_reconnecting
+    @connection_required
+    def send_audio_data(self, number, data, name, lane=None):
+        """
+        Send audio message from content in memory, uploaded in chunks without temporary files
+        :param str number: phone number with cc (country code)
+        :param bytes data: audio content
+        :param str name: audio file name, used to guess mimetype
+        """
+        return self._send_media_path(number, BytesSource(data, name), RequestUploadIqProtocolEntity.MEDIA_TYPE_AUDIO,
+                                     lane=lane)
+
+    @failures_counted("location")
+    @in_loop
+    @buffered_while_reconnecting
     @connection_required
     def send_location(self, number, name, url, latitude, longitude):
         """
@@ -201,9 +761,12 @@ class CeleryLayer(YowInterfaceLayer):
         """
         location_message = LocationMediaMessageProtocolEntity(latitude, longitude, name, url, encoding="raw", 
                                                               to=self.normalize_jid(number))
-        self.toLower(location_message)
+        self.paced_to_lower(location_message)
         return location_message
     
+    @failures_counted("vcard")
+    @in_loop
+    @buffered_while_reconnecting
     @connection_required
     def send_vcard(self, number, name, data):
         """
@@ -220,5 +783,5 @@ class CeleryLayer(YowInterfaceLayer):
         END:VCARD
         """
         vcard_message = VCardMediaMessageProtocolEntity(name, data, to=self.normalize_jid(number))
-        self.toLower(vcard_message)
+        self.paced_to_lower(vcard_message)
         return vcard_message
\ No newline at end of file
@@ -1,4 +1,8 @@
 from yowsup.layers import YowLayerInterface
+from yowsup_celery.ratelimit import RateLimiter
+from yowsup_celery.utils import WorkerPool, TTLCache
+from yowsup_celery.media import ResumableUploads
+from yowsup_celery.inbound import InboundDispatcher
 
 
 class CeleryLayerInterface(YowLayerInterface):
@@ -9,20 +13,118 @@ class CeleryLayerInterface(YowLayerInterface):
     def disconnect(self):
         return self._layer.disconnect()
     
-    def send_message(self, number, content):
-        return self._layer.send_message(number, content)
+    def send_message(self, number, content, lane=None):
+        return self._layer.send_message(number, content, lane=lane)
     
-    def send_image(self, number, path):
-        return self._layer.send_image(number, path)
+    def send_messages(self, messages, lane=None):
+        return self._layer.send_messages(messages, lane=lane)
     
-    def send_audio(self, number, path):
-        return self._layer.send_audio(number, path)
+    def send_image(self, number, path, lane=None):
+        return self._layer.send_image(number, path, lane=lane)
     
-    def send_location(self, number, name, url, latitude, longitude):
-        return self._layer.send_location(number, name, url, latitude, longitude)
+    def send_audio(self, number, path, lane=None):
+        return self._layer.send_audio(number, path, lane=lane)
     
-    def send_vcard(self, number, name, data):
-        return self._layer.send_vcard(number, name, data)
+    def send_image_data(self, number, data, name, caption=None, lane=None):
+        return self._layer.send_image_data(number, data, name, caption, lane=lane)
+
+    def send_audio_data(self, number, data, name, lane=None):
+        return self._layer.send_audio_data(number, data, name, lane=lane)
+    
+    def send_location(self, number, name, url, latitude, longitude, lane=None):
+        return self._layer.send_location(number, name, url, latitude, longitude, lane=lane)
+    
+    def send_vcard(self, number, name, data, lane=None):
+        return self._layer.send_vcard(number, name, data, lane=lane)
 
     def connected(self):
         return self._layer.connected
+
+    def reconnecting(self):
+        return self._layer.reconnecting
+
+    def reconnect_enabled(self):
+        return self._layer.reconnect
+
+    def set_reconnect(self, reconnect):
+        self._layer.reconnect = reconnect
+
+    def stop_reconnect(self):
+        return self._layer.stop_reconnect()
+
+    def set_rate_limit(self, rate, recipient_rate=None):
+        self._layer.rate_limiter = RateLimiter(rate, recipient_rate)
+
+    def throttled(self):
+        return len(self._layer.throttled)
+
+    def rate_limit_delay(self):
+        return self._layer.rate_limiter.global_delay() if self._layer.rate_limiter else 0
+
+    def delivery(self, message_id):
+        return self._layer.ack_tracker.get(message_id)
+
+    def in_flight(self):
+        return self._layer.ack_tracker.in_flight()
+
+    def ack_latencies(self):
+        return self._layer.ack_tracker.ack_latencies()
+
+    def on_delivery(self, message_id, callback, event="ack"):
+        return self._layer.ack_tracker.add_callback(message_id, callback, event)
+
+    def wait_delivery(self, message_id, event="ack", timeout=None):
+        return self._layer.ack_tracker.wait(message_id, event, timeout)
+
+    def set_upload_pool(self, workers, max_pending=100):
+        self._layer.upload_pool = WorkerPool(workers, max_pending, name="upload")
+
+    def pending_uploads(self):
+        return self._layer.upload_pool.pending()
+
+    def set_media_cache(self, size, ttl=None):
+        self._layer.media_cache = TTLCache(size, ttl) if size else None
+
+    def set_media_metadata_cache(self, size):
+        self._layer.media_metadata = TTLCache(size) if size else None
+
+    def set_upload_retry(self, attempts, chunk_size=64 * 1024):
+        self._layer.uploads = ResumableUploads(attempts, chunk_size)
+
+    def set_inbound(self, sink, batch_size=100, window=1.0, workers=1):
+        self._layer.inbound = InboundDispatcher(sink, self._layer.call_later, batch_size, window, workers) \
+            if sink else None
+
+    def flush_inbound(self):
+        if self._layer.inbound:
+            self._layer.inbound.flush()
+
+    def set_metrics(self, metrics, account=None):
+        """
+        :param MetricsRegistry metrics: registry to record metrics, None to disable them
+        :param str account: value of account label of metrics recorded
+        """
+        self._layer.metrics = metrics
+        self._layer.metric_labels = {"account": account} if account else {}
+
+    def set_ping(self, interval, pong_timeout=None):
+        """
+        :param float interval: secs between keep alive pings sent by the loop, 0 or None to not send them
+        :param float pong_timeout: secs to wait for each ping answer before disconnecting, interval if None
+        """
+        self._layer.ping_interval = interval
+        self._layer.pong_timeout = pong_timeout
+
+    def set_loop_runner(self, loop_runner, loop_checker=None):
+        """
+        :param loop_runner: callable(fn, lane) executing sends in the loop, None to execute them in the caller thread
+        :param loop_checker: callable returning True when called from the loop thread
+        """
+        self._layer.loop_runner = loop_runner
+        self._layer.loop_checker = loop_checker
+
+    def set_tracer(self, tracer):
+        """
+        :param Tracer tracer: tracer timing protocol entity callbacks, None to disable it
+        """
+        self._layer.tracer = tracer
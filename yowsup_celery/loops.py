@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import sys
+import asyncore
+import threading
+import six
+from yowsup_celery.exceptions import ConfigurationError
+
+
+class AsyncoreBackend(object):
+    """
+    Poll sockets with asyncore loop, select based
+    """
+    name = "asyncore"
+
+    def __init__(self):
+        self.socket_map = asyncore.socket_map
+
+    def poll(self, timeout, count=None):
+        asyncore.loop(timeout, map=self.socket_map, count=count)
+
+    def close(self):
+        pass
+
+
+def spawn_thread(fn, *args, **kwargs):
+    """
+    Run fn in a new daemon thread
+    :returns: thread
+    """
+    thread = threading.Thread(target=fn, args=args, kwargs=kwargs, name="yowsup-loop")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class AsyncioBackend(object):
+    """
+    Poll asyncore dispatchers, as yowsup network layer, with an asyncio event loop. asyncio uses the
+    best selector of the platform, epoll on Linux and kqueue on BSD, instead of select.
+
+    Dispatchers are registered as readers and writers of the event loop according to their
+    readable and writable state before each poll.
+
+    :ivar dict readers: dispatchers registered as readers by file descriptor
+    :ivar dict writers: dispatchers registered as writers by file descriptor
+    """
+    name = "asyncio"
+
+    def __init__(self, socket_map=None):
+        """
+        :param dict socket_map: asyncore map of dispatchers, asyncore global map by default
+        """
+        try:
+            import asyncio
+        except ImportError:
+            raise ConfigurationError("asyncio loop needs Python 3.4 or newer")
+        self.loop = asyncio.new_event_loop()
+        self.socket_map = socket_map if socket_map is not None else asyncore.socket_map
+        self.readers = {}
+        self.writers = {}
+        self._exc_info = None
+
+    def _handle(self, handler, fd, obj):
+        if self.socket_map.get(fd) is not obj:
+            # closed while handling other events
+            return
+        try:
+            handler(obj)
+        except BaseException:
+            # raised from poll instead of being logged by asyncio
+            self._exc_info = sys.exc_info()
+        self.loop.stop()
+
+    def _watch(self, registered, add, remove, handler, fd, obj, wanted):
+        if registered.get(fd) is obj:
+            if not wanted:
+                remove(fd)
+                del registered[fd]
+        elif wanted:
+            add(fd, self._handle, handler, fd, obj)
+            registered[fd] = obj
+
+    def _sync(self):
+        for registered, remove in ((self.readers, self.loop.remove_reader), (self.writers, self.loop.remove_writer)):
+            for fd, obj in list(registered.items()):
+                # closed dispatchers or file descriptor reused by other dispatcher
+                if self.socket_map.get(fd) is not obj:
+                    remove(fd)
+                    del registered[fd]
+        for fd, obj in list(self.socket_map.items()):
+            self._watch(self.readers, self.loop.add_reader, self.loop.remove_reader, asyncore.read, fd, obj,
+                        obj.readable())
+            self._watch(self.writers, self.loop.add_writer, self.loop.remove_writer, asyncore.write, fd, obj,
+                        obj.writable())
+
+    def poll(self, timeout, count=None):
+        """
+        Wait at most timeout secs for socket events and handle the first ones ready
+        """
+        self._sync()
+        timer = self.loop.call_later(timeout, self.loop.stop)
+        try:
+            self.loop.run_forever()
+        finally:
+            timer.cancel()
+        if self._exc_info:
+            exc_info, self._exc_info = self._exc_info, None
+            six.reraise(*exc_info)
+
+    def close(self):
+        for fd in list(self.readers):
+            self.loop.remove_reader(fd)
+        for fd in list(self.writers):
+            self.loop.remove_writer(fd)
+        self.readers.clear()
+        self.writers.clear()
+        self.loop.close()
+
+
+class GeventBackend(object):
+    """
+    Poll asyncore dispatchers with gevent select, yielding to other greenlets while waiting even if
+    select is not monkey patched. Used with gevent worker pool, the loop runs in its own greenlet
+    instead of occupying a slot of the pool.
+    """
+    name = "gevent"
+
+    def __init__(self, socket_map=None):
+        """
+        :param dict socket_map: asyncore map of dispatchers, asyncore global map by default
+        """
+        try:
+            import gevent.select
+        except ImportError:
+            raise ConfigurationError("gevent loop needs gevent installed")
+        self.select = gevent.select.select
+        self.socket_map = socket_map if socket_map is not None else asyncore.socket_map
+
+    @staticmethod
+    def spawn(fn, *args, **kwargs):
+        """
+        Run fn in a new greenlet
+        :returns: greenlet
+        """
+        import gevent
+        return gevent.spawn(fn, *args, **kwargs)
+
+    def poll(self, timeout, count=None):
+        """
+        Wait at most timeout secs for socket events and handle the ones ready, as asyncore poll
+        """
+        readers = []
+        writers = []
+        for fd, obj in list(self.socket_map.items()):
+            if obj.readable():
+                readers.append(fd)
+            if obj.writable() and not obj.accepting:
+                writers.append(fd)
+        if not readers and not writers:
+            import gevent
+            gevent.sleep(timeout)
+            return
+        readers, writers, _ = self.select(readers, writers, [], timeout)
+        for fd, handler in [(fd, asyncore.read) for fd in readers] + [(fd, asyncore.write) for fd in writers]:
+            obj = self.socket_map.get(fd)
+            if obj is not None:
+                handler(obj)
+
+    def close(self):
+        pass
+
+
+BACKENDS = {
+    AsyncoreBackend.name: AsyncoreBackend,
+    AsyncioBackend.name: AsyncioBackend,
+    GeventBackend.name: GeventBackend,
+}
+
+
+def get_backend_class(name=None):
+    """
+    :param str name: asyncore, asyncio or gevent, None for asyncore
+    """
+    try:
+        return BACKENDS[name or AsyncoreBackend.name]
+    except KeyError:
+        raise ConfigurationError("Unknown loop %s, options are %s" % (name, ", ".join(sorted(BACKENDS))))
+
+
+def get_backend(name=None):
+    """
+    :param str name: asyncore, asyncio or gevent, None for asyncore
+    :returns: new loop backend instance
+    """
+    return get_backend_class(name)()
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import ssl
+import time
+import base64
+import socket
+import hashlib
+import logging
+import mimetypes
+from yowsup_celery.utils import ExponentialBackoff, TTLCache
+from yowsup.common.constants import YowConstants
+from yowsup.common.tools import ModuleTools
+from yowsup.common.http.warequest import WARequest
+from yowsup.common.http.waresponseparser import JSONResponseParser
+from yowsup.layers.protocol_media.protocolentities.message_media_downloadable_image import \
+    ImageDownloadableMediaMessageProtocolEntity
+from yowsup.layers.protocol_media.protocolentities.message_media_downloadable_audio import \
+    AudioDownloadableMediaMessageProtocolEntity
+
+logger = logging.getLogger(__name__)
+
+
+class MediaSource(object):
+    """
+    Media content to be uploaded and sent, read in chunks so memory stays bounded for large files.
+    Subclasses provide size and open
+
+    :ivar str name: file name, used to guess mimetype
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, name):
+        self.name = name
+        self._hash = None
+
+    @property
+    def size(self):
+        raise NotImplementedError
+
+    @property
+    def mimetype(self):
+        return mimetypes.guess_type(self.name)[0]
+
+    def open(self):
+        """
+        :returns: binary file-like object positioned at the start of content
+        """
+        raise NotImplementedError
+
+    def chunks(self, offset=0, chunk_size=None):
+        """
+        Iterate content from offset in chunks of at most chunk_size bytes
+        """
+        chunk_size = chunk_size or self.chunk_size
+        f = self.open()
+        try:
+            if offset:
+                f.seek(offset)
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+
+    def hash(self):
+        """
+        Base64 sha256 of content, as expected by request upload. Computed once
+        """
+        if self._hash is None:
+            sha = hashlib.sha256()
+            for chunk in self.chunks():
+                sha.update(chunk)
+            self._hash = base64.b64encode(sha.digest()).decode()
+        return self._hash
+
+    def __str__(self):
+        return self.name
+
+
+class FileSource(MediaSource):
+    """
+    Media read from a local file
+    """
+
+    def __init__(self, path):
+        super(FileSource, self).__init__(os.path.basename(path))
+        self.path = path
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def __str__(self):
+        return self.path
+
+
+class BytesSource(MediaSource):
+    """
+    Media held in memory
+    """
+
+    def __init__(self, data, name):
+        """
+        :param bytes data: media content
+        :param str name: file name, used to guess mimetype
+        """
+        super(BytesSource, self).__init__(name)
+        self.data = data
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def open(self):
+        return io.BytesIO(self.data)
+
+
+def image_properties(source):
+    """
+    Preview and dimensions of an image source without writing temporary files
+    :returns: (jpeg preview, (width, height)), (None, None) if PIL is not installed
+    """
+    if not ModuleTools.INSTALLED_PIL():
+        logger.warning("Python PIL library not installed")
+        return None, None
+    from PIL import Image
+    f = source.open()
+    try:
+        image = Image.open(f)
+        dimensions = image.size
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((YowConstants.PREVIEW_WIDTH, YowConstants.PREVIEW_HEIGHT))
+        preview = io.BytesIO()
+        image.save(preview, "JPEG")
+    finally:
+        f.close()
+    return preview.getvalue(), dimensions
+
+
+def media_message_from_source(media_type, source, url, ip, to, caption=None):
+    """
+    Image or audio message entity for a media source, equivalent to entity fromFilePath
+    """
+    if media_type == "audio":
+        entity = AudioDownloadableMediaMessageProtocolEntity(source.mimetype, source.hash(), url, ip, source.size,
+                                                             source.name, None, None, None, None, None, None,
+                                                             None, to=to)
+        return entity
+    preview, dimensions = image_properties(source)
+    assert dimensions, "Could not determine image dimensions"
+    width, height = dimensions
+    return ImageDownloadableMediaMessageProtocolEntity(source.mimetype, source.hash(), url, ip, source.size,
+                                                       source.name, "raw", width, height, caption, to=to,
+                                                       preview=preview)
+
+
+class StreamUploader(WARequest):
+    """
+    Upload a media source to WhatsApp media server streaming it in chunks, instead of reading
+    the whole file in memory. Same protocol as yowsup MediaUploader, executed synchronously.
+
+    :ivar int sent: bytes of content written, including resume offset
+    """
+
+    boundary = "zzXXzzYYzzXXzzQQ"
+
+    def __init__(self, jid, account_jid, source, upload_url, progress_fn=None, chunk_size=None, resume_offset=0):
+        """
+        :param MediaSource source: content to upload
+        :param progress_fn: called with source, jid, upload url and percentage uploaded
+        :param int chunk_size: bytes written per socket write, source default if None
+        :param int resume_offset: bytes already uploaded, content is sent from this offset
+        """
+        WARequest.__init__(self)
+        self.jid = jid
+        self.account_jid = account_jid
+        self.source = source
+        self.upload_url = upload_url
+        self.progress_fn = progress_fn
+        self.chunk_size = chunk_size or source.chunk_size
+        self.resume_offset = resume_offset or 0
+        self.sent = self.resume_offset
+        self.setParser(JSONResponseParser())
+
+    def connect(self, host):
+        sock = socket.create_connection((host, self.port))
+        return ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+
+    def request_head(self, host, content_length):
+        name_hash = hashlib.md5(self.source.name.encode()).hexdigest()
+        filename = name_hash + os.path.splitext(self.source.name)[1]
+        part = "--%s\r\n" % self.boundary
+        part += "Content-Disposition: form-data; name=\"to\"\r\n\r\n%s\r\n" % self.jid
+        part += "--%s\r\n" % self.boundary
+        part += "Content-Disposition: form-data; name=\"from\"\r\n\r\n%s\r\n" % \
+            self.account_jid.replace("@whatsapp.net", "")
+        part += "--%s\r\n" % self.boundary
+        part += "Content-Disposition: form-data; name=\"file\"; filename=\"%s\"\r\n" % filename
+        part += "Content-Type: %s\r\n\r\n" % self.source.mimetype
+        footer = "\r\n--%s--\r\n" % self.boundary
+        request = "POST %s\r\n" % self.upload_url
+        request += "Content-Type: multipart/form-data; boundary=%s\r\n" % self.boundary
+        request += "Host: %s\r\n" % host
+        request += "User-Agent: %s\r\n" % self.getUserAgent()
+        if self.resume_offset:
+            size = self.source.size
+            request += "Content-Range: bytes %d-%d/%d\r\n" % (self.resume_offset, size - 1, size)
+        request += "Content-Length: %d\r\n\r\n" % (len(part) + len(footer) + content_length)
+        return request.encode(), part.encode(), footer.encode()
+
+    def read_response(self, sock):
+        data = b""
+        while True:
+            chunk = sock.recv(8192)
+            if not chunk:
+                break
+            data += chunk
+            if b"\r\n\r\n" in data and data.rstrip().endswith(b"}"):
+                break
+        for line in data.decode().splitlines():
+            if line.startswith("{"):
+                return self.parser.parse(line, ["name", "type", "size", "url", "error", "mimetype", "filehash",
+                                                "width", "height"])
+        return None
+
+    def upload(self):
+        """
+        Upload content from resume offset
+        :returns: media url
+        :raises: Exception when upload fails
+        """
+        host = self.upload_url.replace("https://", "").split("/", 1)[0]
+        size = self.source.size
+        request, part, footer = self.request_head(host, size - self.resume_offset)
+        sock = self.connect(host)
+        try:
+            sock.sendall(request)
+            sock.sendall(part)
+            last_progress = None
+            for chunk in self.source.chunks(self.resume_offset, self.chunk_size):
+                sock.sendall(chunk)
+                self.sent += len(chunk)
+                progress = int(self.sent * 100 / size) if size else 100
+                if self.progress_fn and progress != last_progress:
+                    self.progress_fn(self.source, self.jid, self.upload_url, progress)
+                last_progress = progress
+            sock.sendall(footer)
+            result = self.read_response(sock)
+        finally:
+            sock.close()
+        if not result or not result.get("url"):
+            raise Exception("Upload to %s has no media url in response" % self.upload_url)
+        return result["url"]
+
+
+class ResumableUploads(object):
+    """
+    Upload media sources retrying failed uploads from the offset confirmed by the media server, in
+    fixed size chunks, instead of starting again from the first byte. Bytes written by the client are
+    not confirmed, they only bound the offset asked to the server.
+
+    :ivar TTLCache progress: confirmed bytes uploaded by (content hash, upload url) of failed uploads
+    """
+
+    def __init__(self, attempts=3, chunk_size=64 * 1024, retry_delay=1, max_retry_delay=10, max_size=1000,
+                 ttl=3600):
+        """
+        :param int attempts: max upload attempts for each media
+        :param int chunk_size: bytes written per socket write
+        :param float retry_delay: secs to wait before first retry, growing exponentially
+        :param float max_retry_delay: max secs to wait between attempts
+        :param int max_size: max failed uploads tracked
+        :param float ttl: secs to keep progress of failed uploads
+        """
+        self.attempts = attempts
+        self.chunk_size = chunk_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.progress = TTLCache(max_size, ttl)
+
+    def offset(self, source, upload_url, resume_offset=0, content_hash=None):
+        """
+        Offset to upload source from, the greatest of server resume offset and recorded progress
+        :param str content_hash: base64 sha256 of source, computed from content if None
+        """
+        key = (content_hash or source.hash(), upload_url)
+        return max(resume_offset or 0, self.progress.get(key, 0))
+
+    def confirmed_offset(self, sent, resume_offset_fn=None):
+        """
+        Offset to resume a failed upload from
+        :param int sent: bytes written by the client, upper bound of the offset
+        :param resume_offset_fn: returns bytes received by the server, None to upload from first byte
+        """
+        if resume_offset_fn is None:
+            return 0
+        try:
+            server_offset = int(resume_offset_fn() or 0)
+        except Exception:
+            logger.exception("Error requesting resume offset")
+            return 0
+        if server_offset > sent:
+            logger.warning("Server resume offset %d beyond %d bytes sent, uploading from first byte" %
+                           (server_offset, sent))
+            return 0
+        return server_offset
+
+    def upload(self, jid, account_jid, source, upload_url, resume_offset=0, success_fn=None, error_fn=None,
+               progress_fn=None, resume_offset_fn=None, content_hash=None):
+        """
+        Upload source, blocking until it is uploaded or all attempts failed
+        :param int resume_offset: bytes already uploaded reported by server
+        :param resume_offset_fn: called after a failed attempt, returns bytes received by the server
+        :param str content_hash: base64 sha256 of source already sent in request upload, so content is not
+            read again to key progress. Computed from content if None
+        """
+        content_hash = content_hash or source.hash()
+        key = (content_hash, upload_url)
+        offset = self.offset(source, upload_url, resume_offset, content_hash)
+        backoff = ExponentialBackoff(self.retry_delay, self.max_retry_delay)
+        for attempt in range(1, self.attempts + 1):
+            uploader = StreamUploader(jid, account_jid, source, upload_url, progress_fn=progress_fn,
+                                      chunk_size=self.chunk_size, resume_offset=offset)
+            try:
+                url = uploader.upload()
+            except Exception:
+                logger.exception("Upload attempt %d of %s to %s failed at %d bytes" %
+                                 (attempt, source, upload_url, uploader.sent))
+                # sent counts bytes written to the socket, not received by the server
+                offset = self.confirmed_offset(uploader.sent, resume_offset_fn)
+                self.progress.set(key, offset)
+                if attempt < self.attempts:
+                    time.sleep(backoff.next())
+                continue
+            self.progress.pop(key)
+            if success_fn:
+                success_fn(source, jid, url)
+            return url
+        if error_fn:
+            error_fn(source, jid, upload_url)
+        return None
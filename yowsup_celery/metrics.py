@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    "messages_sent_total": "Messages sent by type",
+    "messages_acked_total": "Sent messages acked by server by type",
+    "messages_failed_total": "Messages failed to be sent by type",
+    "detached_queue_depth": "Callbacks waiting in detached queue by lane",
+    "loop_iteration_seconds": "Duration of loop iterations, polling included",
+    "loop_heartbeat_timestamp_seconds": "Unix time of last loop iteration",
+    "reconnects_total": "Reconnection attempts",
+    "upload_bytes_total": "Media bytes uploaded",
+    "upload_seconds": "Duration of media uploads",
+    "stage_seconds": "Duration of entity stages through layers by stage and entity tag",
+}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    return "{%s}" % ",".join("%s=\"%s\"" % (name, _escape(value)) for name, value in items)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(object):
+    """
+    Metric with values by labels
+
+    :ivar str name: full name, with registry prefix
+    :ivar dict values: value by sorted labels
+    """
+    type = None
+
+    def __init__(self, name, help=None):
+        self.name = name
+        self.help = help or name
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """
+        :returns: list of (name, labels key, value) to render
+        """
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for name, key, value in self.samples():
+            lines.append("%s%s %s" % (name, _format_labels(key), _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def get(self, **labels):
+        return self.values.get(_label_key(labels), 0)
+
+
+class Gauge(Metric):
+    """
+    Gauge with values set or computed by a function when rendered
+    """
+    type = "gauge"
+
+    def __init__(self, name, help=None):
+        super(Gauge, self).__init__(name, help)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[_label_key(labels)] = value
+
+    def set_function(self, fn, **labels):
+        """
+        :param fn: callable without arguments returning current value
+        """
+        with self._lock:
+            self.functions[_label_key(labels)] = fn
+
+    def get(self, **labels):
+        key = _label_key(labels)
+        fn = self.functions.get(key)
+        return fn() if fn else self.values.get(key)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+        for key, fn in functions.items():
+            try:
+                values[key] = fn()
+            except Exception:
+                logger.exception("Error computing gauge %s" % self.name)
+        return [(self.name, key, value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """
+    Histogram of observations with cumulative buckets, sum and count by labels
+    """
+    type = "histogram"
+
+    def __init__(self, name, help=None, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts["buckets"][i] += 1
+                    break
+            counts["sum"] += value
+            counts["count"] += 1
+
+    def get(self, **labels):
+        """
+        :returns: (count, sum) of observations
+        """
+        counts = self.values.get(_label_key(labels))
+        return (counts["count"], counts["sum"]) if counts else (0, 0)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts["buckets"]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    samples.append((self.name + "_bucket", key + (("le", le),), cumulative))
+                samples.append((self.name + "_sum", key, counts["sum"]))
+                samples.append((self.name + "_count", key, counts["count"]))
+        return samples
+
+
+class MetricsRegistry(object):
+    """
+    Counters, gauges and histograms created on first use and rendered in Prometheus text format.
+    Any object with the same counter, gauge and histogram methods, returning metrics with inc, set,
+    set_function and observe, can be used instead, e.g. an adapter to prometheus_client
+
+    :ivar str prefix: prefix of metric names
+    :ivar dict metrics: metrics by name without prefix
+    """
+
+    def __init__(self, prefix="yowsup_"):
+        self.prefix = prefix
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.get(name)
+                if metric is None:
+                    metric = self.metrics[name] = cls(self.prefix + name, HELP.get(name), **kwargs)
+        return metric
+
+    def counter(self, name):
+        return self._get(Counter, name)
+
+    def gauge(self, name):
+        return self._get(Gauge, name)
+
+    def histogram(self, name, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, buckets=buckets)
+
+    def render(self):
+        """
+        :returns: all metrics in Prometheus text exposition format
+        """
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class MetricsExporter(HTTPServer):
+    """
+    HTTP server exposing registry metrics in a daemon thread, for any path
+    """
+
+    def __init__(self, registry, port, address="127.0.0.1"):
+        HTTPServer.__init__(self, (address, port), MetricsHandler)
+        self.registry = registry
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="yowsup-metrics")
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("Metrics exported on http://%s:%d/metrics" % self.server_address[:2])
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
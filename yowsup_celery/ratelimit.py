@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled at a constant rate
+
+    :ivar float rate: tokens added per second
+    :ivar float capacity: max tokens stored, size of allowed bursts
+    :ivar float tokens: available tokens
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(max(capacity if capacity is not None else rate, 1))
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def delay(self):
+        """
+        Secs to wait until a token is available, 0 if available now
+        """
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class RateLimiter(object):
+    """
+    Global and per recipient token buckets to pace outgoing messages
+
+    :ivar TokenBucket bucket: global bucket, None for no global limit
+    :ivar OrderedDict recipient_buckets: per recipient buckets, least recently used first
+    """
+
+    def __init__(self, rate=None, recipient_rate=None, burst=None, recipient_burst=None, max_recipients=10000):
+        """
+        :param float rate: max messages per second, None for no global limit
+        :param float recipient_rate: max messages per second to the same recipient, None for no limit
+        :param int burst: max messages sent at once, rate by default
+        :param int recipient_burst: max messages sent at once to the same recipient, recipient_rate by default
+        :param int max_recipients: max per recipient buckets kept
+        """
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.max_recipients = max_recipients
+        self.recipient_buckets = OrderedDict()
+
+    def _recipient_bucket(self, recipient):
+        bucket = self.recipient_buckets.pop(recipient, None)
+        if bucket is None:
+            bucket = TokenBucket(self.recipient_rate, self.recipient_burst)
+            if len(self.recipient_buckets) >= self.max_recipients:
+                self.recipient_buckets.popitem(last=False)
+        self.recipient_buckets[recipient] = bucket
+        return bucket
+
+    def global_delay(self):
+        """
+        Secs to wait until global limit allows to send, 0 if allowed now
+        """
+        return self.bucket.delay() if self.bucket else 0
+
+    def acquire(self, recipient):
+        """
+        Consume a token to send to recipient if both limits allow it
+        :returns: 0 if token was consumed, otherwise secs to wait
+        """
+        delay = self.global_delay()
+        recipient_bucket = self._recipient_bucket(recipient) if self.recipient_rate else None
+        if recipient_bucket:
+            delay = max(delay, recipient_bucket.delay())
+        if delay:
+            return delay
+        if self.bucket:
+            self.bucket.consume()
+        if recipient_bucket:
+            recipient_bucket.consume()
+        return 0
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+from yowsup_celery.stack import run_loop
+from yowsup_celery.exceptions import ConfigurationError
+
+
+class StackRegistry(object):
+    """
+    Stacks of several accounts hosted in the same worker sharing one event loop. Looping any of
+    them loops all of them.
+
+    :ivar OrderedDict stacks: stacks by account phone number, first one is the default
+    :ivar bool listen_requested: loop start requested but not listening yet
+    """
+
+    def __init__(self, stacks=()):
+        self.stacks = OrderedDict()
+        self.listen_requested = False
+        self._listen_lock = threading.Lock()
+        for stack in stacks:
+            self.add(stack)
+
+    def add(self, stack):
+        if stack.account in self.stacks:
+            raise ConfigurationError("Account %s already configured" % stack.account)
+        stack.registry = self
+        self.stacks[stack.account] = stack
+
+    def get(self, account=None):
+        """
+        :param str account: phone number, None for default account
+        """
+        if account is None:
+            return self.default
+        try:
+            return self.stacks[account]
+        except KeyError:
+            raise ConfigurationError("Account %s not configured" % account)
+
+    @property
+    def default(self):
+        return next(iter(self.stacks.values()))
+
+    def accounts(self):
+        return list(self.stacks.keys())
+
+    def __iter__(self):
+        return iter(list(self.stacks.values()))
+
+    def __len__(self):
+        return len(self.stacks)
+
+    @property
+    def listening(self):
+        return any(stack.listening for stack in self.stacks.values())
+
+    def request_listen(self):
+        """
+        Single flight start of the shared loop
+        :returns: True only for the first caller requesting the loop start since it was stopped
+        """
+        with self._listen_lock:
+            if self.listening or self.listen_requested:
+                return False
+            self.listen_requested = True
+            return True
+
+    def cancel_listen_request(self):
+        with self._listen_lock:
+            self.listen_requested = False
+
+    def spawn_loop(self, **kwargs):
+        """
+        Run the shared loop in the worker process. See :meth:`yowsup_celery.stack.YowsupStack.spawn_loop`
+        """
+        return self.default.spawn_loop(**kwargs)
+
+    def wait_listening(self, timeout=None):
+        """
+        Block until any stack is listening, stacks failing authentication stop listening while the loop
+        keeps serving the other ones
+        :param float timeout: max secs to wait
+        :returns: True if listening
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while not self.listening:
+            remaining = deadline - time.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                return False
+            self.default.listening_event.wait(min(remaining, 0.05) if remaining is not None else 0.05)
+        return True
+
+    def asynloop(self, auto_connect=False, timeout=10, detached_delay=0.2, batch_size=None, persistent=None):
+        """
+        Loop all stacks. See :meth:`yowsup_celery.stack.YowsupStack.asynloop`
+        :param bool persistent: None to loop persistently if any stack is persistent
+        """
+        stacks = list(self.stacks.values())
+        if persistent is None:
+            persistent = any(stack.persistent for stack in stacks)
+        return run_loop(stacks, auto_connect, timeout, detached_delay, batch_size, persistent)
+
+    def stop(self):
+        for stack in self.stacks.values():
+            stack.stop()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from yowsup_celery.utils import TTLCache
+
+AUTO_ACCOUNT = "auto"
+
+
+class AccountRouter(object):
+    """
+    Choose the sending account for each recipient among the stacks of a registry. Recipients stay
+    on the account first chosen for them while it is healthy, new recipients go to the least loaded
+    healthy account.
+
+    :ivar StackRegistry registry: stacks to choose from
+    :ivar TTLCache sticky: account chosen by recipient
+    """
+
+    def __init__(self, registry, max_recipients=100000, ttl=None):
+        """
+        :param int max_recipients: max recipients remembered
+        :param float ttl: secs to remember account chosen for a recipient, None to remember it until evicted
+        """
+        self.registry = registry
+        self.sticky = TTLCache(max_recipients, ttl)
+
+    def healthy(self, stack):
+        return stack.facade.connected()
+
+    def load(self, stack):
+        """
+        Sort key of stacks by load, accounts waiting for rate limit last, then by messages sent
+        without ack and waiting for rate limit
+        """
+        facade = stack.facade
+        return facade.rate_limit_delay() > 0, facade.in_flight() + facade.throttled()
+
+    def route(self, recipient):
+        """
+        :param str recipient: phone number or jid
+        :returns: stack to send to recipient. When no account is connected accounts reconnecting are
+            chosen, and default account if none is reconnecting
+        """
+        stack = self.registry.stacks.get(self.sticky.get(recipient))
+        if stack is not None and self.healthy(stack):
+            return stack
+        stacks = list(self.registry)
+        candidates = [s for s in stacks if self.healthy(s)] or [s for s in stacks if s.facade.reconnecting()]
+        if not candidates:
+            return self.registry.default
+        stack = min(candidates, key=self.load)
+        self.sticky.set(recipient, stack.account)
+        return stack
@@ -1,14 +1,22 @@
 import asyncore
+import heapq
+import itertools
+import socket
+import threading
 import time
 import logging
+import select
 import sys
 import traceback
 from yowsup import stacks
 from yowsup_celery.layer import CeleryLayer
 from yowsup_celery import exceptions
+from yowsup_celery.loops import get_backend, get_backend_class
+from yowsup_celery.detached import DetachedQueue, LoopCall, LANES, CONTROL_LANE, TRANSACTIONAL_LANE
 from yowsup.layers import YowLayerEvent
 from yowsup.layers.auth import AuthError
 from yowsup.layers.network import YowNetworkLayer
+from yowsup.layers.protocol_iq import YowIqProtocolLayer
 try:
     import Queue
 except ImportError:
@@ -16,22 +24,114 @@ except ImportError:
     
 logger = logging.getLogger(__name__)
 
+# Yowsup iq layer default
+DEFAULT_PING_INTERVAL = 50
+
+
+class DetachedWakeup(asyncore.dispatcher):
+    """
+    Socket pair watched by asyncore to interrupt the loop select as soon as a callback is
+    queued in the detached queue
+    """
+
+    def __init__(self):
+        reader, self.writer = socket.socketpair()
+        self.writer.setblocking(False)
+        asyncore.dispatcher.__init__(self, reader)
+
+    def wake(self):
+        try:
+            self.writer.send(b'x')
+        except socket.error:
+            # buffer full (loop already pending to wake up) or wakeup closed
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.writer.close()
+
+
 class YowsupStack(stacks.YowStack):
     """
     Gateway for Yowsup in a client API way
     
     :ivar bool listening: asyncore loop task in execution
-    :ivar Queue detached_queue: Queue with callbacks to execute after
+    :ivar DetachedQueue detached_queue: callbacks to be executed by the loop, in priority lanes. When loop
+        finishes calls waited by other threads are cancelled, other callbacks are kept for next loop
     :ivar YowLayerInterface facade:layer interface on top of stack
     disconnection
+    :ivar float detached_timeout: max secs a call from other thread waits for room in detached queue and then
+        for the loop to execute it
+    :ivar Thread loop_thread: thread running the loop while listening
+    :ivar float drain_timeout: max secs the loop keeps executing queued callbacks and writing their data
+        before disconnecting when it finishes
+    :ivar DetachedWakeup wakeup: socket pair to wake up the loop when listening
+    :ivar bool persistent: loop keeps connection alive until stop is requested
+    :ivar bool stopping: stop requested to the loop
+    :ivar list timers: heap of (deadline, seq, callback) to be executed by the loop, kept when loop
+        finishes to be executed by next loop
+    :ivar Event listening_event: set while loop is listening
+    :ivar bool listen_requested: loop start requested but not listening yet
+    :ivar str account: phone number of the account
+    :ivar StackRegistry registry: registry sharing its loop with this stack, None if stack loops alone
+    :ivar str loop_backend: name of backend polling sockets, see :mod:`yowsup_celery.loops`
+    :ivar MetricsRegistry metrics: registry recording stack and layer metrics, None if disabled
+    :ivar Tracer tracer: tracer of entities through :class:`yowsup_celery.tracing.TracingLayer` and
+        CeleryLayer callbacks, None if disabled
+    :ivar AuthError auth_error: authentication error removing the stack from last loop, None if it did not fail
     """
     
-    def __init__(self, credentials, encryption=False, top_layers=None):
+    def __init__(self, credentials, encryption=False, top_layers=None, persistent=False, ping_interval=None,
+                 reconnect=False, rate_limit=None, recipient_rate_limit=None, upload_workers=None,
+                 upload_queue=100, media_cache=None, media_cache_ttl=24 * 3600,
+                 media_metadata_cache=None, upload_attempts=None, upload_chunk_size=64 * 1024,
+                 inbound_sink=None, inbound_batch_size=100, inbound_window=1.0, loop_backend=None, metrics=None,
+                 tracer=None, detached_queue_size=10000, detached_queue_policy="block", detached_queue_timeout=30,
+                 drain_timeout=5, pong_timeout=None):
         """
         :param credentials: number and registed password
         :param bool encryptionEnabled:  E2E encryption enabled/ disabled
         :params top_layers: tuple of layer between :class:`yowsup_gateway.layer.CeleryLayer` 
         and Yowsup Core Layers  
+        :param bool persistent: asynloop connects and keeps connected until stop is requested instead
+            of finishing on timeout
+        :param int ping_interval: secs between keep alive pings sent by the loop, None for Yowsup default,
+            0 to disable them
+        :param bool reconnect: reconnect with backoff when connection is lost while looping
+        :param float rate_limit: max outgoing messages per second, None for no limit
+        :param float recipient_rate_limit: max outgoing messages per second to the same recipient,
+            None for no limit
+        :param int upload_workers: threads uploading media, None for CeleryLayer default
+        :param int upload_queue: max media sends pending of upload when upload_workers is set
+        :param int media_cache: max uploaded media urls kept to send same content without uploading it
+            again, 0 to disable cache, None for CeleryLayer default
+        :param float media_cache_ttl: secs to keep uploaded media urls when media_cache is set
+        :param int media_metadata_cache: max media files kept with hash, size and preview computed,
+            0 to disable cache, None for CeleryLayer default
+        :param int upload_attempts: max attempts for each media upload, retries resume from last offset
+            written. None for CeleryLayer default
+        :param int upload_chunk_size: bytes written per socket write when upload_attempts is set
+        :param inbound_sink: callable receiving batches of received messages and receipts as dicts,
+            None to not deliver them
+        :param int inbound_batch_size: max events per inbound batch
+        :param float inbound_window: max secs an inbound event waits for its batch to be delivered
+        :param str loop_backend: asyncore, asyncio or gevent, None for asyncore
+        :param MetricsRegistry metrics: registry to record metrics labeled by account, None to disable them
+        :param Tracer tracer: tracer timing entity stages, None to disable it
+        :param int detached_queue_size: max callbacks waiting in each lane of detached queue, 0 for unbounded
+        :param str detached_queue_policy: block, reject or shed_oldest when a lane is full,
+            see :class:`yowsup_celery.detached.DetachedQueue`
+        :param float detached_queue_timeout: max secs a send waits for room in detached queue and then for
+            the loop to execute it
+        :param float drain_timeout: max secs to execute queued callbacks and write their data before
+            disconnecting when loop finishes
+        :param float pong_timeout: secs to wait for a ping answer before disconnecting, ping_interval if None
         """
         top_layers = top_layers + (CeleryLayer,) if top_layers else (CeleryLayer,)
         layers = stacks.YowStackBuilder.getDefaultLayers(axolotl=encryption) + top_layers
@@ -40,51 +140,415 @@ class YowsupStack(stacks.YowStack):
         except ValueError as e:
             raise exceptions.ConfigurationError(e.args[0])
         self.setCredentials(credentials)
-        self.detached_queue = Queue.Queue()
+        self.account = credentials[0]
+        self.registry = None
+        self.detached_queue = DetachedQueue(detached_queue_size, detached_queue_policy, detached_queue_timeout)
+        self.detached_timeout = detached_queue_timeout
+        self.loop_thread = None
+        self.auth_error = None
+        self.drain_timeout = drain_timeout
         self.facade = self.getLayerInterface(CeleryLayer)
         self.listening = False
+        self.listening_event = threading.Event()
+        self.listen_requested = False
+        self._listen_lock = threading.Lock()
+        self.wakeup = None
+        self.persistent = persistent
+        self.loop_backend = loop_backend
+        self.metrics = None
+        self.tracer = tracer
+        self.stopping = False
+        self.timers = []
+        self._timers_lock = threading.Lock()
+        self._timers_seq = itertools.count()
+        # Yowsup ping thread writes out of the loop, pings are sent by loop timers instead
+        self.setProp(YowIqProtocolLayer.PROP_PING_INTERVAL, 0)
+        self.facade.set_ping(DEFAULT_PING_INTERVAL if ping_interval is None else ping_interval, pong_timeout)
+        self.facade.set_reconnect(reconnect)
+        self.facade.set_loop_runner(self.run_in_loop, self.in_loop_thread)
+        if rate_limit or recipient_rate_limit:
+            self.facade.set_rate_limit(rate_limit, recipient_rate_limit)
+        if upload_workers:
+            self.facade.set_upload_pool(upload_workers, upload_queue)
+        if media_cache is not None:
+            self.facade.set_media_cache(media_cache, media_cache_ttl)
+        if media_metadata_cache is not None:
+            self.facade.set_media_metadata_cache(media_metadata_cache)
+        if upload_attempts:
+            self.facade.set_upload_retry(upload_attempts, upload_chunk_size)
+        if inbound_sink:
+            self.facade.set_inbound(inbound_sink, inbound_batch_size, inbound_window)
+        if metrics is not None:
+            self.set_metrics(metrics)
+        if tracer is not None:
+            self.facade.set_tracer(tracer)
+
+    def set_metrics(self, metrics):
+        """
+        Record metrics of stack and its layer in registry, labeled by account
+        """
+        self.metrics = metrics
+        self.facade.set_metrics(metrics, self.account)
+        for lane in LANES:
+            metrics.gauge("detached_queue_depth").set_function(lambda lane=lane: self.detached_queue.depth(lane),
+                                                               account=self.account, lane=lane)
         
-    def execDetached(self, fn):
-        return self.detached_queue.put(fn)
-            
+    def execDetached(self, fn, lane=None):
+        """
+        Queue a callback to be executed by the loop
+        :param str lane: detached queue lane, control lane if None
+        :raises: QueueFullError when lane is full, according to detached queue policy
+        """
+        self.detached_queue.put(fn, lane)
+        wakeup = self.wakeup
+        if wakeup:
+            wakeup.wake()
+
+    def in_loop_thread(self):
+        """
+        :returns: True when called from the thread running the loop
+        """
+        return threading.current_thread() is self.loop_thread
+
+    def run_in_loop(self, fn, lane=None, timeout=None):
+        """
+        Execute fn in the loop, so only the loop writes to connections. Called from other thread while
+        listening, fn is queued in detached queue lane and the caller blocks until the loop executes it.
+        Otherwise fn is executed at once
+        :param str lane: detached queue lane, transactional if None
+        :param float timeout: max secs to wait, stack detached_timeout if None
+        :returns: fn result
+        :raises: QueueFullError when lane is full, LoopTimeoutError when loop did not execute it in time
+        """
+        if not self.listening or self.in_loop_thread():
+            return fn()
+        call = LoopCall(fn)
+        self.execDetached(call, lane or TRANSACTIONAL_LANE)
+        return call.wait(self.detached_timeout if timeout is None else timeout)
+
+    def request_listen(self):
+        """
+        Single flight start of the loop
+        :returns: True only for the first caller requesting the loop start since it was stopped
+        """
+        if self.registry is not None:
+            return self.registry.request_listen()
+        with self._listen_lock:
+            if self.listening or self.listen_requested:
+                return False
+            self.listen_requested = True
+            return True
+
+    def cancel_listen_request(self):
+        if self.registry is not None:
+            return self.registry.cancel_listen_request()
+        with self._listen_lock:
+            self.listen_requested = False
+
+    def wait_listening(self, timeout=None):
+        """
+        Block until loop is listening
+        :param float timeout: max secs to wait
+        :returns: True if listening
+        """
+        if self.listening:
+            return True
+        return self.listening_event.wait(timeout) and self.listening
+
+    def layers(self):
+        """
+        :returns: layer instances from bottom to top
+        """
+        layers = []
+        while True:
+            try:
+                layers.append(self.getLayer(len(layers)))
+            except IndexError:
+                return layers
+
+    def owns(self, obj):
+        """
+        :returns: True if obj is one of the layers of this stack, as its network dispatcher
+        """
+        return any(layer is obj for layer in self.layers())
+
+    def _open_wakeup(self):
+        if not hasattr(socket, 'socketpair'):
+            logger.warning("Socket pairs not supported, polling detached queue")
+            return None
+        return DetachedWakeup()
+
+    def call_later(self, delay, fn):
+        """
+        Schedule a callback to be executed by the loop after delay secs
+        """
+        with self._timers_lock:
+            heapq.heappush(self.timers, (time.time() + delay, next(self._timers_seq), fn))
+        wakeup = self.wakeup
+        if wakeup:
+            wakeup.wake()
+
+    def exec_timers(self):
+        """
+        Execute due timer callbacks
+        :returns: secs until next timer deadline, None if there are no more timers
+        """
+        while True:
+            with self._timers_lock:
+                if not self.timers:
+                    return None
+                deadline, _, fn = self.timers[0]
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    return remaining
+                heapq.heappop(self.timers)
+            fn()
+
+    def spawn_loop(self, **kwargs):
+        """
+        Start the loop in the worker process, out of the worker pool, when loop backend supports it.
+        gevent loop runs in its own greenlet so it does not occupy a pool slot
+        :param kwargs: :meth:`asynloop` arguments
+        :returns: greenlet running the loop, None if the backend can not spawn it
+        """
+        spawn = getattr(get_backend_class(self.loop_backend), "spawn", None)
+        if spawn is None:
+            return None
+        return spawn(self.asynloop, **kwargs)
+
+    def stop(self):
+        """
+        Request the loop to drain detached queue, disconnect and finish
+        """
+        self.stopping = True
+        wakeup = self.wakeup
+        if wakeup:
+            wakeup.wake()
+
     def cleanup(self):
         self.listening = False
-        self.detached_queue = Queue.Queue()
+        self.listening_event.clear()
+        self.cancel_listen_request()
+        self.stopping = False
+        if self.wakeup:
+            self.wakeup.close()
+            self.wakeup = None
+        self.loop_thread = None
+        self.facade.stop_reconnect()
 
-    def asynloop(self, auto_connect=False, timeout=10, detached_delay=0.2):
+    def exec_detached_queue(self, delay=0, batch_size=None, lane=None):
+        """
+        Execute callbacks from detached queue. Waits at most delay secs for the first callback and
+        then drains the queue without blocking.
+        :param float delay: max secs to wait for the first callback
+        :param int batch_size: max number of callbacks to execute, None to drain the whole queue
+        :param str lane: only execute callbacks of this lane, None for all lanes
+        :returns: number of callbacks executed
+        """
+        executed = 0
+        while batch_size is None or executed < batch_size:
+            try:
+                if executed == 0 and delay > 0:
+                    callback = self.detached_queue.get(True, delay, lane)
+                else:
+                    callback = self.detached_queue.get(False, lane=lane)
+            except Queue.Empty:
+                break
+            callback()
+            executed += 1
+        return executed
+
+    def asynloop(self, auto_connect=False, timeout=10, detached_delay=0.2, batch_size=None, persistent=None):
         """
         Non-blocking event loop consuming messages until connection is lost,
            or shutdown is requested.
-        :param int timeout: number of secs for asyncore timeout
-        :param float detached_delay: float secs to sleep when exiting asyncore loop and execution detached queue
-            callbacks
+        :param int timeout: number of secs for asyncore timeout. In persistent mode max secs for
+            each asyncore poll
+        :param float detached_delay: max float secs to wait for detached queue callbacks when exiting
+            asyncore loop. Waiting ends as soon as a callback is queued. Only used when socket pairs
+            are not available to wake up asyncore loop
+        :param int batch_size: max number of detached callbacks executed per iteration, None to drain
+            the whole queue
+        :param bool persistent: connect and keep looping until :meth:`stop` is called, None to use
+            stack persistent attribute
         """
-        if auto_connect:
-            self.broadcastEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_CONNECT))
+        if self.registry is not None:
+            return self.registry.asynloop(auto_connect, timeout, detached_delay, batch_size, persistent)
+        if persistent is None:
+            persistent = self.persistent
+        return run_loop([self], auto_connect, timeout, detached_delay, batch_size, persistent)
+
+
+def _owner(stacks, tb):
+    """
+    Stack whose layer raised the error of traceback or whose socket is broken, as select fails for every
+    socket of the map when one of them is closed
+    :returns: None if it is not found
+    """
+    while tb is not None:
+        obj = tb.tb_frame.f_locals.get("self")
+        if obj is not None:
+            for stack in stacks:
+                if stack.owns(obj):
+                    return stack
+        tb = tb.tb_next
+    for stack in stacks:
+        for layer in stack.layers():
+            sock = getattr(layer, "socket", None) if isinstance(layer, asyncore.dispatcher) else None
+            if sock is None:
+                continue
+            try:
+                select.select([sock], [], [], 0)
+            except (socket.error, select.error, ValueError):
+                return stack
+    return None
+
+
+def _fail(stacks, stack, error):
+    """
+    Remove stack failing authentication from the loop, the other stacks keep looping
+    :raises: AuthError when no stack is left
+    """
+    logger.error("Authentication Error of %s: %s" % (stack.account, error))
+    stacks.remove(stack)
+    stack.auth_error = error
+    if stack.facade.connected():
+        stack.broadcastEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_DISCONNECT))
+    stack.exec_detached_queue(lane=CONTROL_LANE)
+    stack.detached_queue.cancel_calls(exceptions.LoopTimeoutError("Authentication failed before executing call"))
+    # wakeup is shared by the stacks still looping
+    stack.wakeup = None
+    stack.cleanup()
+    if not stacks:
+        raise error
+
+
+def _each(stacks, fn):
+    """
+    Call fn with each stack, stacks failing authentication are removed from the loop
+    :returns: results of stacks not failed
+    """
+    results = []
+    for stack in list(stacks):
         try:
-            self.listening = True
-            start = int(time.time())
-            while True:
-                asyncore.loop(timeout)
-                time.sleep(detached_delay)
-                try:
-                    # Execute from detached queue callback
-                    callback = self.detached_queue.get(False)
-                    callback()
-                except Queue.Empty:
-                    pass
-                if int(time.time()) - start > timeout:
-                    logger.info("Asynloop : Timeout")
-                    #  defensive code should be already disconneted
-                    if self.facade.connected():
-                        self.broadcastEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_DISCONNECT))
-                    break
-            self.cleanup()
+            results.append(fn(stack))
         except AuthError as e:
-            self.cleanup()
-            raise exceptions.AuthenticationError("Authentication Error: {0}".format(e))
-        except:
-            self.cleanup()
-            exc_info = sys.exc_info()
-            traceback.print_exception(*exc_info)
-            raise exceptions.UnexpectedError(str(exc_info[0]))
+            _fail(stacks, stack, e)
+    return results
+
+
+def _poll(stacks, backend, timeout, count=None):
+    """
+    Poll sockets of all stacks. A network error disconnects only the stack owning the socket, which reconnects
+    if enabled, and an authentication error removes only that stack from the loop. The other stacks keep looping
+    """
+    try:
+        backend.poll(timeout, count=count)
+    except AuthError as e:
+        stack = _owner(stacks, sys.exc_info()[2])
+        if stack is None:
+            raise
+        _fail(stacks, stack, e)
+    except socket.error as e:
+        stack = _owner(stacks, sys.exc_info()[2])
+        failed = [stack] if stack is not None else stacks
+        logger.warning("Network error of %s: %s" % (", ".join(stack.account for stack in failed), e))
+        # close connection so layers are notified and reconnection is scheduled
+        for stack in failed:
+            stack.broadcastEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_DISCONNECT, reason=str(e)))
+
+
+def _drain(stacks, backend, timeout):
+    """
+    Execute callbacks queued before the loop finishes and poll until connected stacks have written their data
+    and throttled sends, at most timeout secs
+    """
+    deadline = time.time() + timeout
+    while True:
+        _each(stacks, lambda stack: stack.exec_timers() if stack.facade.connected() else None)
+        _each(stacks, lambda stack: stack.exec_detached_queue())
+        connected = [stack for stack in stacks if stack.facade.connected()]
+        pending = any(not stack.detached_queue.empty() or stack.facade.throttled() for stack in connected) or \
+            (connected and any(obj.writable() for obj in list(backend.socket_map.values())))
+        remaining = deadline - time.time()
+        if not pending or remaining <= 0:
+            return
+        _poll(stacks, backend, min(remaining, 0.05), count=1)
+
+
+def run_loop(stacks, auto_connect=False, timeout=10, detached_delay=0.2, batch_size=None, persistent=False):
+    """
+    Event loop shared by stacks. Sockets of all stacks are polled by the same asyncore loop, and
+    detached callbacks and timers of every stack are executed by it. When it finishes queued callbacks are
+    drained before disconnecting. A stack failing authentication is removed from the loop with its
+    auth_error set, the loop raises AuthenticationError only when every stack failed.
+    See :meth:`YowsupStack.asynloop`
+    """
+    # stacks still looping
+    active = list(stacks)
+    for stack in stacks:
+        stack.auth_error = None
+    backend = get_backend(stacks[0].loop_backend)
+    try:
+        if auto_connect or persistent:
+            _each(active, lambda stack: stack.broadcastEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_CONNECT)))
+        wakeup = stacks[0]._open_wakeup()
+        for stack in active:
+            # stop requests of a previous loop arriving after it finished are discarded
+            stack.stopping = False
+            stack.wakeup = wakeup
+            stack.loop_thread = threading.current_thread()
+            stack.listening = True
+            stack.listening_event.set()
+            stack.cancel_listen_request()
+        metrics = stacks[0].metrics
+        start = time.time()
+        while True:
+            iteration_start = time.time()
+            next_timers = [t for t in _each(active, lambda stack: stack.exec_timers()) if t is not None]
+            next_timer = min(next_timers) if next_timers else None
+            if wakeup:
+                # select returns on network activity or when a callback is queued
+                poll_timeout = timeout if persistent else max(start + timeout - time.time(), 0)
+                if next_timer is not None:
+                    poll_timeout = min(poll_timeout, next_timer)
+                _poll(active, backend, poll_timeout, count=1)
+                _each(active, lambda stack: stack.exec_detached_queue(0, batch_size))
+            else:
+                _poll(active, backend, timeout)
+                delay = detached_delay if next_timer is None else min(detached_delay, next_timer)
+                # only first stack waits for callbacks
+                _each(active, lambda stack: stack.exec_detached_queue(delay if stack is active[0] else 0, batch_size))
+            if metrics is not None:
+                now = time.time()
+                metrics.histogram("loop_iteration_seconds").observe(now - iteration_start)
+                metrics.gauge("loop_heartbeat_timestamp_seconds").set(now)
+            stopping = any(stack.stopping for stack in active)
+            if stopping or (not persistent and time.time() - start > timeout):
+                logger.info("Asynloop : %s" % ("Stopped" if stopping else "Timeout"))
+                _drain(active, backend, stacks[0].drain_timeout)
+                for stack in active:
+                    #  defensive code should be already disconneted
+                    if stack.facade.connected():
+                        stack.broadcastEvent(YowLayerEvent(YowNetworkLayer.EVENT_STATE_DISCONNECT))
+                for stack in active:
+                    # disconnection events, sends waited by tasks fail now so they are retried at once
+                    stack.exec_detached_queue(lane=CONTROL_LANE)
+                    stack.detached_queue.cancel_calls(
+                        exceptions.LoopTimeoutError("Loop finished before executing call"))
+                break
+        for stack in stacks:
+            stack.cleanup()
+        backend.close()
+    except AuthError as e:
+        backend.close()
+        for stack in stacks:
+            stack.cleanup()
+        raise exceptions.AuthenticationError("Authentication Error: {0}".format(e))
+    except:
+        backend.close()
+        for stack in stacks:
+            stack.cleanup()
+        exc_info = sys.exc_info()
+        traceback.print_exception(*exc_info)
+        raise exceptions.UnexpectedError(str(exc_info[0]))
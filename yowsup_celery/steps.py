@@ -1,13 +1,27 @@
 from __future__ import absolute_import
 from celery import bootsteps
 from yowsup_celery.stack import YowsupStack
+from yowsup_celery.registry import StackRegistry
+from yowsup_celery.routing import AccountRouter
 from yowsup_celery.utils import import_string
+from yowsup_celery.inbound import TaskSink
+from yowsup_celery.loops import get_backend_class, spawn_thread
+from yowsup_celery.metrics import MetricsRegistry, MetricsExporter
+from yowsup_celery.tracing import Tracer
+import inspect
 import logging
+import os
+import six
 from yowsup_celery.exceptions import ConfigurationError
 
 logger = logging.getLogger(__name__)
 
 class YowsupStep(bootsteps.StartStopStep):    
+    """
+    :ivar listener: thread or greenlet running the loop for the worker lifetime in persistent mode
+    :ivar MetricsExporter exporter: HTTP server exposing metrics, None if not enabled
+    """
+    stop_timeout = 10
     
     def _get_top_layers(self, worker):
         top_layers_string = worker.app.conf.table().get('TOP_LAYERS', None)
@@ -17,6 +31,39 @@ class YowsupStep(bootsteps.StartStopStep):
                 top_layer = import_string(top_layer_string)
                 top_layers.append(top_layer)
         return tuple(top_layers)    
+
+    def _get_inbound_sink(self, worker):
+        conf = worker.app.conf.table()
+        if conf.get('YOWSUP_INBOUND_TASK', None):
+            return TaskSink(worker.app, conf['YOWSUP_INBOUND_TASK'], conf.get('YOWSUP_INBOUND_QUEUE', None))
+        if conf.get('YOWSUP_INBOUND_SINK', None):
+            return import_string(conf['YOWSUP_INBOUND_SINK'])
+        return None
+
+    def _get_metrics(self, worker):
+        """
+        YOWSUP_METRICS True for default registry or path to a registry class or instance. Exporting
+        metrics with YOWSUP_METRICS_PORT enables the default registry too
+        """
+        conf = worker.app.conf.table()
+        metrics = conf.get('YOWSUP_METRICS', None)
+        if not metrics and conf.get('YOWSUP_METRICS_PORT', None) is None:
+            return None
+        if not isinstance(metrics, six.string_types):
+            return MetricsRegistry()
+        metrics = import_string(metrics)
+        return metrics() if inspect.isclass(metrics) else metrics
+
+    def _get_tracer(self, worker, metrics):
+        """
+        YOWSUP_TRACING enables tracer recording stage histogram in metrics registry, logging stages slower than
+        YOWSUP_TRACING_SLOW secs and passing spans to callable at YOWSUP_TRACING_SPANS path
+        """
+        conf = worker.app.conf.table()
+        if not conf.get('YOWSUP_TRACING', None):
+            return None
+        span_fn = conf.get('YOWSUP_TRACING_SPANS', None)
+        return Tracer(metrics, import_string(span_fn) if span_fn else None, conf.get('YOWSUP_TRACING_SLOW', None))
     
     def _get_config(self, config):
         try:
@@ -48,21 +95,98 @@ class YowsupStep(bootsteps.StartStopStep):
             else:
                 return None
         
-    def __init__(self, worker, login, config, unmoxie, **kwargs):
+    def __init__(self, worker, login, config, unmoxie, persistent=False, loop=None, **kwargs):
         """
         :param worker: celery worker
         :param login: optional login:password parameter
         :param config: optional path to configuration file
         :param unmoxie: boolean to disable encryption
+        :param persistent: boolean to keep connection alive until worker stops
+        :param loop: event loop backend, asyncore, asyncio or gevent
         """
+        self.persistent = persistent
+        self.listener = None
+        self.exporter = None
         credentials = self._get_credentials(login, config, worker)
         if not credentials:
             raise ConfigurationError("Error: You must specify a configuration method")
-        worker.app.stack = YowsupStack(credentials, not unmoxie, self._get_top_layers(worker))
-        logger.info("Yowsup for %s intialized" % credentials[0])
+        conf = worker.app.conf.table()
+        stack_kwargs = dict(persistent=persistent,
+                            ping_interval=conf.get('YOWSUP_PING_INTERVAL', None),
+                            pong_timeout=conf.get('YOWSUP_PONG_TIMEOUT', None),
+                            reconnect=conf.get('YOWSUP_RECONNECT', persistent),
+                            rate_limit=conf.get('YOWSUP_RATE_LIMIT', None),
+                            recipient_rate_limit=conf.get('YOWSUP_RECIPIENT_RATE_LIMIT', None),
+                            upload_workers=conf.get('YOWSUP_UPLOAD_WORKERS', None),
+                            upload_queue=conf.get('YOWSUP_UPLOAD_QUEUE', 100),
+                            media_cache=conf.get('YOWSUP_MEDIA_CACHE', None),
+                            media_cache_ttl=conf.get('YOWSUP_MEDIA_CACHE_TTL', 24 * 3600),
+                            media_metadata_cache=conf.get('YOWSUP_MEDIA_METADATA_CACHE', None),
+                            upload_attempts=conf.get('YOWSUP_UPLOAD_ATTEMPTS', None),
+                            upload_chunk_size=conf.get('YOWSUP_UPLOAD_CHUNK_SIZE', 64 * 1024),
+                            inbound_window=conf.get('YOWSUP_INBOUND_WINDOW', 1.0),
+                            inbound_batch_size=conf.get('YOWSUP_INBOUND_BATCH_SIZE', 100),
+                            loop_backend=loop or conf.get('YOWSUP_LOOP', None),
+                            detached_queue_size=conf.get('YOWSUP_DETACHED_QUEUE_SIZE', 10000),
+                            detached_queue_policy=conf.get('YOWSUP_DETACHED_QUEUE_POLICY', 'block'),
+                            detached_queue_timeout=conf.get('YOWSUP_DETACHED_QUEUE_TIMEOUT', 30),
+                            drain_timeout=conf.get('YOWSUP_DRAIN_TIMEOUT', 5),
+                            metrics=self._get_metrics(worker))
+        stack_kwargs['tracer'] = self._get_tracer(worker, stack_kwargs['metrics'])
+        worker.app.metrics = stack_kwargs['metrics']
+        top_layers = self._get_top_layers(worker)
+        inbound_sink = self._get_inbound_sink(worker)
+        worker.app.stack = YowsupStack(credentials, not unmoxie, top_layers, inbound_sink=inbound_sink,
+                                       **stack_kwargs)
+        worker.app.stacks = StackRegistry([worker.app.stack])
+        for account in conf.get('YOWSUP_ACCOUNTS', None) or ():
+            account_credentials = self._get_account_credentials(account, worker)
+            worker.app.stacks.add(YowsupStack(account_credentials, not unmoxie, top_layers, inbound_sink=inbound_sink,
+                                              **stack_kwargs))
+        worker.app.router = AccountRouter(worker.app.stacks)
+        logger.info("Yowsup for %s intialized" % ", ".join(worker.app.stacks.accounts()))
+
+    def _get_account_credentials(self, account, worker):
+        """
+        :param str account: phone:password login or path to configuration file
+        """
+        if ":" in account and not os.path.exists(account):
+            return self._get_credentials(account, None, worker)
+        return self._get_credentials(None, account, worker)
+
+    def start(self, worker):
+        """
+        Start metrics exporter when YOWSUP_METRICS_PORT is set. In persistent mode start the loop of all
+        accounts, in a greenlet with gevent loop and in a thread otherwise, so it is listening before the
+        first task arrives
+        """
+        conf = worker.app.conf.table()
+        if conf.get('YOWSUP_METRICS_PORT', None) is not None:
+            self.exporter = MetricsExporter(worker.app.metrics, conf['YOWSUP_METRICS_PORT'],
+                                            conf.get('YOWSUP_METRICS_ADDRESS', '127.0.0.1')).start()
+        if not self.persistent:
+            return
+        spawn = getattr(get_backend_class(worker.app.stack.loop_backend), "spawn", spawn_thread)
+        self.listener = spawn(self._listen, worker)
+        logger.info("Yowsup loop started")
+
+    def _listen(self, worker):
+        try:
+            worker.app.stack.asynloop(persistent=True)
+        except Exception:
+            # tasks start it again when needed
+            logger.exception("Yowsup loop stopped by error")
 
     def stop(self, worker):     
         logger.info("Stopping yowsup")
-        if worker.app.stack.facade.connected():
-            worker.app.stack.facade.disconnect()
-            logger.info("Disconnect yowsup")
+        worker.app.stacks.stop()
+        if self.listener is not None:
+            self.listener.join(self.stop_timeout)
+            self.listener = None
+        for stack in worker.app.stacks:
+            if stack.facade.connected():
+                stack.facade.disconnect()
+                logger.info("Disconnect yowsup %s" % stack.account)
+        if self.exporter is not None:
+            self.exporter.stop()
+            self.exporter = None
@@ -2,37 +2,120 @@ from __future__ import absolute_import
 
 from celery import Task, shared_task
 from functools import wraps
+import base64
+import time
+import six
+from yowsup_celery.exceptions import DeliveryTimeoutError, LoopTimeoutError, QueueFullError, ConnectionError
+from yowsup_celery.routing import AUTO_ACCOUNT
+from yowsup_celery.detached import TRANSACTIONAL_LANE, BULK_LANE
 
 def listening_required(f):
+    """
+    Start listen loop if needed, only once for concurrent tasks, and wait until it is listening.
+    With auto account any account listening is enough, as sends are routed to listening accounts.
+    Loop is spawned in the worker process when the loop backend supports it, otherwise a listen task
+    is sent. Task is retried when loop is not listening after listening_timeout secs.
+    Optional account keyword selects the stack of that account and optional lane keyword the detached queue
+    lane of its sends, they are not passed to the task. Task is retried too when its sends were not executed by
+    the loop in time, they are discarded so retrying does not duplicate them
+    """
     @wraps(f)
     def decorated_function(self, *args, **kwargs):
-        if not self.stack.listening:
-            listen.apply_async(queue=self.request.delivery_info['routing_key'])
-            return self.retry()
-        else:
+        account = kwargs.pop("account", None)
+        kwargs.pop("lane", None)
+        loop = self.loop
+        if not loop.listening:
+            if loop.request_listen() and not loop.spawn_loop():
+                options = {"kwargs": {"account": account}} if account else {}
+                listen.apply_async(queue=self.request.delivery_info['routing_key'], **options)
+            if not loop.wait_listening(self.listening_timeout):
+                # request is kept until the loop or listen task requested starts, so retries do not request it again
+                return self.retry()
+        try:
             return f(self, *args, **kwargs)
+        except LoopTimeoutError as e:
+            return self.retry(exc=e)
     return decorated_function
 
    
 class YowsupTask(Task):
     abstract = True
     default_retry_delay = 0.5
+    listening_timeout = 5
+    delivery_timeout = 30
+    default_lane = TRANSACTIONAL_LANE
     
     @property
     def stack(self):
-        return self.app.stack
+        """
+        Stack of account keyword of the task, default stack if it is not given or account is routed
+        by recipient
+        """
+        account = (self.request.kwargs or {}).get("account")
+        if account is None or account == AUTO_ACCOUNT:
+            return self.app.stack
+        return self.app.stacks.get(account)
+
+    @property
+    def loop(self):
+        """
+        Stack whose loop the task needs listening, stack registry when account is routed by recipient
+        """
+        if (self.request.kwargs or {}).get("account") == AUTO_ACCOUNT:
+            return self.app.stacks
+        return self.stack
     
     @property
     def facade(self):
-        return self.app.stack.facade
+        return self.stack.facade
+
+    @property
+    def lane(self):
+        """
+        Detached queue lane of the task sends, lane keyword of the task or task default lane
+        """
+        return (self.request.kwargs or {}).get("lane") or self.default_lane
+
+    def route(self, number):
+        """
+        Facade to send to number, chosen by app router when account keyword is auto
+        """
+        if (self.request.kwargs or {}).get("account") == AUTO_ACCOUNT:
+            return self.app.router.route(number).facade
+        return self.facade
+
+    def wait_delivery(self, message_id, event, timeout, facade=None):
+        delivery = (facade or self.facade).wait_delivery(message_id, event, timeout)
+        if delivery is None:
+            raise DeliveryTimeoutError("Message %s %s not received in %s secs" % (message_id, event, timeout))
+        return delivery
+
+    def delivery_result(self, message, result=None, facade=None):
+        """
+        :param message: sent message entity, None if it was buffered while reconnecting
+        :param str result: None returns True when message is handed to the stack, id returns message id,
+            ack or receipt wait for them and return message delivery
+        :param facade: facade message was sent with, task facade if None
+        """
+        if result is None:
+            return True
+        message_id = message.getId() if message else None
+        if result == "id" or message_id is None:
+            return message_id
+        return self.wait_delivery(message_id, result, self.delivery_timeout, facade)
     
     
 @shared_task(base=YowsupTask, bind=True, ignore_result=True)
-def listen(self):
-    if not self.stack.listening:
-        return self.stack.asynloop()
-    else:
-        return "Already listening"
+def listen(self, account=None):
+    loop = self.loop
+    try:
+        if not loop.listening:
+            return loop.asynloop()
+        else:
+            return "Already listening"
+    finally:
+        # loop finished or failed to start, next task requests it again
+        loop.cancel_listen_request()
 
 @shared_task(base=YowsupTask, bind=True)
 @listening_required
@@ -47,30 +130,91 @@ def disconnect(self):
 
 @shared_task(base=YowsupTask, bind=True)
 @listening_required
-def send_message(self, number, content):
-    self.facade.send_message(number, content)
-    return True
+def send_message(self, number, content, result=None):
+    facade = self.route(number)
+    return self.delivery_result(facade.send_message(number, content, lane=self.lane), result, facade)
+
+@shared_task(base=YowsupTask, bind=True, default_lane=BULK_LANE)
+@listening_required
+def send_messages_bulk(self, messages, result=None):
+    """
+    :param list messages: (number, content) pairs
+    :param str result: ack or receipt to wait for them and add delivery to each message, None for messages
+        not acked or received in time
+    :returns: number, id and status of each message. With auto account, messages of an account failing as a
+        whole get error status, the task is not retried as messages of other accounts were sent
+    """
+    if (self.request.kwargs or {}).get("account") == AUTO_ACCOUNT:
+        # send messages of each account in a batch, results keep messages order
+        facades = [self.route(number) for number, _ in messages]
+        routed = [None] * len(messages)
+        for facade in set(facades):
+            indexes = [i for i, f in enumerate(facades) if f is facade]
+            try:
+                sent = facade.send_messages([messages[i] for i in indexes], lane=self.lane)
+            except (LoopTimeoutError, QueueFullError, ConnectionError) as e:
+                sent = [{"number": messages[i][0], "id": None, "status": "error", "error": str(e)} for i in indexes]
+            for i, message in zip(indexes, sent):
+                routed[i] = (facade, message)
+    else:
+        routed = [(self.facade, message) for message in self.facade.send_messages(messages, lane=self.lane)]
+    if result in ("ack", "receipt"):
+        deadline = time.time() + self.delivery_timeout
+        for facade, message in routed:
+            if message["id"]:
+                # a lost ack does not discard results of the other messages
+                message["delivery"] = facade.wait_delivery(message["id"], result, max(deadline - time.time(), 0))
+    return [message for _, message in routed]
 
 @shared_task(base=YowsupTask, bind=True)
 @listening_required
 def send_image(self, number, path):
-    self.facade.send_image(number, path)
+    self.route(number).send_image(number, path, lane=self.lane)
     return True
 
 @shared_task(base=YowsupTask, bind=True)
 @listening_required
 def send_audio(self, number, path):
-    self.facade.send_audio(number, path)
+    self.route(number).send_audio(number, path, lane=self.lane)
     return True
 
+def media_data(data):
+    """
+    Media content sent as bytes, or as base64 text when task serializer does not support bytes
+    """
+    if isinstance(data, six.text_type):
+        return base64.b64decode(data)
+    return data
+
 @shared_task(base=YowsupTask, bind=True)
 @listening_required
-def send_location(self, number, name, url, latitude, longitude):
-    self.facade.send_location(number, name, url, latitude, longitude)
+def send_image_data(self, number, data, name, caption=None):
+    """
+    :param data: image content, bytes or base64 text
+    :param str name: image file name, used to guess mimetype
+    """
+    self.route(number).send_image_data(number, media_data(data), name, caption, lane=self.lane)
     return True
 
 @shared_task(base=YowsupTask, bind=True)
 @listening_required
-def send_vcard(self, number, name, data):
-    self.facade.send_vcard(number, name, data)
+def send_audio_data(self, number, data, name):
+    """
+    :param data: audio content, bytes or base64 text
+    :param str name: audio file name, used to guess mimetype
+    """
+    self.route(number).send_audio_data(number, media_data(data), name, lane=self.lane)
     return True
+
+@shared_task(base=YowsupTask, bind=True)
+@listening_required
+def send_location(self, number, name, url, latitude, longitude, result=None):
+    facade = self.route(number)
+    return self.delivery_result(facade.send_location(number, name, url, latitude, longitude, lane=self.lane), result,
+                                facade)
+
+@shared_task(base=YowsupTask, bind=True)
+@listening_required
+def send_vcard(self, number, name, data, result=None):
+    facade = self.route(number)
+    return self.delivery_result(facade.send_vcard(number, name, data, lane=self.lane), result, facade)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import time
+import logging
+from yowsup.layers import YowLayer
+
+logger = logging.getLogger(__name__)
+
+
+class Tracer(object):
+    """
+    Record duration of each stage an entity goes through, as a histogram of stage_seconds labeled by
+    stage and entity tag, and as spans passed to a callable.
+
+    Stages:
+        * lower: from the layer below CeleryLayer to network buffer, encoding and encryption included
+        * upper: from the layer below CeleryLayer to the end of CeleryLayer handling
+        * callback: protocol entity callback of CeleryLayer
+
+    :ivar MetricsRegistry metrics: registry recording stage histogram, None to not record it
+    :ivar span_fn: callable(stage, name, start, duration) receiving every span, None to not emit spans
+    :ivar float slow: secs over which a span is logged as warning, None to not log them
+    """
+
+    def __init__(self, metrics=None, span_fn=None, slow=None):
+        self.metrics = metrics
+        self.span_fn = span_fn
+        self.slow = slow
+
+    def record(self, stage, name, start, end=None):
+        """
+        :param str stage: lower, upper or callback
+        :param str name: entity tag
+        :param float start: time the stage started
+        :param float end: time the stage finished, now if None
+        """
+        duration = (end or time.time()) - start
+        if self.metrics is not None:
+            self.metrics.histogram("stage_seconds").observe(duration, stage=stage, name=name)
+        if self.span_fn is not None:
+            self.span_fn(stage, name, start, duration)
+        if self.slow is not None and duration > self.slow:
+            logger.warning("Slow %s of %s: %.3f secs" % (stage, name, duration))
+
+
+class TracingLayer(YowLayer):
+    """
+    Layer timing entities going through it to the stack tracer. Add it as the last of TOP_LAYERS to
+    be just below CeleryLayer. Entities pass through untouched when stack has no tracer.
+    """
+
+    def _tracer(self):
+        return getattr(self.getStack(), "tracer", None)
+
+    def send(self, entity):
+        tracer = self._tracer()
+        if tracer is None:
+            return self.toLower(entity)
+        start = time.time()
+        try:
+            self.toLower(entity)
+        finally:
+            tracer.record("lower", entity.getTag(), start)
+
+    def receive(self, entity):
+        tracer = self._tracer()
+        if tracer is None:
+            return self.toUpper(entity)
+        start = time.time()
+        try:
+            self.toUpper(entity)
+        finally:
+            tracer.record("upper", entity.getTag(), start)
+
+    def __str__(self):
+        return "Tracing Layer"
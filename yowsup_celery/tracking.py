@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+
+class AckTracker(object):
+    """
+    Bounded table of sent messages to correlate them with incoming acks and receipts
+
+    Each delivery is a dict with message id, recipient, message type, and sent, ack and receipt
+    timestamps. Deliveries older than ttl or exceeding max size are expired, oldest first.
+
+    :ivar OrderedDict deliveries: deliveries by message id in send order
+    :ivar dict callbacks: callbacks waiting for ack or receipt by (message id, event)
+    :ivar int unacked: tracked deliveries without ack
+    """
+
+    def __init__(self, max_size=10000, ttl=3600):
+        """
+        :param int max_size: max deliveries kept
+        :param float ttl: secs to keep deliveries
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.deliveries = OrderedDict()
+        self.callbacks = {}
+        self.unacked = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now, reserve=0):
+        while self.deliveries:
+            delivery = next(iter(self.deliveries.values()))
+            if len(self.deliveries) + reserve <= self.max_size and now - delivery["sent"] <= self.ttl:
+                break
+            message_id, delivery = self.deliveries.popitem(last=False)
+            if delivery["ack"] is None:
+                self.unacked -= 1
+            for event in ("ack", "receipt"):
+                self.callbacks.pop((message_id, event), None)
+
+    def sent(self, message_id, to, message_type=None):
+        now = time.time()
+        with self._lock:
+            previous = self.deliveries.pop(message_id, None)
+            if previous is not None and previous["ack"] is None:
+                self.unacked -= 1
+            self._expire(now, reserve=1)
+            self.unacked += 1
+            self.deliveries[message_id] = {"id": message_id, "to": to, "type": message_type,
+                                           "sent": now, "ack": None, "receipt": None}
+
+    def _update(self, message_id, key):
+        with self._lock:
+            delivery = self.deliveries.get(message_id)
+            if delivery is None or delivery[key] is not None:
+                return delivery
+            delivery[key] = time.time()
+            if key == "ack":
+                self.unacked -= 1
+            callbacks = self.callbacks.pop((message_id, key), [])
+        for callback in callbacks:
+            callback(self.get(message_id))
+        return delivery
+
+    def acked(self, message_id):
+        """
+        Record server ack for message
+        :returns: delivery or None if message is not tracked
+        """
+        return self._update(message_id, "ack")
+
+    def received(self, message_id):
+        """
+        Record recipient receipt for message
+        :returns: delivery or None if message is not tracked
+        """
+        return self._update(message_id, "receipt")
+
+    def get(self, message_id):
+        """
+        :returns: copy of delivery with ack and receipt latencies in secs, None if not tracked
+        """
+        with self._lock:
+            delivery = self.deliveries.get(message_id)
+            if delivery is None:
+                return None
+            delivery = dict(delivery)
+        delivery["ack_latency"] = delivery["ack"] - delivery["sent"] if delivery["ack"] else None
+        delivery["receipt_latency"] = delivery["receipt"] - delivery["sent"] if delivery["receipt"] else None
+        return delivery
+
+    def in_flight(self):
+        """
+        Number of tracked messages sent and not acked yet
+        """
+        with self._lock:
+            self._expire(time.time())
+            return self.unacked
+
+    def ack_latencies(self):
+        """
+        Ack latencies in secs of tracked messages
+        """
+        with self._lock:
+            return [d["ack"] - d["sent"] for d in self.deliveries.values() if d["ack"] is not None]
+
+    def add_callback(self, message_id, callback, event="ack"):
+        """
+        Call callback with delivery when message ack or receipt is received. Called at once if it
+        was already received
+        :param str event: ack or receipt
+        """
+        with self._lock:
+            delivery = self.deliveries.get(message_id)
+            if delivery is None or delivery[event] is None:
+                self.callbacks.setdefault((message_id, event), []).append(callback)
+                return
+        callback(self.get(message_id))
+
+    def remove_callback(self, message_id, callback, event="ack"):
+        with self._lock:
+            callbacks = self.callbacks.get((message_id, event), [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self.callbacks.pop((message_id, event), None)
+
+    def wait(self, message_id, event="ack", timeout=None):
+        """
+        Block until message ack or receipt is received
+        :param str event: ack or receipt
+        :param float timeout: max secs to wait
+        :returns: delivery or None if timeout expired
+        """
+        done = threading.Event()
+        result = []
+
+        def callback(delivery):
+            result.append(delivery)
+            done.set()
+        self.add_callback(message_id, callback, event)
+        if not done.wait(timeout):
+            self.remove_callback(message_id, callback, event)
+            return None
+        return result[0]
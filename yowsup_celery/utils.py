@@ -1,6 +1,18 @@
 import six
 import sys
+import time
+import random
+import logging
+import threading
+from collections import OrderedDict
 from importlib import import_module
+from yowsup_celery.exceptions import QueueFullError
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+logger = logging.getLogger(__name__)
 
 def import_string(dotted_path):
     """
@@ -21,3 +33,179 @@ def import_string(dotted_path):
         msg = 'Module "%s" does not define a "%s" attribute/class' % (
             module_path, class_name)
         six.reraise(ImportError, ImportError(msg), sys.exc_info()[2])
+
+
+class ExponentialBackoff(object):
+    """
+    Bounded exponential backoff delays with random jitter
+
+    :ivar int attempts: delays increased since last reset
+    """
+
+    def __init__(self, base=1, maximum=60, factor=2, jitter=0.5):
+        """
+        :param float base: delay in secs for the first attempt
+        :param float maximum: max delay in secs
+        :param float factor: multiplier applied to delay for each attempt
+        :param float jitter: fraction of the delay randomly subtracted to spread attempts
+        """
+        self.base = base
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next(self):
+        """
+        Delay in secs for the next attempt
+        """
+        delay = self.base * (self.factor ** self.attempts)
+        if delay < self.maximum:
+            self.attempts += 1
+        else:
+            delay = self.maximum
+        return delay - delay * self.jitter * random.random()
+
+    def reset(self):
+        self.attempts = 0
+
+
+class TTLCache(object):
+    """
+    Thread safe mapping bounded by size and age. Least recently used items are evicted when
+    max size is reached and items older than ttl are expired.
+
+    :ivar OrderedDict items: (timestamp, value) by key, least recently used first
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        """
+        :param int max_size: max items kept
+        :param float ttl: secs to keep items, None to keep them until evicted
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return default
+            if self.ttl is not None and time.time() - item[0] > self.ttl:
+                return default
+            self.items[key] = item
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self.items.pop(key, None)
+            while self.items and len(self.items) >= self.max_size:
+                self.items.popitem(last=False)
+            self.items[key] = (time.time(), value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self.items.pop(key, None)
+            return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class WorkerPool(object):
+    """
+    Bounded pool of daemon threads executing jobs. Threads are started with the first job.
+
+    Pending jobs (queued or running) are limited by max_pending slots, a slot must be acquired to
+    submit a job and it is released when job finishes.
+
+    :ivar Queue jobs: queued jobs
+    :ivar list threads: worker threads
+    """
+
+    def __init__(self, size=4, max_pending=100, name="worker"):
+        """
+        :param int size: number of threads
+        :param int max_pending: max jobs queued or running
+        :param str name: threads name prefix
+        """
+        self.size = size
+        self.name = name
+        self.jobs = Queue.Queue()
+        self.slots = Queue.Queue(max_pending)
+        self.threads = []
+        self._threads_lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """
+        Reserve a slot for a job, blocking while max pending jobs are reached
+        :param float timeout: max secs to wait, None to wait forever
+        """
+        try:
+            self.slots.put(None, True, timeout)
+        except Queue.Full:
+            raise QueueFullError("%s pool has %d pending jobs" % (self.name, self.slots.maxsize))
+
+    def release(self):
+        self.slots.get_nowait()
+
+    def pending(self):
+        return self.slots.qsize()
+
+    def submit(self, fn, args=(), reserved=False, timeout=None):
+        """
+        Queue a job to be executed by a pool thread
+        :param bool reserved: slot already acquired for the job
+        :param float timeout: max secs to wait for a slot when not reserved
+        """
+        if not reserved:
+            self.acquire(timeout)
+        self._start()
+        self.jobs.put((fn, args))
+
+    def _start(self):
+        with self._threads_lock:
+            while len(self.threads) < self.size:
+                thread = threading.Thread(target=self._work, name="%s-%d" % (self.name, len(self.threads)))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                fn, args = job
+                try:
+                    fn(*args)
+                except Exception:
+                    logger.exception("Error executing %s job" % self.name)
+                finally:
+                    self.release()
+            finally:
+                self.jobs.task_done()
+
+    def join(self):
+        """
+        Block until all queued jobs are done
+        """
+        self.jobs.join()
+
+    def stop(self, timeout=None):
+        """
+        Finish threads after queued jobs are done
+        """
+        with self._threads_lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.jobs.put(None)
+        for thread in threads:
+            thread.join(timeout)